@@ -27,6 +27,77 @@ import tools
 __doc__ = 'Set of functions that are use for backmapping.'
 
 
+class CenterOfMassMap(object):
+    """Forward mapping of atomistic positions to the centers of mass of CG beads.
+
+    The atoms of all beads are kept in one array of atom ids, grouped by beads, with
+    the array of their masses. The centers of mass of all beads are computed with one
+    weighted segment sum, for a single configuration or for a stack of frames.
+
+    Args:
+        bead_names: The names of CG beads.
+        atom_ids: The array of atom ids, the atoms of a bead are consecutive.
+        masses: The array of masses of the atoms.
+        starts: The array with the index of the first atom of every bead.
+    """
+    def __init__(self, bead_names, atom_ids, masses, starts):
+        self.bead_names = list(bead_names)
+        self.atom_ids = np.asarray(atom_ids, dtype=np.int64)
+        self.masses = np.asarray(masses, dtype=np.float64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        sizes = np.diff(np.append(self.starts, len(self.atom_ids)))
+        if len(self.starts) != len(self.bead_names) or (sizes <= 0).any():
+            raise RuntimeError('Every CG bead has to be mapped on at least one atom')
+        self.bead_masses = np.add.reduceat(self.masses, self.starts)
+        if (self.bead_masses <= 0.0).any():
+            raise RuntimeError('The total mass of CG beads {} is not positive'.format(
+                [self.bead_names[x] for x in np.flatnonzero(self.bead_masses <= 0.0)]))
+
+    @classmethod
+    def from_mass_map(cls, mass_map, fragments):
+        """Builds the map from the mass map of the CG molecule.
+
+        Args:
+            mass_map: The dictionary bead name -> {'chain_idx:chain_name:atom_name': mass}.
+            fragments: The atoms by chain name and atom name, e.g. GROFile.fragments.
+        """
+        bead_names, atom_ids, masses, starts = [], [], [], []
+        for cg_bead, aa_beads in mass_map.iteritems():
+            bead_names.append(cg_bead)
+            starts.append(len(atom_ids))
+            for aa_bead, aa_mass in aa_beads.iteritems():
+                _, chain_name, atom_name = aa_bead.split(':')
+                atom_ids.append(fragments[chain_name][atom_name].atom_id)
+                masses.append(aa_mass)
+        return cls(bead_names, atom_ids, masses, starts)
+
+    def tile(self, num_copies, num_atoms):
+        """Returns the map of num_copies consecutive molecules, each with num_atoms atoms."""
+        shifts = np.arange(num_copies)
+        return CenterOfMassMap(
+            self.bead_names * num_copies,
+            (self.atom_ids + num_atoms * shifts[:, None]).ravel(),
+            np.tile(self.masses, num_copies),
+            (self.starts + len(self.atom_ids) * shifts[:, None]).ravel())
+
+    def com(self, positions):
+        """Returns the centers of mass of CG beads.
+
+        Args:
+            positions: The array of shape (..., N, 3), the row of an atom is its id - 1.
+
+        Returns:
+            The array of shape (..., number of beads, 3).
+        """
+        weighted = np.asarray(positions)[..., self.atom_ids - 1, :] * self.masses[:, None]
+        return np.add.reduceat(weighted, self.starts, axis=-2) / self.bead_masses[:, None]
+
+    def map_frames(self, frames):
+        """Generates the centers of mass of CG beads for the frames, e.g. of files_io.read_trajectory."""
+        for frame in frames:
+            yield self.com(frame.position)
+
+
 def calculate_com_fragments(backmapper_settings):
     """For each of the bead calculate the center of mass based on the all-atom coordinate file.
 
@@ -43,25 +114,13 @@ def calculate_com_fragments(backmapper_settings):
     for mol_name, cg_mol in backmapper_settings.cg_molecules.iteritems():
         aa_file = files_io.GROFile(cg_mol.source_coordinates)
         aa_file.read()
-        cg_com_coords = {}
+        com_map = CenterOfMassMap.from_mass_map(cg_mol.mass_map, aa_file.fragments)
+        positions = aa_file.atoms.positions(np.arange(1, len(aa_file.atoms) + 1))
+        cg_com[cg_mol.name] = dict(zip(com_map.bead_names, com_map.com(positions)))
+
         cg_aa = collections.defaultdict(list)
-        for cg_bead, aa_beads in cg_mol.mass_map.iteritems():
-            c_mp = [0.0, 0.0, 0.0]
-            tot_mass = 0.0
-            for aa_bead, aa_mass in aa_beads.iteritems():
-                chain_id, chain_name, atom_name = aa_bead.split(':')
-                pos = aa_file.fragments[chain_name][atom_name].position
-                tot_mass += aa_mass
-                cg_aa[cg_bead].append(aa_file.fragments[chain_name][atom_name])
-                for i in range(3):
-                    c_mp[i] += pos[i] * aa_mass
-            for i in range(3):
-                c_mp[i] /= tot_mass
-            cg_com_coords[cg_bead] = np.array(c_mp)
-
-        for ca in cg_aa.values():
-            ca.sort(key=lambda x: x.atom_id)
-        cg_com[cg_mol.name] = cg_com_coords
+        for cg_bead, atom_ids in zip(com_map.bead_names, np.split(com_map.atom_ids, com_map.starts[1:])):
+            cg_aa[cg_bead] = [aa_file.atoms[x] for x in sorted(atom_ids.tolist())]
         cg_aa_beads[cg_mol.name] = cg_aa
     return cg_com, cg_aa_beads
 
@@ -71,7 +130,7 @@ def prepare_hyb_coordinates(settings, cg_graph, cg_com, cg_aa, plain=False):
 
     Args:
         settings: The BackmapperSettings object.
-        cg_graph: The networkx.Graph object with the CG structure.
+        cg_graph: The graph.Graph object with the CG structure.
         cg_com: Indexed by molecule name and bead index, position of COM of CG beads.
         cg_aa: Dictionary with atomistic fragments.
         plain: If set to 'CG' or 'AA' then prepare only configuration for that kind
@@ -318,16 +377,17 @@ def generate_crosslink_at_terms(settings, output_topology, plain=False):
         {k: v['bond_params'] for k, v in new_bonds.iteritems()})
     # Search for angles and dihedrals if angle_params and dihedral_params present.
     g = output_topology.get_graph()
+    local_paths = tools.LocalPaths(g)
     for pair, hyb_params in new_bonds.iteritems():
         gen_angle_params = hyb_params.get('angle_params')
         gen_dih_params = hyb_params.get('dihedral_params')
         gen_pair_params = hyb_params.get('pair_params')
         if gen_angle_params:
             output_topology.new_data['{}angles'.format(b_prefix)].update(
-                {x: gen_angle_params for x in tools.gen_bonded_tuples(g, 3, pair)})
+                {x: gen_angle_params for x in local_paths.bonded_tuples(3, pair)})
         dih_list = None
         if gen_dih_params or gen_pair_params:
-            dih_list = tools.gen_bonded_tuples(g, 4, pair)
+            dih_list = local_paths.bonded_tuples(4, pair)
         if gen_dih_params:
             output_topology.new_data['{}dihedrals'.format(b_prefix)].update(
                 {x: gen_dih_params for x in dih_list})
@@ -19,12 +19,26 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 I/O library. Handles opening and writing different files."""
 
 import collections
+import contextlib
 import copy
+import hashlib
+import itertools
 import logging
 import os
 
 import numpy
-import networkx
+
+import graph
+
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 __doc__ = "Set of I/O classes and functions."""
 
@@ -71,6 +85,927 @@ class TopoAtom(object):
             self.mass, self.active_site)
 
 
+# Columns of the atom section in .gro file, (start, end) in characters.
+GRO_COLUMNS = collections.OrderedDict([
+    ('chain_idx', (0, 5)),
+    ('chain_name', (5, 10)),
+    ('name', (10, 15)),
+    ('atom_id', (15, 20)),
+    ('x', (20, 28)),
+    ('y', (28, 36)),
+    ('z', (36, 44))
+    ])
+
+# Columns of the ATOM/HETATM records in .pdb file.
+PDB_COLUMNS = collections.OrderedDict([
+    ('atom_id', (6, 11)),
+    ('name', (12, 16)),
+    ('chain_name', (17, 20)),
+    ('chain_idx', (22, 26)),
+    ('x', (30, 38)),
+    ('y', (38, 46)),
+    ('z', (46, 54))
+    ])
+
+AtomBlock = collections.namedtuple(
+    'AtomBlock', [
+        'atom_id',
+        'name',
+        'chain_name',
+        'chain_idx',
+        'position'
+    ])
+
+
+def _fixed_columns(lines, columns):
+    """Cuts the fixed-width columns out of the lines in one pass.
+
+    Args:
+        lines: The list of lines.
+        columns: The dict with the name of column and (start, end) tuple.
+
+    Returns:
+        The dict with the name of column and the numpy array of byte strings.
+    """
+    width = max(end for _, end in columns.values())
+    raw = numpy.array(lines, dtype='S{}'.format(width))
+    # Short lines are padded with '\x00', the same as the missing value.
+    chars = raw.view('S1').reshape(len(lines), width)
+    output = {}
+    for col_name, (start, end) in columns.items():
+        output[col_name] = numpy.ascontiguousarray(
+            chars[:, start:end]).view('S{}'.format(end - start)).ravel()
+    return output
+
+
+def read_gro_block(lines, scale_factor=1.0, columns=GRO_COLUMNS):
+    """Parses the atom section of .gro file into the numpy arrays.
+
+    The atom ids are renumbered from 1 and the residue indexes are incremented
+    whenever the residue index in the file changes, the same as in GROFile.read.
+
+    Args:
+        lines: The list of lines with the atom section.
+        scale_factor: The factor by which the positions are multiplied.
+        columns: The definition of fixed-width columns.
+
+    Returns:
+        The AtomBlock tuple with the arrays.
+    """
+    number_of_atoms = len(lines)
+    if number_of_atoms == 0:
+        return AtomBlock(
+            atom_id=numpy.zeros(0, dtype=numpy.int64),
+            name=numpy.zeros(0, dtype=str),
+            chain_name=numpy.zeros(0, dtype=str),
+            chain_idx=numpy.zeros(0, dtype=numpy.int64),
+            position=numpy.zeros((0, 3)))
+    cols = _fixed_columns([l.rstrip('\r\n') for l in lines], columns)
+    gro_chain_idx = cols['chain_idx'].astype(numpy.int64)
+    chain_change = numpy.ones(number_of_atoms, dtype=numpy.int64)
+    chain_change[1:] = gro_chain_idx[1:] != gro_chain_idx[:-1]
+    position = numpy.empty((number_of_atoms, 3))
+    for dim, col_name in enumerate('xyz'):
+        position[:, dim] = cols[col_name].astype(numpy.float64)
+    position *= scale_factor
+    return AtomBlock(
+        atom_id=numpy.arange(1, number_of_atoms + 1, dtype=numpy.int64),
+        name=numpy.char.strip(cols['name']).astype(str),
+        chain_name=numpy.char.strip(cols['chain_name']).astype(str),
+        chain_idx=numpy.cumsum(chain_change),
+        position=position)
+
+
+# Columns of the wide variant of .gro file, atom and residue ids do not wrap at 99999.
+# The variant is not a GROMACS format, only bakery reads it back, see gro_columns.
+GRO_WIDE_COLUMNS = collections.OrderedDict([
+    ('chain_idx', (0, 10)),
+    ('chain_name', (10, 15)),
+    ('name', (15, 20)),
+    ('atom_id', (20, 30)),
+    ('x', (30, 38)),
+    ('y', (38, 46)),
+    ('z', (46, 54))
+    ])
+
+GRO_FORMAT = '%5d%-5s%5s%5d%8.3f%8.3f%8.3f'
+GRO_WIDE_FORMAT = '%10d%-5s%5s%10d%8.3f%8.3f%8.3f'
+
+
+def gro_columns(line):
+    """Returns the columns of the atom line of .gro file, GRO_COLUMNS or GRO_WIDE_COLUMNS.
+
+    The variant is detected from the column widths: the decimal point of the x coordinate
+    is in the column 24 of the standard line and in the column 34 of the wide one.
+
+    Args:
+        line: The atom line, str or bytes.
+    """
+    point = b'.' if isinstance(line, bytes) else '.'
+    if line[24:25] != point and line[34:35] == point:
+        return GRO_WIDE_COLUMNS
+    return GRO_COLUMNS
+
+
+def format_rows(fmt, columns, chunk_size=100000):
+    """Formats the columns row by row, in chunks.
+
+    Every chunk is formatted with a single % operation on the flat tuple of values,
+    so the output can be streamed without building the list of lines.
+
+    Args:
+        fmt: The format of a single row, without the new line.
+        columns: The list of arrays with values of the columns.
+        chunk_size: The number of rows in a chunk.
+
+    Returns:
+        The generator of strings, each with up to chunk_size lines.
+    """
+    num_rows = len(columns[0]) if columns else 0
+    row_fmt = fmt + '\n'
+    for start in range(0, num_rows, chunk_size):
+        end = min(start + chunk_size, num_rows)
+        chunk = numpy.empty((end - start, len(columns)), dtype=object)
+        for col_idx, column in enumerate(columns):
+            chunk[:, col_idx] = column[start:end]
+        yield (row_fmt * (end - start)) % tuple(chunk.ravel().tolist())
+
+
+def build_old2new(atom_ids, removed_ids=None, renumber=True):
+    """Returns the array that maps the old atom ids to the new ones, -1 marks removed atoms.
+
+    Args:
+        atom_ids: The ids of the existing atoms.
+        removed_ids: The ids of the atoms to remove.
+        renumber: Number the remaining atoms from 1 in the order of their ids, otherwise
+            the ids are kept.
+
+    Returns:
+        The int64 array indexed by the old atom id.
+    """
+    if removed_ids is None:
+        removed_ids = []
+    atom_ids = numpy.unique(numpy.asarray(list(atom_ids), dtype=numpy.int64))
+    removed_ids = numpy.unique(numpy.asarray(list(removed_ids), dtype=numpy.int64))
+    size = 1 + max([0] + [int(x.max()) for x in (atom_ids, removed_ids) if len(x)])
+    if renumber:
+        atom_ids = atom_ids[~numpy.isin(atom_ids, removed_ids)]
+        old2new = numpy.full(size, -1, dtype=numpy.int64)
+        old2new[atom_ids] = numpy.arange(1, len(atom_ids) + 1)
+    else:
+        old2new = numpy.arange(size, dtype=numpy.int64)
+        old2new[removed_ids] = -1
+    return old2new
+
+
+class Categories(object):
+    """Interned table of strings, every distinct value is stored only once."""
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def code(self, value):
+        """Returns the code of the value, adds the value if it is missing."""
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self._codes[value] = code
+            self.values.append(value)
+        return code
+
+    def codes(self, values):
+        """Returns the numpy array with codes of the values."""
+        uniques, inverse = numpy.unique(numpy.asarray(values), return_inverse=True)
+        uniques_codes = numpy.array([self.code(v) for v in uniques.tolist()], dtype=numpy.int32)
+        return uniques_codes[inverse.ravel()]
+
+    def decode(self, codes):
+        """Returns the numpy array with values of the codes."""
+        return numpy.array(self.values, dtype=object)[codes]
+
+
+class AtomStore(MutableMapping):
+    """Columnar storage of atoms, used by CoordinateFile.atoms.
+
+    Behaves like a dict of Atom objects indexed by atom id. The positions are kept in
+    one contiguous float array, the names and chain names as codes of the interned
+    tables. The Atom objects are created only on demand.
+
+    The position of the Atom is a read-only copy, so writing to it raises ValueError
+    instead of being lost. The position is changed by setting the atom again, e.g.
+    atoms[key] = atom._replace(position=new_position), or with CoordinateFile.update_positions.
+
+    Removed rows are only marked as dead; compact() reclaims them.
+    """
+    _columns = ('_key', '_atom_id', '_name', '_chain_name', '_chain_idx', '_alive')
+
+    def __init__(self, capacity=16):
+        capacity = max(int(capacity), 1)
+        self._key = numpy.zeros(capacity, dtype=numpy.int64)
+        self._atom_id = numpy.zeros(capacity, dtype=numpy.int64)
+        self._name = numpy.zeros(capacity, dtype=numpy.int32)
+        self._chain_name = numpy.zeros(capacity, dtype=numpy.int32)
+        self._chain_idx = numpy.zeros(capacity, dtype=numpy.int64)
+        self._alive = numpy.zeros(capacity, dtype=bool)
+        self._position = numpy.zeros((capacity, 3))
+        # Map atom id -> row, -1 if the atom does not exist.
+        self._row_of = numpy.full(capacity + 1, -1, dtype=numpy.int64)
+        self._size = 0
+        self._count = 0
+        self.names = Categories()
+        self.chain_names = Categories()
+        # Incremented on every modification, used to invalidate secondary indexes.
+        self.version = 0
+
+    @classmethod
+    def from_block(cls, block, keys=None):
+        """Creates the store from the AtomBlock arrays."""
+        store = cls(len(block.atom_id))
+        store.extend(
+            block.atom_id if keys is None else keys,
+            block.atom_id, block.name, block.chain_name, block.chain_idx, block.position)
+        return store
+
+    @classmethod
+    def from_atoms(cls, atoms):
+        """Creates the store from the dict of Atom objects."""
+        if isinstance(atoms, AtomStore):
+            return atoms.copy()
+        store = cls(len(atoms))
+        for key, atom in atoms.items():
+            store[key] = atom
+        return store
+
+    def _reserve(self, size):
+        capacity = len(self._key)
+        if size <= capacity:
+            return
+        new_capacity = max(size, 2 * capacity)
+        for col in self._columns:
+            old = getattr(self, col)
+            new = numpy.zeros(new_capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, col, new)
+        new_position = numpy.zeros((new_capacity, 3))
+        new_position[:self._size] = self._position[:self._size]
+        self._position = new_position
+
+    def _reserve_keys(self, max_key):
+        if max_key >= len(self._row_of):
+            new_row_of = numpy.full(max(max_key + 1, 2 * len(self._row_of)), -1, dtype=numpy.int64)
+            new_row_of[:len(self._row_of)] = self._row_of
+            self._row_of = new_row_of
+
+    def _row(self, key):
+        try:
+            row = self._row_of[key] if 0 <= key < len(self._row_of) else -1
+        except TypeError:
+            raise KeyError(key)
+        if row < 0:
+            raise KeyError(key)
+        return row
+
+    def extend(self, keys, atom_ids, names, chain_names, chain_idx, positions):
+        """Appends atoms given as arrays. Keys have to be new and unique."""
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        num = len(keys)
+        if num == 0:
+            return
+        if keys.min() < 0:
+            raise ValueError('Atom ids have to be positive')
+        self._reserve_keys(int(keys.max()))
+        if (self._row_of[keys] >= 0).any() or len(numpy.unique(keys)) != num:
+            raise ValueError('Atom ids already defined')
+        self._reserve(self._size + num)
+        rows = slice(self._size, self._size + num)
+        self._key[rows] = keys
+        self._atom_id[rows] = atom_ids
+        self._name[rows] = self.names.codes(names)
+        self._chain_name[rows] = self.chain_names.codes(chain_names)
+        self._chain_idx[rows] = chain_idx
+        self._position[rows] = positions
+        self._alive[rows] = True
+        self._row_of[keys] = numpy.arange(self._size, self._size + num)
+        self._size += num
+        self._count += num
+        self.version += 1
+
+    def __getitem__(self, key):
+        row = self._row(key)
+        position = self._position[row].copy()
+        position.flags.writeable = False
+        return Atom(
+            atom_id=int(self._atom_id[row]),
+            name=self.names.values[self._name[row]],
+            chain_name=self.chain_names.values[self._chain_name[row]],
+            chain_idx=int(self._chain_idx[row]),
+            position=position)
+
+    def __setitem__(self, key, atom):
+        try:
+            row = self._row(key)
+        except KeyError:
+            if key < 0:
+                raise ValueError('Atom ids have to be positive')
+            self._reserve_keys(key)
+            self._reserve(self._size + 1)
+            row = self._size
+            self._size += 1
+            self._count += 1
+            self._key[row] = key
+            self._alive[row] = True
+            self._row_of[key] = row
+        self._atom_id[row] = atom.atom_id
+        self._name[row] = self.names.code(atom.name)
+        self._chain_name[row] = self.chain_names.code(atom.chain_name)
+        self._chain_idx[row] = atom.chain_idx
+        self._position[row] = atom.position
+        self.version += 1
+
+    def __delitem__(self, key):
+        row = self._row(key)
+        self._alive[row] = False
+        self._row_of[key] = -1
+        self._count -= 1
+        self.version += 1
+
+    def __contains__(self, key):
+        try:
+            self._row(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.keys_array().tolist())
+
+    def __len__(self):
+        return self._count
+
+    def __eq__(self, other):
+        if not isinstance(other, AtomStore):
+            if not isinstance(other, Mapping):
+                return NotImplemented
+            other = AtomStore.from_atoms(other)
+        if len(self) != len(other):
+            return False
+        keys = numpy.sort(self.keys_array())
+        if not numpy.array_equal(keys, numpy.sort(other.keys_array())):
+            return False
+        rows, other_rows = self.rows(keys), other.rows(keys)
+        return bool(
+            numpy.array_equal(self._atom_id[rows], other._atom_id[other_rows]) and
+            numpy.array_equal(self._chain_idx[rows], other._chain_idx[other_rows]) and
+            numpy.array_equal(self._position[rows], other._position[other_rows]) and
+            numpy.array_equal(self.names.decode(self._name[rows]),
+                              other.names.decode(other._name[other_rows])) and
+            numpy.array_equal(self.chain_names.decode(self._chain_name[rows]),
+                              other.chain_names.decode(other._chain_name[other_rows])))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __copy__(self):
+        return self.copy()
+
+    def copy(self):
+        """Returns the compacted copy of the store."""
+        return self.take(self.keys_array())
+
+    def keys_array(self):
+        """Returns the numpy array with atom ids, in the insertion order."""
+        return self._key[:self._size][self._alive[:self._size]]
+
+    def rows(self, keys):
+        """Returns the rows of atom ids, raises KeyError if any is missing."""
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        if len(keys) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        if keys.min() < 0 or keys.max() >= len(self._row_of):
+            raise KeyError('Atom ids out of range')
+        rows = self._row_of[keys]
+        if (rows < 0).any():
+            raise KeyError(keys[rows < 0].tolist())
+        return rows
+
+    def columns(self, keys=None):
+        """Returns the AtomBlock with columns of selected atoms (default: all, in insertion order)."""
+        if keys is None:
+            keys = self.keys_array()
+        rows = self.rows(keys)
+        return AtomBlock(
+            atom_id=self._atom_id[rows],
+            name=self.names.decode(self._name[rows]),
+            chain_name=self.chain_names.decode(self._chain_name[rows]),
+            chain_idx=self._chain_idx[rows],
+            position=self._position[rows])
+
+    def positions(self, keys):
+        """Returns the (N, 3) array with positions of atoms."""
+        return self._position[self.rows(keys)]
+
+    def set_positions(self, keys, positions):
+        """Updates positions of atoms."""
+        self._position[self.rows(keys)] = positions
+        self.version += 1
+
+    def take(self, keys, new_keys=None):
+        """Returns new store with selected atoms.
+
+        Args:
+            keys: The atom ids to copy.
+            new_keys: The optional new ids, atom_id field is also updated.
+        """
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        rows = self.rows(keys)
+        output = AtomStore(len(keys))
+        output.names.values = list(self.names.values)
+        output.names._codes = dict(self.names._codes)
+        output.chain_names.values = list(self.chain_names.values)
+        output.chain_names._codes = dict(self.chain_names._codes)
+        num = len(keys)
+        if new_keys is None:
+            new_keys = keys
+            output._atom_id[:num] = self._atom_id[rows]
+        else:
+            new_keys = numpy.asarray(new_keys, dtype=numpy.int64)
+            output._atom_id[:num] = new_keys
+        if num:
+            output._reserve_keys(int(new_keys.max()))
+        output._key[:num] = new_keys
+        output._name[:num] = self._name[rows]
+        output._chain_name[:num] = self._chain_name[rows]
+        output._chain_idx[:num] = self._chain_idx[rows]
+        output._position[:num] = self._position[rows]
+        output._alive[:num] = True
+        output._row_of[new_keys] = numpy.arange(num)
+        output._size = output._count = num
+        return output
+
+    def remove(self, keys):
+        """Removes atoms, the missing ids are ignored."""
+        keys = numpy.asarray(list(keys), dtype=numpy.int64)
+        keys = keys[(keys >= 0) & (keys < len(self._row_of))]
+        rows = self._row_of[keys]
+        rows = numpy.unique(rows[rows >= 0])
+        self._alive[rows] = False
+        self._row_of[self._key[rows]] = -1
+        self._count -= len(rows)
+        self.version += 1
+
+    def compact(self):
+        """Drops the removed rows."""
+        if self._count != self._size:
+            self._replace_with(self.copy())
+
+    def remap(self, old2new):
+        """Changes the atom ids by the map, the rows are ordered by the new ids.
+
+        Args:
+            old2new: The array indexed by the old atom id, see build_old2new. The atoms
+                mapped to -1 or not in the array are removed.
+        """
+        keys = self.keys_array()
+        new_keys = numpy.full(len(keys), -1, dtype=numpy.int64)
+        inside = keys < len(old2new)
+        new_keys[inside] = old2new[keys[inside]]
+        keep = new_keys >= 0
+        order = numpy.argsort(new_keys[keep], kind='mergesort')
+        self._replace_with(self.take(keys[keep][order], new_keys[keep][order]))
+
+    def renumber(self):
+        """Renumbers atoms from 1, following the order of old atom ids."""
+        self.remap(build_old2new(self.keys_array()))
+
+    def _replace_with(self, other):
+        version = self.version
+        self.__dict__.update(other.__dict__)
+        self.version = version + 1
+
+
+class ParamTable(object):
+    """Interned table of parameter lists of bonded terms.
+
+    Every distinct list is stored only once as a tuple. The values of different types
+    that compare equal, e.g. 1 and 1.0, are kept apart, so they are written back as they are.
+    """
+    def __init__(self):
+        self.values = []
+        self._ids = {}
+        self._last = (None, None, None)
+
+    def __len__(self):
+        return len(self.values)
+
+    def code(self, params):
+        """Returns the id of the parameter list, adds the list if it is missing."""
+        # The same list is often added many times in a row.
+        last_params, last_values, last_id = self._last
+        if params is last_params and tuple(params) == last_values:
+            return last_id
+        values = tuple(params)
+        try:
+            key = (values, tuple([p.__class__ for p in values]))
+            param_id = self._ids.get(key)
+        except TypeError:  # Not hashable, stored without interning.
+            key = param_id = None
+        if param_id is None:
+            param_id = len(self.values)
+            self.values.append(values)
+            if key is not None:
+                self._ids[key] = param_id
+        self._last = (params, values, param_id)
+        return param_id
+
+    def decode(self, param_id):
+        """Returns the new list with the parameters."""
+        return list(self.values[param_id])
+
+
+def _packed_key(key):
+    """Packs the first two atom ids of the term into one int64 number that keeps their order.
+
+    Works on the tuple of ids and on the sequence of int32 arrays (the columns).
+    """
+    if isinstance(key, tuple):
+        high, low = int(key[0]), int(key[1]) if len(key) > 1 else -(1 << 31)
+    else:
+        high = key[0].astype(numpy.int64)
+        low = key[1].astype(numpy.int64) if len(key) > 1 else -(1 << 31)
+    return (high << 32) + (low + (1 << 31))
+
+
+def _lexsort_rows(keys):
+    """Returns the stable order of rows of the int32 array sorted by columns, the first column first."""
+    if not len(keys):
+        return numpy.zeros(0, dtype=numpy.int64)
+    packed = [_packed_key(keys[:, col:col + 2].T) for col in range(0, keys.shape[1], 2)]
+    if len(packed) == 1:
+        return numpy.argsort(packed[0], kind='mergesort')
+    return numpy.lexsort(packed[::-1])
+
+
+class BondedTerms(MutableMapping):
+    """Array-backed storage of one section of bonded terms, e.g. bonds or angles.
+
+    Behaves like a dict that maps the tuple of atom ids to the list of parameters.
+    The atom ids are kept in the int32 array of shape (N, arity) and every row refers to
+    the parameter list in the ParamTable, which can be shared between the sections.
+    The arity is set by the first added term.
+
+    The terms keep the order of insertion of the dict of Python 3.7: a term that is set
+    again keeps its place and takes the last parameters, a term that is deleted and added
+    again moves to the end. The new terms are collected in the dict of pending terms, the
+    arrays of terms added at once in the list of pending blocks. They are merged into the
+    arrays in one pass when they grow large or before the terms are iterated. The lookup
+    uses the packed first two atom ids of the rows, sorted.
+
+    Args:
+        data: The optional mapping or the list of (key, params) with the initial terms.
+        param_table: The ParamTable, by default a new one is created.
+        arity: The number of atoms in a term.
+    """
+    _min_pending = 1 << 16
+
+    def __init__(self, data=None, param_table=None, arity=None):
+        self.param_table = ParamTable() if param_table is None else param_table
+        self.arity = arity
+        # The terms in the order of insertion, the arrays are replaced and never changed in place.
+        self._ids = numpy.zeros((0, arity or 0), dtype=numpy.int32)
+        self._param = numpy.zeros(0, dtype=numpy.int32)
+        # The rows sorted by the atom ids and their packed first two atom ids.
+        self._index_rows = numpy.zeros(0, dtype=numpy.int64)
+        self._index_key = numpy.zeros(0, dtype=numpy.int64)
+        # key -> parameter id of the terms not yet in the arrays. The Python 2 dict has
+        # no order, the list keeps the keys in the order of their first insertion.
+        self._pending = {}
+        self._pending_keys = []
+        # The (ids, param) arrays added by add_coded() and add_many(), older than the pending dict.
+        self._blocks = []
+        if data is not None:
+            for key, params in (data.items() if isinstance(data, Mapping) else data):
+                self[key] = params
+
+    @classmethod
+    def from_mapping(cls, data, param_table=None):
+        """Returns the BondedTerms with the content of the mapping, the BondedTerms is copied."""
+        if isinstance(data, BondedTerms):
+            if param_table is None or param_table is data.param_table:
+                return data.copy()
+            return cls(data._iter_items(), param_table, data.arity)
+        return cls(data, param_table)
+
+    def _key(self, key):
+        key = tuple(key)
+        if self.arity is None:
+            self.arity = len(key)
+            self._ids = numpy.zeros((0, self.arity), dtype=numpy.int32)
+        elif len(key) != self.arity:
+            raise RuntimeError('Term {} does not match the arity {}'.format(key, self.arity))
+        return key
+
+    def _keys_array(self, keys):
+        keys = numpy.array(keys, dtype=numpy.int32)
+        if len(keys) and self.arity is None:
+            self._key(keys[0].tolist())
+        if len(keys) and (keys.ndim != 2 or keys.shape[1] != self.arity):
+            raise RuntimeError('Terms of shape {} do not match the arity {}'.format(keys.shape, self.arity))
+        return keys
+
+    def _find_row(self, key):
+        """Returns the row of the term in the arrays or None."""
+        index_key = self._index_key
+        if not len(index_key) or len(key) != self.arity:
+            return None
+        value = _packed_key(key)
+        pos = int(index_key.searchsorted(numpy.int64(value)))
+        while pos < len(index_key) and index_key[pos] == value:
+            row = self._index_rows[pos]
+            if self.arity <= 2 or tuple(self._ids[row, 2:].tolist()) == key[2:]:
+                return row
+            pos += 1
+        return None
+
+    def _find(self, key):
+        """Returns the current parameter id of the term or None."""
+        param_id = self._pending.get(key)
+        if param_id is None:
+            if self._blocks:
+                self._flush()
+            row = self._find_row(key)
+            if row is not None:
+                param_id = self._param[row]
+        return param_id
+
+    def _set_arrays(self, ids, param):
+        """Sets the arrays of terms, the duplicated terms are merged and the index is rebuilt.
+
+        The first row of a term keeps its place, the last one gives the parameters.
+        """
+        order = _lexsort_rows(ids)
+        sorted_ids = ids[order]
+        first = numpy.ones(len(ids), dtype=bool)
+        if len(ids) > 1:
+            first[1:] = numpy.any(sorted_ids[1:] != sorted_ids[:-1], axis=1)
+        if not first.all():
+            # The stable sort keeps the rows of the same term in the order of insertion.
+            starts = numpy.flatnonzero(first)
+            ends = numpy.append(starts[1:], len(ids)) - 1
+            param[order[starts]] = param[order[ends]]
+            keep = numpy.zeros(len(ids), dtype=bool)
+            keep[order[starts]] = True
+            order = (numpy.cumsum(keep) - 1)[order[starts]]
+            ids, param, sorted_ids = ids[keep], param[keep], sorted_ids[starts]
+        self._ids, self._param = ids, param
+        self._index_rows = order
+        self._index_key = _packed_key(sorted_ids.T) if len(ids) else numpy.zeros(0, dtype=numpy.int64)
+
+    def _block_pending(self):
+        """Moves the terms of the pending dict to the pending blocks."""
+        if self._pending_keys:
+            self._blocks.append((
+                numpy.array(self._pending_keys, dtype=numpy.int32).reshape(-1, self.arity),
+                numpy.array([self._pending[key] for key in self._pending_keys], dtype=numpy.int32)))
+            self._pending = {}
+            self._pending_keys = []
+
+    def _flush(self):
+        """Merges the pending terms into the arrays."""
+        self._block_pending()
+        if self._blocks:
+            blocks, self._blocks = self._blocks, []
+            self._set_arrays(
+                numpy.concatenate([self._ids] + [ids for ids, _ in blocks]),
+                numpy.concatenate([self._param] + [param for _, param in blocks]))
+
+    def append(self, key, params):
+        """Adds the term, as for the dict the last parameters win.
+
+        This is the fast path for parsing files, the term is compared with the arrays
+        when the pending terms are merged.
+        """
+        key = self._key(key)
+        if key not in self._pending:
+            self._pending_keys.append(key)
+        self._pending[key] = self.param_table.code(params)
+        if len(self._pending_keys) > max(self._min_pending, len(self._param) // 2):
+            self._flush()
+
+    __setitem__ = append
+
+    def add_many(self, keys, params):
+        """Adds the terms with the same parameters, like append().
+
+        Args:
+            keys: The array of shape (N, arity) with the atom ids.
+            params: The list of parameters.
+        """
+        keys = self._keys_array(keys)
+        if len(keys):
+            self._block_pending()
+            self._blocks.append((keys, numpy.full(len(keys), self.param_table.code(params), dtype=numpy.int32)))
+
+    def add_coded(self, keys, param_ids):
+        """Adds the terms with the ids of their parameters in the param_table, like append().
+
+        Args:
+            keys: The array of shape (N, arity) with the atom ids.
+            param_ids: The array of N parameter ids, see ParamTable.code.
+        """
+        keys = self._keys_array(keys)
+        if len(keys):
+            self._block_pending()
+            self._blocks.append((keys, numpy.array(param_ids, dtype=numpy.int32)))
+
+    def arrays(self):
+        """Returns the copy of the atom ids and parameter ids arrays, in the order of insertion."""
+        self._flush()
+        return self._ids.copy(), self._param.copy()
+
+    def contains_many(self, keys):
+        """Returns the boolean array, True for the rows of keys that are in the terms.
+
+        Args:
+            keys: The array of shape (N, arity) with the atom ids.
+        """
+        keys = numpy.asarray(keys, dtype=numpy.int32)
+        self._flush()
+        ids = self._ids
+        if not len(ids) or not len(keys) or keys.shape[1] != ids.shape[1]:
+            return numpy.zeros(len(keys), dtype=bool)
+        row_type = numpy.dtype((numpy.void, ids.dtype.itemsize * ids.shape[1]))
+        return numpy.isin(
+            numpy.ascontiguousarray(keys).view(row_type).ravel(),
+            numpy.ascontiguousarray(ids).view(row_type).ravel())
+
+    def max_id(self):
+        """Returns the largest atom id in the terms, 0 if there are none."""
+        self._flush()
+        return int(self._ids.max()) if self._ids.size else 0
+
+    def remap(self, old2new):
+        """Changes the atom ids by the map and drops the terms with removed atoms.
+
+        Args:
+            old2new: The array indexed by the old atom id, see build_old2new. The terms
+                with atoms mapped to -1 or not in the array are removed.
+        """
+        self._flush()
+        if not len(self._ids):
+            return
+        ids = self._ids.astype(numpy.int64)
+        inside = (ids >= 0) & (ids < len(old2new))
+        new_ids = numpy.where(inside, numpy.asarray(old2new)[numpy.where(inside, ids, 0)], -1)
+        keep = (new_ids >= 0).all(axis=1)
+        self._set_arrays(new_ids[keep].astype(numpy.int32), self._param[keep])
+
+    def __getitem__(self, key):
+        try:
+            param_id = self._find(tuple(key))
+        except (TypeError, ValueError):
+            param_id = None
+        if param_id is None:
+            raise KeyError(key)
+        return self.param_table.decode(param_id)
+
+    def __contains__(self, key):
+        try:
+            return self._find(tuple(key)) is not None
+        except (TypeError, ValueError):
+            return False
+
+    def __delitem__(self, key):
+        key = tuple(key)
+        if key not in self:
+            raise KeyError(key)
+        self._flush()
+        row = self._find_row(key)
+        if row is not None:
+            keep = numpy.arange(len(self._param)) != row
+            self._set_arrays(self._ids[keep], self._param[keep])
+
+    def __iter__(self):
+        self._flush()
+        ids = self._ids
+        for start in range(0, len(ids), 65536):
+            for key in ids[start:start + 65536].tolist():
+                yield tuple(key)
+
+    def __len__(self):
+        self._flush()
+        return len(self._param)
+
+    def __bool__(self):
+        return bool(self._pending_keys or self._blocks) or len(self._param) > 0
+
+    __nonzero__ = __bool__
+
+    def _iter_items(self):
+        """Iterates over (key, params) pairs."""
+        self._flush()
+        ids, param, values = self._ids, self._param, self.param_table.values
+        for start in range(0, len(param), 65536):
+            chunk = slice(start, start + 65536)
+            for key, param_id in zip(ids[chunk].tolist(), param[chunk].tolist()):
+                yield tuple(key), list(values[param_id])
+
+    def iteritems(self):
+        return self._iter_items()
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        return (params for _, params in self._iter_items())
+
+    def items(self):
+        return list(self._iter_items())
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [params for _, params in self._iter_items()]
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self._iter_items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'BondedTerms({})'.format(dict(self._iter_items()))
+
+    def __copy__(self):
+        # The arrays are never changed in place, so they are shared.
+        self._flush()
+        output = BondedTerms(param_table=self.param_table, arity=self.arity)
+        output.__dict__.update(self.__dict__)
+        output._pending, output._pending_keys, output._blocks = {}, [], []
+        return output
+
+    def copy(self):
+        return self.__copy__()
+
+    def __getstate__(self):
+        self._flush()
+        return self.__dict__.copy()
+
+
+class TermSections(dict):
+    """Dict of sections of bonded terms, every plain dict set in it becomes BondedTerms.
+
+    Args:
+        param_table: The ParamTable shared by the sections.
+    """
+    def __init__(self, data=None, param_table=None):
+        super(TermSections, self).__init__()
+        self.param_table = ParamTable() if param_table is None else param_table
+        if data:
+            self.update(data)
+
+    def __setitem__(self, section_name, data):
+        if not isinstance(data, BondedTerms) or data.param_table is not self.param_table:
+            data = BondedTerms.from_mapping(data, self.param_table)
+        super(TermSections, self).__setitem__(section_name, data)
+
+    def update(self, *args, **kwargs):
+        for section_name, data in dict(*args, **kwargs).items():
+            self[section_name] = data
+
+    def __reduce__(self):
+        return self.__class__, (dict(self), self.param_table)
+
+    def setdefault(self, section_name, data=None):
+        if section_name not in self:
+            self[section_name] = {} if data is None else data
+        return self[section_name]
+
+
+def _terms_property(section_name):
+    """Returns the property that keeps the section of the topology as BondedTerms."""
+    attr = '_{}'.format(section_name)
+
+    def getter(self):
+        return getattr(self, attr)
+
+    def setter(self, data):
+        if not isinstance(data, BondedTerms) or data.param_table is not self.param_table:
+            data = BondedTerms.from_mapping(data, self.param_table)
+        setattr(self, attr, data)
+    return property(getter, setter, doc='The {} section, see BondedTerms.'.format(section_name))
+
+
 def prepare_path(file_path):
     """Prepare the file to open.
 
@@ -99,22 +1034,215 @@ def prepare_path(file_path):
     return file_path
 
 
+# Version of the parsers, change it whenever the parsed state of a file changes,
+# the entries of the ParseCache written by the other version are then not used.
+PARSER_VERSION = 2
+
+
+class ParseCache(object):
+    """Cache of the parsed files, keyed by the hash of the file content and the parser version.
+
+    The parsed state of the file object is kept as a pickle, on disk if `cache_dir` is set,
+    and in memory up to `memory_limit` bytes, the least recently used entries are dropped
+    first. Every load gives new objects, so the loaded state can be modified.
+
+    Args:
+        cache_dir: The directory with the cache files, None to keep the cache only in memory.
+        memory_limit: The maximum size in bytes of the entries kept in memory, 0 to keep none.
+    """
+    def __init__(self, cache_dir=None, memory_limit=64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        self._recorders = []
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(file_obj, content, options=()):
+        """Returns the key of the content parsed by the file object with the options."""
+        digest = hashlib.sha1('{} {} {!r}\n'.format(
+            PARSER_VERSION, file_obj.__class__.__name__, tuple(options)).encode('utf-8'))
+        for line in content:
+            digest.update(line if isinstance(line, bytes) else line.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '{}.pck'.format(key))
+
+    def _remember(self, key, data):
+        """Keeps the data in memory as the most recently used entry, within the memory_limit."""
+        self._forget(key)
+        if len(data) > self.memory_limit:
+            return
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_limit:
+            _, old_data = self._memory.popitem(last=False)
+            self._memory_size -= len(old_data)
+
+    def _forget(self, key):
+        data = self._memory.pop(key, None)
+        if data is not None:
+            self._memory_size -= len(data)
+
+    def load(self, key):
+        """Returns the state stored under the key or None."""
+        data = self._memory.get(key)
+        if data is None and self.cache_dir and os.path.exists(self._path(key)):
+            with open(self._path(key), 'rb') as cache_file:
+                data = cache_file.read()
+        if data is None:
+            self.misses += 1
+            return None
+        try:
+            state = pickle.loads(data)
+        except Exception as ex:  # pylint:disable=W0703
+            logger.warning('Broken entry %s in the parse cache: %s', key, ex)
+            self._forget(key)
+            self.misses += 1
+            return None
+        self._remember(key, data)
+        self.hits += 1
+        return state
+
+    def store(self, key, state):
+        """Stores the state under the key."""
+        data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        self._remember(key, data)
+        if self.cache_dir:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # Written to the temporary file first, so other processes never read a partial entry.
+            tmp_path = '{}.{}.tmp'.format(self._path(key), os.getpid())
+            with open(tmp_path, 'wb') as cache_file:
+                cache_file.write(data)
+            os.rename(tmp_path, self._path(key))
+
+    def clear(self):
+        """Clears the memory part of the cache."""
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+
+    @contextlib.contextmanager
+    def recording(self):
+        """Context manager that yields the list of keys of the files read in the block.
+
+        The keys are appended in the order of reading, also for the files read without the cache.
+        """
+        keys = []
+        self._recorders.append(keys)
+        try:
+            yield keys
+        finally:
+            self._recorders.remove(keys)
+
+    def record(self, key):
+        """Appends the key of a read file to the lists of the open recordings."""
+        for keys in self._recorders:
+            keys.append(key)
+
+
+parse_cache = ParseCache(os.environ.get('BAKERY_CACHE_DIR') or None)
+
+
+def set_parse_cache_dir(cache_dir):
+    """Sets the directory of the on-disk parse cache, None keeps the cache only in memory."""
+    parse_cache.cache_dir = cache_dir or None
+
+
+def cached_read(file_obj, parse, options=(), cached=True):
+    """Parses the content of the file object or restores the parsed state from the parse_cache.
+
+    Args:
+        file_obj: The file object, with the content already read.
+        parse: The function that parses the content and fills the file object.
+        options: The options of the file object that change the result of the parsing.
+        cached: If False, the content is always parsed and the state is not stored.
+    """
+    key = ParseCache.key(file_obj, file_obj.content, options)
+    parse_cache.record(key)
+    if not cached:
+        parse()
+        return
+    state = parse_cache.load(key)
+    if state is not None:
+        logger.info('Parsed %s found in cache', file_obj.file_name)
+        file_obj.set_parsed_state(state)
+        return
+    parse()
+    parse_cache.store(key, file_obj.get_parsed_state())
+
+
 class CoordinateFile(object):
-    """Coordinate file object."""
+    """Coordinate file object.
+
+    The atoms are kept in the AtomStore, the secondary indexes `chains`
+    (chain_name -> chain_idx -> atom name -> Atom) and `fragments`
+    (chain_name -> atom name -> Atom) are built on the first access.
+    """
     def __init__(self, file_name):
         self.file_name = file_name
         self.title = None
         self.atoms_updated = False
-        self.atoms = {}
-        self.chains = {}
+        self._atoms = AtomStore()
+        self._chains = None
+        self._fragments = None
+        self._indexes_version = None
         self.content = None
         self.box = None
         self.data = None
         self.scale_factor = 1.0
         self.file = None
-        self.fragments = collections.defaultdict(dict)
+        # Map atom id -> particle id, the missing entries are identity.
         self.id_map = {}
 
+    @property
+    def atoms(self):
+        return self._atoms
+
+    @atoms.setter
+    def atoms(self, atoms):
+        if not isinstance(atoms, AtomStore):
+            atoms = AtomStore.from_atoms(atoms)
+        self._atoms = atoms
+        self._indexes_version = None
+
+    @property
+    def chains(self):
+        self._build_indexes()
+        return self._chains
+
+    @property
+    def fragments(self):
+        self._build_indexes()
+        return self._fragments
+
+    def _build_indexes(self):
+        if self._indexes_version == self._atoms.version:
+            return
+        chains = {}
+        fragments = collections.defaultdict(dict)
+        for at_id in self._atoms:
+            at = self._atoms[at_id]
+            fragments[at.chain_name][at.name] = at
+            chain = chains.setdefault(at.chain_name, {})
+            chain.setdefault(at.chain_idx, {})[at.name] = at
+        self._chains = chains
+        self._fragments = fragments
+        self._indexes_version = self._atoms.version
+
+    def get_parsed_state(self):
+        """Returns the attributes set by parsing the file, used by the ParseCache."""
+        return {'title': self.title, 'box': self.box, 'atoms': self._atoms}
+
+    def set_parsed_state(self, state):
+        """Restores the attributes from get_parsed_state()."""
+        self.title = state['title']
+        self.box = state['box']
+        self.atoms = state['atoms']
+
     def init(self):
         self.__init__(self.file_name)
         logger.info('Init of coordinate file')
@@ -124,24 +1252,46 @@ class CoordinateFile(object):
         self.atoms_updated = False
 
 
+# Sections of bonded terms kept as attributes of the TopologyFile.
+TERM_SECTIONS = (
+    'bonds', 'angles', 'dihedrals', 'improper_dihedrals', 'pairs',
+    'cross_bonds', 'cross_angles', 'cross_dihedrals', 'cross_pairs')
+
+
 class TopologyFile(object):
     """Reader for GROMACS .top files.
 
+    The sections of bonded terms, also those in `new_data`, are kept as BondedTerms
+    with one shared ParamTable; plain dicts assigned to them are converted.
+
     Args:
         file_name: The input topology file.
     """
+    bonds = _terms_property('bonds')
+    angles = _terms_property('angles')
+    dihedrals = _terms_property('dihedrals')
+    improper_dihedrals = _terms_property('improper_dihedrals')
+    pairs = _terms_property('pairs')
+    cross_bonds = _terms_property('cross_bonds')
+    cross_angles = _terms_property('cross_angles')
+    cross_dihedrals = _terms_property('cross_dihedrals')
+    cross_pairs = _terms_property('cross_pairs')
+
+    # Attributes that are not the result of parsing, skipped by get_parsed_state().
+    _unparsed_attrs = frozenset(['file_name', 'file', 'content', 'parsers', 'writers'])
 
     def __init__(self, file_name):
         self.file_name = file_name
         self.title = None
         self.atoms_updated = False
-        self.new_data = {
+        self.param_table = ParamTable()
+        self.new_data = TermSections({
             'bonds': {},
             'angles': {},
             'dihedrals': {},
             'improper_dihedrals': {},
             'pairs': {}
-            }
+            }, self.param_table)
         self.parsers = {}
         self.writers = {}
 
@@ -174,6 +1324,14 @@ class TopologyFile(object):
         self.content = None
         self.file = None
 
+    def get_parsed_state(self):
+        """Returns the attributes set by parsing the file, used by the ParseCache."""
+        return {k: v for k, v in self.__dict__.items() if k not in self._unparsed_attrs}
+
+    def set_parsed_state(self, state):
+        """Restores the attributes from get_parsed_state()."""
+        self.__dict__.update(state)
+
     def init(self):
         self.__init__(self.file_name)
         logger.info('Init of topology file.')
@@ -185,10 +1343,80 @@ class TopologyFile(object):
             del self.__dict__['__state']
 
 
+class ParticleSnapshot(object):
+    """Positions and image boxes of particles, gathered from the storage in a single pass.
+
+    Args:
+        ids: The array of particle ids.
+        position: The (N, 3) array of folded positions.
+        image_box: The (N, 3) array of image boxes.
+    """
+    def __init__(self, ids, position, image_box):
+        order = numpy.argsort(ids, kind='mergesort')
+        self.ids = numpy.asarray(ids)[order]
+        self.position = numpy.asarray(position, dtype=numpy.float64)[order]
+        self.image_box = numpy.asarray(image_box, dtype=numpy.float64)[order]
+
+    @classmethod
+    def take(cls, system, particle_ids):
+        """Reads the particles from the system storage.
+
+        Args:
+            system: The espressopp.System object, or any object with storage.getParticle.
+            particle_ids: The list of particle ids to read.
+
+        Returns:
+            The ParticleSnapshot object.
+        """
+        particle_ids = numpy.unique(numpy.asarray(particle_ids, dtype=numpy.int64))
+        position = numpy.zeros((len(particle_ids), 3))
+        image_box = numpy.zeros((len(particle_ids), 3))
+        get_particle = system.storage.getParticle
+        for idx, pid in enumerate(particle_ids.tolist()):
+            pt = get_particle(pid)
+            position[idx] = tuple(pt.pos)
+            image_box[idx] = tuple(pt.imageBox)
+        return cls(particle_ids, position, image_box)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, particle_ids):
+        """Returns the rows of given particles, raises KeyError if any of them is missing."""
+        particle_ids = numpy.asarray(particle_ids)
+        rows = numpy.searchsorted(self.ids, particle_ids)
+        rows[rows == len(self.ids)] = 0
+        missing = (self.ids[rows] != particle_ids) if len(self.ids) else numpy.ones(len(rows), dtype=bool)
+        if missing.any():
+            raise KeyError('Particles not in the snapshot: {}'.format(particle_ids[missing][:10].tolist()))
+        return rows
+
+    def positions(self, particle_ids, box=None):
+        """Returns the (N, 3) array of positions of given particles.
+
+        Args:
+            particle_ids: The list of particle ids.
+            box: If set, the positions are unfolded with this box size.
+        """
+        rows = self.rows(particle_ids)
+        position = self.position[rows]
+        if box is not None:
+            position += numpy.asarray(box, dtype=numpy.float64)*self.image_box[rows]
+        return position
+
+
 class GROFile(CoordinateFile):
-    def read(self):
+    # Atom and residue ids in wide columns, see GRO_WIDE_COLUMNS. None: detected by read()
+    # from the first atom line, the standard columns in write().
+    wide = None
+
+    def read(self, cached=True):
         """Reads the .gro file and return the atom list.
 
+        Args:
+          cached: If False, the file is not stored in the parse_cache, for the files written
+            by bakery itself, e.g. the hybrid configuration.
+
         Returns:
           The dict with atoms (key: atom_id, value: atom object).
         """
@@ -196,77 +1424,39 @@ class GROFile(CoordinateFile):
         self.file = open(self.file_name, 'r')
         if not self.content:
             self.content = self.file.readlines()
+        if self.wide is None:
+            self.wide = len(self.content) > 2 and gro_columns(self.content[2]) is GRO_WIDE_COLUMNS
 
+        cached_read(self, self._parse, (self.scale_factor, self.wide), cached)
+
+    def _parse(self):
+        """Parses the content of the .gro file."""
         self.title = self.content[0].replace('\r\n', '').replace('\n', '')
         number_of_atoms = int(self.content[1])
 
         logger.info('Reading GRO file %s', self.file_name)
 
-        at_id = 1  # Ignore atom id section
-        chain_idx = 0  # Ignore chain idx section
-        last_chain_idx = None
-        for line in self.content[2:number_of_atoms + 2]:
-            gro_chain_idx = int(line[0:5].strip())
-            if last_chain_idx != gro_chain_idx:  # Increment chain_idx when the original one change
-                chain_idx += 1
-                last_chain_idx = gro_chain_idx
-            chain_name = line[5:10].strip()
-            at_name = line[10:15].strip()
-            self.id_map[at_id] = at_id
-            # Need to rescale.
-            pos_x = float(line[20:28].strip()) * self.scale_factor
-            pos_y = float(line[28:36].strip()) * self.scale_factor
-            pos_z = float(line[36:44].strip()) * self.scale_factor
-
-            self.atoms[at_id] = (
-                Atom(
-                    atom_id=at_id,
-                    name=at_name,
-                    chain_name=chain_name,
-                    chain_idx=chain_idx,
-                    position=numpy.array([pos_x, pos_y, pos_z])
-                ))
-            self.fragments[chain_name][at_name] = self.atoms[at_id]
-            if chain_name not in self.chains:
-                self.chains[chain_name] = {}
-            if chain_idx not in self.chains[chain_name]:
-                self.chains[chain_name][chain_idx] = {}
-            self.chains[chain_name][chain_idx][at_name] = self.atoms[at_id]
-            at_id += 1
+        # Atom ids and residue indexes from the file are ignored, see read_gro_block.
+        self.atoms = AtomStore.from_block(read_gro_block(
+            self.content[2:number_of_atoms + 2], self.scale_factor,
+            GRO_WIDE_COLUMNS if self.wide else GRO_COLUMNS))
 
         # Reads the box size, the last line.
         self.box = numpy.array(
-            map(float, filter(None, self.content[number_of_atoms + 2].split(' ')))
-            ) * self.scale_factor
+            self.content[number_of_atoms + 2].split(), dtype=numpy.float64) * self.scale_factor
 
     def remove_atoms(self, atom_ids, renumber=True):
         """Remove atom and renumber the file."""
-        for atom_id in atom_ids:
-            atom_to_remove = self.atoms[atom_id]
-            try:
-                del self.fragments[atom_to_remove.chain_name][atom_to_remove.name]
-                del self.chains[atom_to_remove.chain_name][atom_to_remove.chain_idx][atom_to_remove.name]
-            except KeyError:
-                pass
-            del self.atoms[atom_id]
-
+        atom_ids = list(atom_ids)
+        self.atoms.rows(atom_ids)  # Raises KeyError on missing atoms.
         if renumber:
-            new_at_id = 1
-            new_atoms = {}
-            for at_id in self.atoms:
-                new_atoms[new_at_id] = self.atoms[at_id]._replace(atom_id=new_at_id)
-                new_at_id += 1
-            self.atoms = new_atoms
+            self.atoms.remap(build_old2new(self.atoms.keys_array(), atom_ids))
+        else:
+            self.atoms.remove(atom_ids)
 
     def renumber(self):
         """Renumber atoms with new id"""
-        new_at_id = 1
-        new_atoms = {}
-        for at_id in self.atoms:
-            new_atoms[new_at_id] = self.atoms[at_id]._replace(atom_id=new_at_id)
-            new_at_id += 1
-        self.atoms = new_atoms
-
+        self.atoms.renumber()
 
     @staticmethod
     def copy(input_gro, particle_ids=None, renumber=False):
@@ -283,80 +1473,73 @@ class GROFile(CoordinateFile):
         output_gro.title = input_gro.title
         output_gro.id_map = {}
         if particle_ids:
+            particle_ids = numpy.asarray(particle_ids, dtype=numpy.int64)
             if renumber:
-                new_pid = 1
-                for pid in particle_ids:
-                    at = input_gro.atoms[pid]
-                    output_gro.id_map[new_pid] = pid
-                    output_gro.atoms[new_pid] = Atom(
-                        atom_id=new_pid,
-                        name=at.name,
-                        chain_name=at.chain_name,
-                        chain_idx=at.chain_idx,
-                        position=at.position
-                    )
-                    new_pid += 1
+                new_pids = numpy.arange(1, len(particle_ids) + 1)
+                output_gro.atoms = input_gro.atoms.take(particle_ids, new_pids)
+                output_gro.id_map = dict(zip(new_pids.tolist(), particle_ids.tolist()))
             else:
-                for pid in particle_ids:
-                    output_gro.atoms[pid] = copy.copy(input_gro.atoms[pid])
-                    output_gro.id_map[pid] = pid
+                output_gro.atoms = input_gro.atoms.take(particle_ids)
         else:
-            output_gro.atoms = copy.copy(input_gro.atoms)
-            output_gro.id_map = {k: k for k in output_gro.atoms}
+            output_gro.atoms = input_gro.atoms.copy()
         return output_gro
 
-    def write(self, file_name=None, force=False):
+    def write(self, file_name=None, force=False, wide=None):
         """Writes the content to the output file.
 
         Args:
           file_name: The new file name, otherwise the old one will be used.
           force: Force to save even if any atoms were not updated.
+          wide: Use wide columns for atom and residue ids instead of wrapping them
+            at 99999 (default: self.wide). Only bakery reads such files back.
         """
 
         if self.atoms_updated or force:
-            output = []
-            if self.title:
-                output.append(self.title)
-            else:
-                output.append('XXX of molecules')
-            # Puts the number of atoms
-            output.append('%d' % len(self.atoms))
-            # Puts the definition of the atoms, fixed format.
-            fmt = "%5d%-5s%5s%5d%8.3f%8.3f%8.3f"
-            for at_id in sorted(self.atoms):
-                at = self.atoms[at_id]
-                output.append(fmt % (
-                    at.chain_idx % 99999,
-                    at.chain_name,
-                    at.name,
-                    at.atom_id % 99999,
-                    at.position[0],
-                    at.position[1],
-                    at.position[2]
-                    ))
-
-            output.append('%f %f %f\n' % tuple(self.box))
+            if wide is None:
+                wide = self.wide
             write_file_path = prepare_path(file_name if file_name else self.file_name)
             logger.info('Writing GRO file %s', write_file_path)
-            output_file = open(write_file_path, 'w')
-            output_file.writelines('\n'.join(output))
-            output_file.close()
+            with open(write_file_path, 'w') as output_file:
+                output_file.write('{}\n'.format(self.title if self.title else 'XXX of molecules'))
+                # Puts the number of atoms
+                output_file.write('%d\n' % len(self.atoms))
+                # Puts the definition of the atoms, fixed format.
+                at = self.atoms.columns(numpy.sort(self.atoms.keys_array()))
+                if wide:
+                    fmt, chain_idx, atom_id = GRO_WIDE_FORMAT, at.chain_idx, at.atom_id
+                else:
+                    fmt, chain_idx, atom_id = GRO_FORMAT, at.chain_idx % 99999, at.atom_id % 99999
+                for chunk in format_rows(fmt, [
+                        chain_idx.tolist(), at.chain_name, at.name, atom_id.tolist(),
+                        at.position[:, 0].tolist(), at.position[:, 1].tolist(),
+                        at.position[:, 2].tolist()]):
+                    output_file.write(chunk)
+                output_file.write('%f %f %f\n' % tuple(self.box))
             self.atoms_updated = False
 
-    def update_positions(self, system, unfolded=True):
-        """Update positions. Warning! This is a very slow approach, use only to save end-state.
+    def particle_ids(self):
+        """Returns the array of particle ids in the storage, following the id_map."""
+        at_ids = self.atoms.keys_array()
+        if not self.id_map:
+            return at_ids
+        return numpy.array([self.id_map.get(at_id, at_id) for at_id in at_ids.tolist()], dtype=at_ids.dtype)
+
+    def update_positions(self, system, unfolded=True, snapshot=None):
+        """Update positions.
+
+        Without the snapshot, the particles are read one by one from the storage, which is slow.
+        To update several files, take one ParticleSnapshot and pass it to every call.
 
         Args:
             system: The espressopp.System object.
             unfolded: Update position with unfolded coordinates.
+            snapshot: The ParticleSnapshot that contains all particles of this file.
         """
-        for at_id in self.atoms:
-            pt = system.storage.getParticle(self.id_map.get(at_id, at_id))
-            old_atom = self.atoms[at_id]
-            new_pos = pt.pos
-            if unfolded:
-                new_pos = numpy.array(list(pt.pos)) + numpy.array(self.box)*numpy.array(list(pt.imageBox))
-            self.atoms[at_id] = old_atom._replace(position=new_pos)
+        if snapshot is None:
+            snapshot = ParticleSnapshot.take(system, self.particle_ids())
+        self.atoms.set_positions(
+            self.atoms.keys_array(),
+            snapshot.positions(self.particle_ids(), self.box if unfolded else None))
 
     def dump(self, system, filename, particle_ids, chain_name, chain_idx, atom_name):
         """Dump data from storage."""
@@ -374,42 +1557,295 @@ class GROFile(CoordinateFile):
         self.write(filename, force=True)
 
 
+
+GROFrame = collections.namedtuple('GROFrame', ['title', 'position', 'box'])
+
+
+class GROTrajectory(object):
+    """Reader of multi-frame .gro files, e.g. written by DumpGRO with append=True.
+
+    The file is scanned once to build the index of byte offsets of the frames. The
+    index is cached in the sidecar file `<file_name>.idx` and reused as long as the
+    size and the modification time of the .gro file do not change. The frames are
+    read lazily, only one frame is kept in the memory.
+
+    Args:
+        file_name: The input .gro file.
+        scale_factor: The factor by which the positions are multiplied.
+        use_cache: Read and write the sidecar index file.
+        wide: The file has wide columns, see GRO_WIDE_COLUMNS. None: detected in every
+            frame from the first atom line.
+    """
+    index_version = 1
+
+    def __init__(self, file_name, scale_factor=1.0, use_cache=True, wide=None):
+        self.file_name = file_name
+        self.scale_factor = scale_factor
+        self.columns = None
+        if wide is not None:
+            self.columns = self._position_columns(GRO_WIDE_COLUMNS if wide else GRO_COLUMNS)
+        self.index_file_name = '{}.idx'.format(file_name)
+        self.offsets = None
+        self.num_atoms = None
+        if use_cache:
+            self._load_index()
+        if self.offsets is None:
+            self._build_index()
+            if use_cache:
+                self._save_index()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, frame_idx):
+        return self.read_frame(frame_idx)
+
+    def __iter__(self):
+        with open(self.file_name, 'rb') as input_file:
+            for offset, num_atoms in zip(self.offsets.tolist(), self.num_atoms.tolist()):
+                input_file.seek(offset)
+                yield self._read_frame(input_file, num_atoms)
+
+    def read_frame(self, frame_idx):
+        """Reads the frame with given index, negative indexes count from the end."""
+        offset = int(self.offsets[frame_idx])
+        num_atoms = int(self.num_atoms[frame_idx])
+        with open(self.file_name, 'rb') as input_file:
+            input_file.seek(offset)
+            return self._read_frame(input_file, num_atoms)
+
+    def _read_frame(self, input_file, num_atoms):
+        title = input_file.readline().rstrip(b'\r\n').decode()
+        input_file.readline()  # number of atoms
+        lines = [input_file.readline().rstrip(b'\r\n') for _ in range(num_atoms)]
+        columns = self.columns
+        if columns is None:
+            columns = self._position_columns(gro_columns(lines[0]) if lines else GRO_COLUMNS)
+        cols = _fixed_columns(lines, columns)
+        position = numpy.empty((num_atoms, 3))
+        for dim, col_name in enumerate('xyz'):
+            position[:, dim] = cols[col_name].astype(numpy.float64)
+        box = numpy.array(input_file.readline().split(), dtype=numpy.float64)
+        return GROFrame(title, position * self.scale_factor, box * self.scale_factor)
+
+    def _file_stat(self):
+        stat = os.stat(self.file_name)
+        return numpy.array([self.index_version, stat.st_size, int(stat.st_mtime)], dtype=numpy.int64)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_file_name):
+            return
+        try:
+            with open(self.index_file_name, 'rb') as index_file:
+                index = numpy.load(index_file)
+                if not numpy.array_equal(index['stat'], self._file_stat()):
+                    logger.info('Index file %s is out of date', self.index_file_name)
+                    return
+                self.offsets = index['offsets']
+                self.num_atoms = index['num_atoms']
+        except (IOError, ValueError, KeyError):
+            logger.warning('Could not read index file %s', self.index_file_name)
+
+    def _save_index(self):
+        try:
+            with open(self.index_file_name, 'wb') as index_file:
+                numpy.savez(
+                    index_file, stat=self._file_stat(), offsets=self.offsets, num_atoms=self.num_atoms)
+        except IOError:
+            logger.warning('Could not write index file %s', self.index_file_name)
+
+    def _build_index(self):
+        """Scans the file and collects the offsets of frames."""
+        logger.info('Building index of frames of %s', self.file_name)
+        offsets = []
+        atoms = []
+        file_size = os.path.getsize(self.file_name)
+        with open(self.file_name, 'rb') as input_file:
+            offset = 0
+            while offset < file_size:
+                input_file.seek(offset)
+                title = input_file.readline()
+                if not title.strip():
+                    break
+                num_atoms = int(input_file.readline())
+                atom_offset = input_file.tell()
+                first_line = input_file.readline()
+                # Atom lines have usually the same length, try to jump over the atom
+                # section and check that the box line is where we expect it.
+                box_offset = atom_offset + num_atoms * len(first_line)
+                input_file.seek(box_offset - 1)
+                if num_atoms > 0 and input_file.read(1) == b'\n' and self._is_box(input_file.readline()):
+                    next_offset = input_file.tell()
+                else:
+                    input_file.seek(atom_offset)
+                    for _ in range(num_atoms):
+                        input_file.readline()
+                    if not self._is_box(input_file.readline()):
+                        raise ValueError('Wrong format of frame {} in {}'.format(
+                            len(offsets), self.file_name))
+                    next_offset = input_file.tell()
+                offsets.append(offset)
+                atoms.append(num_atoms)
+                offset = next_offset
+        self.offsets = numpy.array(offsets, dtype=numpy.int64)
+        self.num_atoms = numpy.array(atoms, dtype=numpy.int64)
+
+    @staticmethod
+    def _position_columns(columns):
+        return collections.OrderedDict((k, columns[k]) for k in 'xyz')
+
+    @staticmethod
+    def _is_box(line):
+        box = line.split()
+        try:
+            [float(x) for x in box]
+        except ValueError:
+            return False
+        return len(box) in (3, 9)
+
+
+class LammpsDumpTrajectory(object):
+    """Reader of LAMMPS text dump files (dump atom/custom) with the positions of atoms.
+
+    The file is scanned once for the offsets of the frames, the frames are read lazily.
+    The positions are sorted by the atom id, the ids have to be 1..N, and are shifted
+    to the origin of the box, the same as in LammpsReader. The position columns are
+    x y z, xu yu zu or the scaled xs ys zs.
+
+    Args:
+        file_name: The input dump file.
+        scale_factor: The factor by which the positions are multiplied (default: A -> nm).
+    """
+    position_columns = [('x', 'y', 'z'), ('xu', 'yu', 'zu'), ('xs', 'ys', 'zs')]
+
+    def __init__(self, file_name, scale_factor=0.1):
+        self.file_name = file_name
+        self.scale_factor = scale_factor
+        self.offsets = None
+        self._build_index()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, frame_idx):
+        return self.read_frame(frame_idx)
+
+    def __iter__(self):
+        with open(self.file_name, 'rb') as input_file:
+            for offset in self.offsets.tolist():
+                input_file.seek(offset)
+                yield self._read_frame(input_file)
+
+    def read_frame(self, frame_idx):
+        """Reads the frame with given index, negative indexes count from the end."""
+        with open(self.file_name, 'rb') as input_file:
+            input_file.seek(int(self.offsets[frame_idx]))
+            return self._read_frame(input_file)
+
+    def _read_frame(self, input_file):
+        sections = {}
+        while len(sections) < 4:
+            item = input_file.readline().decode().strip()
+            if not item.startswith('ITEM:'):
+                raise ValueError('Wrong format of {}, expected ITEM: got {}'.format(self.file_name, item))
+            item = item[len('ITEM:'):].split()
+            if item[0] == 'TIMESTEP':
+                sections['timestep'] = int(input_file.readline())
+            elif item[0] == 'NUMBER':
+                sections['num_atoms'] = int(input_file.readline())
+            elif item[0] == 'BOX':
+                sections['bounds'] = numpy.array(
+                    [input_file.readline().split()[:2] for _ in range(3)], dtype=numpy.float64)
+            elif item[0] == 'ATOMS':
+                sections['columns'] = item[1:]
+                sections['data'] = numpy.loadtxt(
+                    [input_file.readline().decode() for _ in range(sections['num_atoms'])], ndmin=2)
+        columns = sections['columns']
+        data = sections['data']
+        ids = data[:, columns.index('id')].astype(numpy.int64)
+        order = numpy.argsort(ids)
+        if not numpy.array_equal(ids[order], numpy.arange(1, len(ids) + 1)):
+            raise ValueError('Atom ids of timestep {} in {} are not 1..N'.format(
+                sections['timestep'], self.file_name))
+        lo = sections['bounds'][:, 0]
+        box = sections['bounds'][:, 1] - lo
+        for position_columns in self.position_columns:
+            if set(position_columns).issubset(columns):
+                position = data[order][:, [columns.index(x) for x in position_columns]]
+                break
+        else:
+            raise ValueError('No position columns in {}'.format(self.file_name))
+        if position_columns[0] == 'xs':
+            position = position * box
+        else:
+            position = position - lo
+        return GROFrame('Timestep {}'.format(sections['timestep']),
+                        position * self.scale_factor, box * self.scale_factor)
+
+    def _build_index(self):
+        """Scans the file and collects the offsets of frames."""
+        logger.info('Building index of frames of %s', self.file_name)
+        offsets = []
+        offset = 0
+        with open(self.file_name, 'rb') as input_file:
+            for line in input_file:
+                if line.startswith(b'ITEM: TIMESTEP'):
+                    offsets.append(offset)
+                offset += len(line)
+        self.offsets = numpy.array(offsets, dtype=numpy.int64)
+
+
+def read_trajectory(file_name):
+    """Returns the reader of the multi-frame .gro or LAMMPS dump (.dump, .lammpstrj) file."""
+    if file_name.split('.')[-1] == 'gro':
+        return GROTrajectory(file_name)
+    return LammpsDumpTrajectory(file_name)
+
+
 class PDBFile(CoordinateFile):
     scale_factor = 0.1  # PDB is expressed in Angstrome and the program use nm
 
-    def read(self):
-        """Reads the file and return atom list."""
+    def read(self, cached=True):
+        """Reads the file and return atom list.
+
+        Args:
+          cached: If False, the file is not stored in the parse_cache.
+        """
 
         self.file = open(self.file_name, 'r')
 
         if not self.content:
             self.content = self.file.readlines()
 
+        cached_read(self, self._parse, (self.scale_factor,), cached)
+
+    def _parse(self):
+        """Parses the content of the .pdb file."""
         logger.info('Reading PDB file %s', self.file_name)
 
+        atom_lines = []
         for line in self.content:
             if line.startswith('CRYST1'):
                 # Box size
                 self.box = numpy.array(
-                    map(float, filter(None, line.split(' '))[1:4])
-                    ) * self.scale_factor
+                    line.split()[1:4], dtype=numpy.float64) * self.scale_factor
             elif line.startswith('ATOM') or line.startswith('HETATM'):
-                atom_id = int(line[6:11].strip())
-                atom_name = line[12:16].strip()
-                chain_name = line[17:20].strip()  # Residue name
-                chain_idx = line[22:26].strip()
-                pos_x = float(line[30:38]) * self.scale_factor
-                pos_y = float(line[38:46]) * self.scale_factor
-                pos_z = float(line[46:54]) * self.scale_factor
-                self.atoms[atom_id] = (
-                    Atom(
-                        atom_id=atom_id,
-                        name=atom_name,
-                        chain_name=chain_name,
-                        chain_idx=chain_idx,
-                        position=numpy.array([pos_x, pos_y, pos_z])
-                        ))
-                self.fragments[chain_name][atom_name] = self.atoms[atom_id]
+                atom_lines.append(line.rstrip('\r\n'))
+
+        cols = _fixed_columns(atom_lines, PDB_COLUMNS)
+        atom_ids = cols['atom_id'].astype(numpy.int64)
+        # The last definition of the atom id wins.
+        _, last_rows = numpy.unique(atom_ids[::-1], return_index=True)
+        rows = numpy.sort(len(atom_ids) - 1 - last_rows)
+        position = numpy.empty((len(rows), 3))
+        for dim, col_name in enumerate('xyz'):
+            position[:, dim] = cols[col_name][rows].astype(numpy.float64)
+        self.atoms = AtomStore.from_block(AtomBlock(
+            atom_id=atom_ids[rows],
+            name=numpy.char.strip(cols['name'][rows]).astype(str),
+            chain_name=numpy.char.strip(cols['chain_name'][rows]).astype(str),  # Residue name
+            chain_idx=cols['chain_idx'][rows].astype(numpy.int64),
+            position=position * self.scale_factor))
 
         if len([x for x in self.box if x == self.box[0]]) != 3:
             raise ValueError('The box size in all direction should be the same')
@@ -417,51 +1853,47 @@ class PDBFile(CoordinateFile):
     def write(self, file_name=None, force=False):
         """Write the file again."""
         if self.atoms_updated or force:
-            output = []
-            output.append('REMARK generate by YAPT')
-            output.append('MODEL 1')
-            # Writing the box coordinates
-            # Following http://deposit.rcsb.org/adit/docs/pdb_atom_format.html#ATOM
-            # Boxes are orthorhombic for now
-            output.append('%-6s%9.3f%9.3f%9.3f%7.2f%7.2f%7.2f %-11s%4d\n' % (
-                'CRYST1',
-                self.box[0] / self.scale_factor,
-                self.box[1] / self.scale_factor,
-                self.box[2] / self.scale_factor,
-                90.00,
-                90.00,
-                90,
-                'P 1',
-                1
-                ))
-
-            # Puts the number of atoms
-            output.append('%d' % len(self.atoms))
-            # Puts the definition of the atoms, fixed format.
-            fmt = '%-6s%5d %4s %-3s  %4d    %8.3f%8.3f%8.3f                      %2s'
-            for at_id in sorted(self.atoms):
-                at = self.atoms[at_id]
-                output.append(fmt % (
-                    'ATOM  ',
-                    int(at.atom_id) % 100000,
-                    at.name,
-                    at.chain_name,
-                    int(at.chain_idx) % 10000,
-                    at.position[0] / self.scale_factor,
-                    at.position[1] / self.scale_factor,
-                    at.position[2] / self.scale_factor,
-                    at.name
-                    ))
-
-            output.append('TER')
-            output.append('ENDMDL')
-            output.append('\n')
-
             write_file_path = prepare_path(file_name if file_name else self.file_name)
             logger.info('Writing PDB file %s', write_file_path)
-            output_file = open(write_file_path, 'w')
-            output_file.writelines('\n'.join(output))
-            output_file.close()
+            with open(write_file_path, 'w') as output_file:
+                output_file.write('REMARK generate by YAPT\n')
+                output_file.write('MODEL 1\n')
+                # Writing the box coordinates
+                # Following http://deposit.rcsb.org/adit/docs/pdb_atom_format.html#ATOM
+                # Boxes are orthorhombic for now
+                output_file.write('%-6s%9.3f%9.3f%9.3f%7.2f%7.2f%7.2f %-11s%4d\n\n' % (
+                    'CRYST1',
+                    self.box[0] / self.scale_factor,
+                    self.box[1] / self.scale_factor,
+                    self.box[2] / self.scale_factor,
+                    90.00,
+                    90.00,
+                    90,
+                    'P 1',
+                    1
+                    ))
+
+                # Puts the number of atoms
+                output_file.write('%d\n' % len(self.atoms))
+                # Puts the definition of the atoms, fixed format.
+                fmt = '%-6s%5d %4s %-3s  %4d    %8.3f%8.3f%8.3f                      %2s'
+                at = self.atoms.columns(numpy.sort(self.atoms.keys_array()))
+                position = at.position / self.scale_factor
+                for chunk in format_rows(fmt, [
+                        ['ATOM  '] * len(at.atom_id),
+                        (at.atom_id % 100000).tolist(),
+                        at.name,
+                        at.chain_name,
+                        (at.chain_idx % 10000).tolist(),
+                        position[:, 0].tolist(),
+                        position[:, 1].tolist(),
+                        position[:, 2].tolist(),
+                        at.name]):
+                    output_file.write(chunk)
+
+                output_file.write('TER\n')
+                output_file.write('ENDMDL\n')
+                output_file.write('\n')
             self.atoms_updated = False
 
 
@@ -504,14 +1936,10 @@ class GROMACSTopologyFile(TopologyFile):
             'angles': self._write_angles,
             'dihedrals': self._write_dihedrals,
             'pairs': self._write_pairs,
-            'cross_bonds': lambda: self._write_default(
-                [self.new_data.get('cross_bonds'), self.cross_bonds]),
-            'cross_angles': lambda: self._write_default(
-                [self.new_data.get('cross_angles'), self.cross_angles]),
-            'cross_dihedrals': lambda: self._write_default(
-                [self.new_data.get('cross_dihedrals'), self.cross_dihedrals]),
-            'cross_pairs': lambda: self._write_default(
-                [self.new_data.get('cross_pairs'), self.cross_pairs])
+            'cross_bonds': lambda: self._write_terms('cross_bonds'),
+            'cross_angles': lambda: self._write_terms('cross_angles'),
+            'cross_dihedrals': lambda: self._write_terms('cross_dihedrals'),
+            'cross_pairs': lambda: self._write_terms('cross_pairs')
             }
         self.current_charges = {}
         self.atomtypes = {}
@@ -529,13 +1957,13 @@ class GROMACSTopologyFile(TopologyFile):
     def init(self):
         """Reset the class properties without creating the object again."""
         logger.info('Init of topology file.')
-        self.new_data = {
+        self.new_data = TermSections({
             'bonds': {},
             'angles': {},
             'dihedrals': {},
             'improper_dihedrals': {},
             'pairs': {}
-            }
+            }, self.param_table)
         if '__state' in self.__dict__:
             del self.__dict__['__state']
         self.current_charges = {}
@@ -543,7 +1971,7 @@ class GROMACSTopologyFile(TopologyFile):
 
     def get_graph(self):
         """Returns graph."""
-        output_graph = networkx.Graph(box=None)
+        output_graph = graph.Graph(box=None)
         for at_id, g_at in self.atoms.iteritems():
             output_graph.add_node(
                 at_id,
@@ -604,8 +2032,17 @@ class GROMACSTopologyFile(TopologyFile):
         for k, v in pdbfile.atoms.iteritems():
             self.atoms[k].position = v.position
 
+    def bonded_sections(self):
+        """Returns the list of all BondedTerms of the topology, including new_data."""
+        return [getattr(self, name) for name in TERM_SECTIONS] + list(self.new_data.values())
+
     def remove_atoms(self, atom_ids, renumber=True):
-        """Removes atom from topology and clean data structures."""
+        """Removes atom from topology and clean data structures.
+
+        Args:
+            atom_ids: The ids of atoms to remove.
+            renumber: Renumber the remaining atoms from 1, also in the bonded terms.
+        """
         for atom_id in atom_ids:
             atom_to_remove = self.atoms[atom_id]
             try:
@@ -615,77 +2052,48 @@ class GROMACSTopologyFile(TopologyFile):
                 pass
             del self.atoms[atom_id]
 
-        # Renumber data.
+        # Clean bonded structures, all sections with the same map.
         if renumber:
-            new_at_id = 1
-            old2new = {}
-            new_atoms = {}
-            for at_id in sorted(self.atoms):
-                new_atoms[new_at_id] = self.atoms[at_id]
-                new_atoms[new_at_id].atom_id = new_at_id
-                old2new[at_id] = new_at_id
-                new_at_id += 1
-            self.atoms = new_atoms
-
-        # Clean bonded structures.
-        self.bonds = {k: v for k, v in self.bonds.items() if not atom_ids.intersection(k)}
-        self.angles = {k: v for k, v in self.angles.items() if not atom_ids.intersection(k)}
-        self.dihedrals = {k: v for k, v in self.dihedrals.items() if not atom_ids.intersection(k)}
-        self.pairs = {k: v for k, v in self.pairs.items() if not atom_ids.intersection(k)}
-        self.cross_bonds = {k: v for k, v in self.cross_bonds.items() if not atom_ids.intersection(k)}
-        self.cross_angles = {k: v for k, v in self.cross_angles.items() if not atom_ids.intersection(k)}
-        self.cross_dihedrals = {k: v for k, v in self.cross_dihedrals.items() if not atom_ids.intersection(k)}
-        self.cross_pairs = {k: v for k, v in self.cross_pairs.items() if not atom_ids.intersection(k)}
-        self.improper_dihedrals = {k: v for k, v in self.improper_dihedrals.items() if not atom_ids.intersection(k)}
-
-        # And new_data
-        for k in self.new_data:
-            self.new_data[k] = {p: v for p, v in self.new_data[k].items() if not atom_ids.intersection(p)}
-
-
-    def renumber(self):
-        """Renumber topology"""
-        # Clean bonded structures.
-        old2new = {}
-        new_at_id = 1
+            old2new = self._renumber_atoms()
+        else:
+            old2new = build_old2new(
+                [max([0] + [terms.max_id() for terms in self.bonded_sections()])], atom_ids, renumber=False)
+        for terms in self.bonded_sections():
+            terms.remap(old2new)
+
+    def _renumber_atoms(self):
+        """Renumbers atoms from 1 in the order of their ids, returns the old2new array."""
+        old2new = build_old2new(self.atoms)
         new_atoms = {}
         for at_id in sorted(self.atoms):
+            new_at_id = int(old2new[at_id])
             new_atoms[new_at_id] = self.atoms[at_id]
             new_atoms[new_at_id].atom_id = new_at_id
-            old2new[at_id] = new_at_id
-            new_at_id += 1
         self.atoms = new_atoms
+        return old2new
 
-        self.bonds = {tuple(map(old2new.get, k)): v
-                      for k, v in self.bonds.items()}
-        self.angles = {tuple(map(old2new.get, k)): v
-                       for k, v in self.angles.items()}
-        self.dihedrals = {tuple(map(old2new.get, k)): v
-                          for k, v in self.dihedrals.items()}
-        self.pairs = {tuple(map(old2new.get, k)): v
-                      for k, v in self.pairs.items()}
-        self.cross_bonds = {tuple(map(old2new.get, k)): v
-                            for k, v in self.cross_bonds.items()}
-        self.cross_angles = {tuple(map(old2new.get, k)): v
-                             for k, v in self.cross_angles.items()}
-        self.cross_dihedrals = {tuple(map(old2new.get, k)): v
-                                for k, v in self.cross_dihedrals.items()}
-        self.cross_pairs = {tuple(map(old2new.get, k)): v
-                            for k, v in self.cross_pairs.items()}
-        self.improper_dihedrals = {tuple(map(old2new.get, k)): v
-                                   for k, v in self.improper_dihedrals.items()}
-
-        # And new_data
-        for k in self.new_data:
-            self.new_data[k] = {tuple(map(old2new.get, p)): v for p, v in self.new_data[k].items()}
-
-    def read(self):
-        """Reads the topology file."""
+    def renumber(self):
+        """Renumber topology, the bonded terms with atoms missing in the topology are removed."""
+        old2new = self._renumber_atoms()
+        for terms in self.bonded_sections():
+            terms.remap(old2new)
+
+    def read(self, cached=True):
+        """Reads the topology file.
+
+        Args:
+          cached: If False, the file is not stored in the parse_cache, for the files written
+            by bakery itself, e.g. the hybrid topology.
+        """
 
         if not self.content:
             self.file = open(self.file_name, 'r')
             self.content = self.file.readlines()
 
+        cached_read(self, self._parse, cached=cached)
+
+    def _parse(self):
+        """Parses the content of the topology file."""
         logger.info('Reading top file %s', self.file_name)
 
         # New version
@@ -717,56 +2125,65 @@ class GROMACSTopologyFile(TopologyFile):
                     if raw_data:
                         current_parser(raw_data)  # pylint:disable=E1102
 
-    def write(self, filename=None):
+    def _default_content(self):
+        """Returns the lines with the headers of the sections written when no file was read."""
+        sections = []
+        if self.defaults:
+            sections.append('defaults')
+        if self.atomtypes:
+            sections.append('atomtypes')
+        if self.bondtypes:
+            sections.append('bondtypes')
+        if self.angletypes:
+            sections.append('angletypes')
+        if self.dihedraltypes:
+            sections.append('dihedraltypes')
+        sections.extend([
+            'moleculetype',
+            'atoms'])
+        section_list = ['bonds', 'angles', 'pairs', 'cross_bonds',
+                        'cross_angles', 'cross_dihedrals', 'cross_pairs']
+        for s in section_list:
+            if getattr(self, s) or self.new_data.get(s):
+                sections.append(s)
+        if (self.dihedrals or self.new_data['dihedrals'] or
+                self.improper_dihedrals or self.new_data['improper_dihedrals']):
+            sections.append('dihedrals')
+
+        sections.extend([
+            'system',
+            'molecules'])
+        content = []
+        for s in sections:
+            content.append('[ %s ]\n' % s)
+            content.append('\n')
+        return content
+
+    def write(self, filename=None, others=()):
         """Updates the topology file.
 
         Args:
           filename: The optional output filename.
+          others: The list of (topology, filename) written in the same walk over the sections,
+            the topologies share the content of this one, e.g. the atomistic topology from
+            tools.get_atomistic_topology.
         """
         if filename is None:
             filename = self.file_name
-        output_file = open(prepare_path(filename), 'w')
-
-        new_data = []
-        current_section = None
-        previous_section = None
-        skip_lines = False
-        section_writer = None
 
         if self.content is None:
-            sections = []
-            if self.defaults:
-                sections.append('defaults')
-            if self.atomtypes:
-                sections.append('atomtypes')
-            if self.bondtypes:
-                sections.append('bondtypes')
-            if self.angletypes:
-                sections.append('angletypes')
-            if self.dihedraltypes:
-                sections.append('dihedraltypes')
-            sections.extend([
-                'moleculetype',
-                'atoms'])
-            section_list = ['bonds', 'angles', 'pairs', 'cross_bonds',
-                            'cross_angles', 'cross_dihedrals', 'cross_pairs']
-            for s in section_list:
-                if getattr(self, s) or self.new_data.get(s):
-                    sections.append(s)
-            if (self.dihedrals or self.new_data['dihedrals'] or
-                    self.improper_dihedrals or self.new_data['improper_dihedrals']):
-                sections.append('dihedrals')
-
-            sections.extend([
-                'system',
-                'molecules'])
-            self.content = []
-            for s in sections:
-                self.content.append('[ %s ]\n' % s)
-                self.content.append('\n')
-
-        new_data.extend(self.header_section)
+            self.content = self._default_content()
 
+        outputs = []
+        for topology, output_filename in [(self, filename)] + list(others):
+            logger.info('Writing topology file %s...', output_filename)
+            output_file = open(prepare_path(output_filename), 'w')
+            output_file.writelines(topology.header_section)
+            # The output state: [topology, file name, file, section writer, skip lines].
+            outputs.append([topology, output_filename, output_file, None, False])
+
+        current_section = None
+        previous_section = None
         for line in self.content:
             tmp_line = line.strip()
             if tmp_line.startswith('['):  # section part
@@ -774,34 +2191,84 @@ class GROMACSTopologyFile(TopologyFile):
                 current_section = tmp_line.replace('[', '').replace(']', '').strip()
                 if previous_section == 'dihedrals' and current_section == 'dihedrals':
                     current_section = 'improper_dihedrals'
-                section_writer = self.writers.get(current_section)
-                if current_section.startswith('cross') and self.skip_cross:
-                    skip_lines = True
-                    continue
-                new_data.append(line)
-                print('{}: Writing section {}'.format(filename, current_section))
-                skip_lines = False
+                for output in outputs:
+                    topology, output_filename, output_file = output[:3]
+                    output[3] = topology.writers.get(current_section)
+                    if current_section.startswith('cross') and topology.skip_cross:
+                        output[4] = True
+                        continue
+                    output_file.write(line)
+                    print('{}: Writing section {}'.format(output_filename, current_section))
+                    output[4] = False
             elif tmp_line.startswith(';') or tmp_line.startswith('#'):
-                new_data.append(line)
+                for output in outputs:
+                    output[2].write(line)
             else:
-                if section_writer is None:  # there is no special writer, simply copy the line
-                    new_data.append(line)
-                elif not skip_lines:
-                    output_writer = section_writer()
-                    if output_writer:
-                        new_data.extend(['%s\n' % x for x in output_writer])
-                    new_data.extend(['\n'])
-                    skip_lines = True
-
-        logger.info('Writing topology file %s...', filename)
-        output_file.writelines(new_data)
-        output_file.close()
-        self.atoms_updated = False
+                for output in outputs:
+                    output_file, section_writer, skip_lines = output[2:]
+                    if section_writer is None:  # there is no special writer, simply copy the line
+                        output_file.write(line)
+                    elif not skip_lines:
+                        # The writers return iterables of lines, the long sections come in chunks
+                        # of lines joined together.
+                        output_writer = section_writer()
+                        if output_writer:
+                            for x in output_writer:
+                                output_file.write('%s\n' % x)
+                        output_file.write('\n')
+                        output[4] = True
+
+        for output in outputs:
+            output[2].close()
+            output[0].atoms_updated = False
+
+    def written_sections(self):
+        """Returns the names of sections with the content written by write(), in the order of writing.
+
+        Only the first section of a name is listed, the cross sections are skipped with skip_cross.
+        """
+        if self.content is None:
+            self.content = self._default_content()
+        sections = []
+        current_section = None
+        previous_section = None
+        skip_lines = True
+        for line in self.content:
+            tmp_line = line.strip()
+            if tmp_line.startswith('['):
+                previous_section = current_section
+                current_section = tmp_line.replace('[', '').replace(']', '').strip()
+                if previous_section == 'dihedrals' and current_section == 'dihedrals':
+                    current_section = 'improper_dihedrals'
+                skip_lines = current_section.startswith('cross') and self.skip_cross
+            elif not (skip_lines or tmp_line.startswith(';') or tmp_line.startswith('#')):
+                if current_section not in sections:
+                    sections.append(current_section)
+                skip_lines = True
+        return sections
+
+    def written_terms(self, section_name):
+        """Returns the BondedTerms with the terms of the section and of its new data, in the order of write().
+
+        The blocks of terms are added in the order of writing. A term written twice keeps
+        the place of the first and takes the parameters of the last, as in the topology
+        read from the written file. The missing new data of a section adds no terms. The
+        terms share the ParamTable of this topology.
+        """
+        terms = BondedTerms(param_table=self.param_table)
+        for datas, check_in in self._term_blocks(section_name):
+            datas = [data for data in datas if data is not None]
+            if not datas:
+                continue
+            sorted_terms = self._sorted_terms(datas, check_in)
+            if sorted_terms is not None:
+                terms.add_coded(*sorted_terms)
+        return terms
 
     # Parsers for the data.
     def _parse_bonds(self, raw_data):
         atom_tuple = tuple(map(int, raw_data[0:2]))
-        self.bonds[atom_tuple] = raw_data[2:]
+        self.bonds.append(atom_tuple, raw_data[2:])
 
         self.bonds_def[atom_tuple[0]].add(atom_tuple[1])
         self.bonds_def[atom_tuple[1]].add(atom_tuple[0])
@@ -892,35 +2359,35 @@ class GROMACSTopologyFile(TopologyFile):
 
     def _parse_angles(self, raw_data):
         atom_tuple = tuple(map(int, raw_data[0:3]))
-        self.angles[atom_tuple] = raw_data[3:]
+        self.angles.append(atom_tuple, raw_data[3:])
 
     def _parse_dihedrals(self, raw_data):
         atom_tuple = tuple(map(int, raw_data[0:4]))
-        self.dihedrals[atom_tuple] = raw_data[4:]
+        self.dihedrals.append(atom_tuple, raw_data[4:])
 
     def _parse_improper_dihedrals(self, raw_data):
         atom_tuple = tuple(map(int, raw_data[0:4]))
-        self.improper_dihedrals[atom_tuple] = raw_data[4:]
+        self.improper_dihedrals.append(atom_tuple, raw_data[4:])
 
     def _parse_pairs(self, raw_data):
         atom_tuple = tuple(map(int, raw_data[0:2]))
-        self.pairs[atom_tuple] = raw_data[2:]
+        self.pairs.append(atom_tuple, raw_data[2:])
 
     def _parse_cross_bonds(self, raw_data):
         atom_tuple = tuple(map(int, raw_data[0:2]))
-        self.cross_bonds[atom_tuple] = raw_data[2:]
+        self.cross_bonds.append(atom_tuple, raw_data[2:])
 
     def _parse_cross_angles(self, raw_data):
         atom_tuple = tuple(map(int, raw_data[0:3]))
-        self.cross_angles[atom_tuple] = raw_data[3:]
+        self.cross_angles.append(atom_tuple, raw_data[3:])
 
     def _parse_cross_dihedrals(self, raw_data):
         atom_tuple = tuple(map(int, raw_data[0:4]))
-        self.cross_dihedrals[atom_tuple] = raw_data[4:]
+        self.cross_dihedrals.append(atom_tuple, raw_data[4:])
 
     def _parse_cross_pairs(self, raw_data):
         atom_tuple = tuple(map(int, raw_data[0:2]))
-        self.cross_pairs[atom_tuple] = raw_data[2:]
+        self.cross_pairs.append(atom_tuple, raw_data[2:])
 
     def _parse_moleculetype(self, raw_data):
         self.moleculetype['name'] = raw_data[0]
@@ -935,20 +2402,18 @@ class GROMACSTopologyFile(TopologyFile):
 
     # Writers
     def _write_atoms(self):
-        return_data = []
         for atom_id in sorted(self.atoms):
             x = self.atoms[atom_id]
-            return_data.append('%s %s %s %s %s %s %s %s' % (
-                               x.atom_id,
-                               x.atom_type,
-                               x.chain_idx,
-                               x.chain_name,
-                               x.name,
-                               x.cgnr,
-                               x.charge if x.charge is not None else '0.0',
-                               x.mass if x.mass is not None else ''
-                               ))
-        return return_data
+            yield '%s %s %s %s %s %s %s %s' % (
+                x.atom_id,
+                x.atom_type,
+                x.chain_idx,
+                x.chain_name,
+                x.name,
+                x.cgnr,
+                x.charge if x.charge is not None else '0.0',
+                x.mass if x.mass is not None else ''
+                )
 
     def _write_atomtypes(self):
         return_data = []
@@ -984,42 +2449,36 @@ class GROMACSTopologyFile(TopologyFile):
         return return_data
 
     def _write_bonds(self):  # pylint:disable=R0201
-        return_data = []
-        return_data.extend(self._write_default(self.bonds))
-        return_data.extend(self._write_default(self.new_data['bonds'], self.bonds))
-        return return_data
+        return self._write_terms('bonds')
 
     def _write_pairs(self):  # pylint:disable=R0201
-        return_data = []
-        return_data.extend(self._write_default(self.pairs))
-        return_data.extend(
-            self._write_default(self.new_data['pairs'], self.pairs)
-            )
-        return return_data
+        return self._write_terms('pairs')
 
     def _write_angles(self):
-        return_data = []
-        return_data.extend(self._write_default(self.angles))
-        return_data.extend(
-            self._write_default(self.new_data['angles'], self.angles)
-            )
-        return return_data
+        return self._write_terms('angles')
 
     def _write_dihedrals(self):
-        return_data = []
-        return_data.extend(self._write_default(self.dihedrals))
-        return_data.extend(
-            self._write_default(self.new_data['dihedrals'], self.dihedrals)
-            )
-        return return_data
+        return self._write_terms('dihedrals')
 
     def _write_improper_dihedrals(self):
-        return_data = []
-        return_data.extend(self._write_default(self.improper_dihedrals))
-        return_data.extend(
-            self._write_default(self.new_data['improper_dihedrals'], self.improper_dihedrals)
-            )
-        return return_data
+        return self._write_terms('improper_dihedrals')
+
+    def _term_blocks(self, section_name):
+        """Returns the list of (datas, check_in) of the blocks of terms written in the section.
+
+        The cross sections are written from new_data and the section together, the other
+        sections first from the section and then from new_data.
+        """
+        terms = getattr(self, section_name)
+        if section_name.startswith('cross'):
+            return [([self.new_data.get(section_name), terms], None)]
+        return [([terms], None), ([self.new_data[section_name]], terms)]
+
+    def _write_terms(self, section_name):
+        blocks = [self._write_default(datas, check_in) for datas, check_in in self._term_blocks(section_name)]
+        if any(block is False for block in blocks):
+            return False
+        return itertools.chain(*blocks)
 
     def _write_defaults(self):
         if self.defaults:
@@ -1050,14 +2509,67 @@ class GROMACSTopologyFile(TopologyFile):
         if None in datas:
             return False
 
-        flat_data = []
+        return self._format_terms(datas, check_in)
+
+    def _terms(self, data):
+        """Returns the data as BondedTerms that share the ParamTable of this topology."""
+        if isinstance(data, BondedTerms) and data.param_table is self.param_table:
+            return data
+        return BondedTerms.from_mapping(data, self.param_table)
+
+    def _sorted_terms(self, datas, check_in):
+        """Returns the atom ids and parameter ids of the terms, sorted by atom ids and then by parameters.
+
+        A term is skipped if the term and its reverse are both in check_in and the reverse
+        is also in the same data. Returns None if no term is left.
+        """
+        ids, params = [], []
+        check_in = self._terms(check_in) if check_in else None
         for data in datas:
-            for key, values in data.iteritems():
-                rev_key = tuple(reversed(key))
-                if tuple(key) not in check_in or rev_key not in check_in or rev_key not in data:
-                    flat_data.append(list(key) + list(values))
-        flat_data.sort()
-        return ['%s' % ' '.join(map(str, x)) for x in flat_data]
+            data = self._terms(data)
+            data_ids, data_params = data.arrays()
+            if check_in is not None and len(data_ids):
+                rev_ids = data_ids[:, ::-1]
+                skip = (check_in.contains_many(data_ids) & check_in.contains_many(rev_ids) &
+                        data.contains_many(rev_ids))
+                data_ids, data_params = data_ids[~skip], data_params[~skip]
+            if len(data_ids):
+                ids.append(data_ids)
+                params.append(data_params)
+        if not ids:
+            return None
+        ids = numpy.concatenate(ids)
+        params = numpy.concatenate(params)
+        arity = ids.shape[1]
+
+        # The terms with the same atoms are ordered by their parameter lists.
+        values = self.param_table.values
+        used_params = numpy.unique(params)
+        param_rank = numpy.zeros(len(values), dtype=numpy.int64)
+        param_rank[sorted(used_params.tolist(), key=lambda x: list(values[x]))] = numpy.arange(len(used_params))
+        order = numpy.lexsort([param_rank[params]] + [ids[:, col] for col in reversed(range(arity))])
+        return ids[order], params[order]
+
+    def _format_terms(self, datas, check_in, chunk_size=100000):
+        """Generates the lines of bonded terms in the order of _sorted_terms.
+
+        Every item is a chunk of up to chunk_size lines.
+        """
+        terms = self._sorted_terms(datas, check_in)
+        if terms is None:
+            return
+        ids, params = terms
+        arity = ids.shape[1]
+        values = self.param_table.values
+        suffix = numpy.empty(len(values), dtype=object)
+        for param_id in numpy.unique(params).tolist():
+            suffix[param_id] = ' {}'.format(' '.join(map(str, values[param_id]))) if values[param_id] else ''
+        fmt = ' '.join(['%d'] * arity) + '%s'
+        for start in range(0, len(ids), chunk_size):
+            chunk_ids = ids[start:start + chunk_size]
+            for chunk in format_rows(fmt, [chunk_ids[:, col].tolist() for col in range(arity)] +
+                                     [suffix[params[start:start + chunk_size]]], chunk_size):
+                yield chunk[:-1]
 
 
 class LammpsReader(object):
@@ -1195,13 +2707,13 @@ class LammpsReader(object):
                     self.current_section = None
 
     def get_graph(self, settings):
-        """Creates networkx.Graph object from coordinate and topology data.
+        """Creates graph.Graph object from coordinate and topology data.
 
         Args:
             settings: The settings object.
 
         Returns:
-            networkx.Graph object. Each of node has attributes:
+            graph.Graph object. Each of node has attributes:
                 - name: The name of atom.
                 - res_id: The id of molecule.
                 - chain_name: The name of molecule.
@@ -1213,7 +2725,7 @@ class LammpsReader(object):
         """
         type2chain_name = settings.type2chain
         name_seq = settings.name_seq
-        output_graph = networkx.Graph(box=(self.box['x'], self.box['y'], self.box['z']))
+        output_graph = graph.Graph(box=(self.box['x'], self.box['y'], self.box['z']))
         seq_idx = {k: 0 for k in name_seq}
         for at_id, lmp_at in self.atoms.iteritems():
             chain_name = type2chain_name[lmp_at['atom_type']]
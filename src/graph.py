@@ -0,0 +1,353 @@
+"""
+Copyright (C) 2017 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is distributed under free software licence:
+you can redistribute it and/or modify it under the terms of the
+GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import array
+import collections
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+import networkx
+
+__doc__ = 'Array-based graph with the subset of the networkx interface used by the backmapper.'
+
+
+class _Missing(object):
+    """The marker of the missing value in the attribute columns, a singleton also after pickling."""
+
+    def __reduce__(self):
+        return '_MISSING'
+
+
+_MISSING = _Missing()
+
+# The initial number of neighbour slots of a node.
+_INITIAL_CAPACITY = 4
+_EMPTY_BLOCK = array.array('l', [0] * _INITIAL_CAPACITY)
+
+
+class NodeAttributes(MutableMapping):
+    """The dictionary view of the attributes of a single node, kept in the columns of the graph."""
+
+    __slots__ = ('_graph', '_row')
+
+    def __init__(self, graph, row):
+        self._graph = graph
+        self._row = row
+
+    def __getitem__(self, key):
+        column = self._graph._columns.get(key)
+        value = _MISSING if column is None else column[self._row]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        column = self._graph._columns.get(key)
+        if column is None:
+            column = self._graph._columns[key] = [_MISSING] * len(self._graph._ids)
+        column[self._row] = value
+
+    def __delitem__(self, key):
+        self[key]  # Raises KeyError on missing attribute.
+        self._graph._columns[key][self._row] = _MISSING
+
+    def __iter__(self):
+        for key, column in self._graph._columns.items():
+            if column[self._row] is not _MISSING:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class NodeView(object):
+    """Maps the nodes to their attributes, like networkx Graph.node."""
+
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, node):
+        return NodeAttributes(self._graph, self._graph._index[node])
+
+    def get(self, node, default=None):
+        row = self._graph._index.get(node)
+        if row is None:
+            return default
+        return NodeAttributes(self._graph, row)
+
+    def __contains__(self, node):
+        return node in self._graph._index
+
+    def __iter__(self):
+        return iter(self._graph.nodes())
+
+    def __len__(self):
+        return len(self._graph._index)
+
+
+class Graph(object):
+    """Undirected graph with the adjacency in growable CSR arrays and node attributes in columns.
+
+    Every node has a row. The neighbours of the row are stored in a block of the flat
+    array of rows; a full block is moved to the end of the array with the doubled
+    capacity, the array is compacted when the half of it is unused. The attributes
+    of nodes are kept in one list per attribute name, indexed by the row.
+
+    The nodes and the neighbours are kept in the order of insertion. They are iterated in
+    the order of the keys of a dict filled in this order, as the dicts of networkx.Graph
+    (or networkx.MultiGraph), so the iteration over the nodes, neighbours and edges follows
+    networkx also on Python 2, where the order of a dict is not the order of insertion.
+    The order is the one of networkx for the graphs without removed nodes.
+
+    Args:
+        multigraph: If True, the parallel edges are kept and counted in the degree.
+        attr: The attributes of the graph, in the `graph` dictionary.
+    """
+    def __init__(self, multigraph=False, **attr):
+        self.graph = dict(attr)
+        self.multigraph = multigraph
+        self._index = {}  # node -> row
+        self._ids = []  # row -> node, None for removed nodes.
+        self._columns = collections.OrderedDict()  # attribute name -> list of values of rows
+        self._start = array.array('l')
+        self._length = array.array('l')
+        self._capacity = array.array('l')
+        self._neighbours = array.array('l')
+        self._unused = 0  # The number of unused slots in _neighbours.
+        self._self_loops = {}  # row -> number of self-loops
+        self._edge_data = {}  # (row, row) -> dict, only for edges with attributes.
+        self._num_edges = 0
+        self.node = NodeView(self)
+
+    def is_multigraph(self):
+        return self.multigraph
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, node):
+        return node in self._index
+
+    def __iter__(self):
+        return iter(self.nodes())
+
+    def __getitem__(self, node):
+        """Returns the list of neighbours of the node."""
+        return self.neighbors(node)
+
+    def number_of_nodes(self):
+        return len(self._index)
+
+    def number_of_edges(self):
+        return self._num_edges
+
+    def has_node(self, node):
+        return node in self._index
+
+    def _rows(self, row):
+        start = self._start[row]
+        return self._neighbours[start:start + self._length[row]]
+
+    def has_edge(self, u, v):
+        row_u = self._index.get(u)
+        row_v = self._index.get(v)
+        if row_u is None or row_v is None:
+            return False
+        return row_v in self._rows(row_u)
+
+    def add_node(self, node, **attr):
+        row = self._index.get(node)
+        if row is None:
+            row = len(self._ids)
+            self._index[node] = row
+            for column in self._columns.values():
+                column.append(_MISSING)
+            self._ids.append(node)
+            self._start.append(0)
+            self._length.append(0)
+            self._capacity.append(0)
+        for key, value in attr.items():
+            column = self._columns.get(key)
+            if column is None:
+                column = self._columns[key] = [_MISSING] * len(self._ids)
+            column[row] = value
+        return row
+
+    def add_nodes_from(self, nodes, **attr):
+        for node in nodes:
+            self.add_node(node, **attr)
+
+    def _append_neighbour(self, row, neighbour_row):
+        length = self._length[row]
+        if length == self._capacity[row]:
+            start = len(self._neighbours)
+            if length:
+                self._neighbours.extend(self._rows(row))
+                self._neighbours.extend(array.array('l', [0]) * length)
+                self._unused += length
+                self._capacity[row] = 2 * length
+            else:
+                self._neighbours.extend(_EMPTY_BLOCK)
+                self._capacity[row] = _INITIAL_CAPACITY
+            self._start[row] = start
+            self._compact_if_needed()
+        self._neighbours[self._start[row] + length] = neighbour_row
+        self._length[row] = length + 1
+
+    def _remove_neighbour(self, row, neighbour_row):
+        start = self._start[row]
+        length = self._length[row]
+        rows = self._rows(row)
+        if self.multigraph:  # The last parallel edge is removed, as in networkx.MultiGraph.
+            idx = start + length - 1 - rows[::-1].index(neighbour_row)
+        else:
+            idx = start + rows.index(neighbour_row)
+        self._neighbours[idx:start + length - 1] = self._neighbours[idx + 1:start + length]
+        self._length[row] = length - 1
+
+    def add_edge(self, u, v, **attr):
+        row_u = self._index.get(u)
+        if row_u is None:
+            row_u = self.add_node(u)
+        row_v = self._index.get(v)
+        if row_v is None:
+            row_v = self.add_node(v)
+        start = self._start[row_u]
+        if self.multigraph or row_v not in self._neighbours[start:start + self._length[row_u]]:
+            self._append_neighbour(row_u, row_v)
+            if row_u == row_v:
+                self._self_loops[row_u] = self._self_loops.get(row_u, 0) + 1
+            else:
+                self._append_neighbour(row_v, row_u)
+            self._num_edges += 1
+        if attr:
+            self._edge_data.setdefault(tuple(sorted((row_u, row_v))), {}).update(attr)
+
+    def add_edges_from(self, edges, **attr):
+        for edge in edges:
+            self.add_edge(edge[0], edge[1], **attr)
+
+    def remove_edge(self, u, v):
+        row_u = self._index[u]
+        row_v = self._index[v]
+        if row_v not in self._rows(row_u):
+            raise KeyError('The edge {}-{} is not in the graph'.format(u, v))
+        self._remove_neighbour(row_u, row_v)
+        if row_u == row_v:
+            self._self_loops[row_u] -= 1
+            if not self._self_loops[row_u]:
+                del self._self_loops[row_u]
+        else:
+            self._remove_neighbour(row_v, row_u)
+        self._num_edges -= 1
+        if row_v not in self._rows(row_u):
+            self._edge_data.pop(tuple(sorted((row_u, row_v))), None)
+
+    def remove_node(self, node):
+        row = self._index.pop(node)
+        neighbour_rows = self._rows(row)
+        for neighbour_row in neighbour_rows:
+            if neighbour_row != row:
+                self._remove_neighbour(neighbour_row, row)
+            if self._edge_data:
+                self._edge_data.pop(tuple(sorted((row, neighbour_row))), None)
+        self._num_edges -= len(neighbour_rows)
+        self._self_loops.pop(row, None)
+        self._unused += self._capacity[row]
+        self._length[row] = 0
+        self._capacity[row] = 0
+        for column in self._columns.values():
+            column[row] = _MISSING
+        self._ids[row] = None
+
+    def _compact_if_needed(self):
+        """Rewrites the blocks of neighbours when the half of the flat array is unused."""
+        if self._unused < 1024 or 2 * self._unused < len(self._neighbours):
+            return
+        neighbours = array.array('l')
+        for row in range(len(self._ids)):
+            start = len(neighbours)
+            neighbours.extend(self._rows(row))
+            neighbours.extend(array.array('l', [0]) * (self._capacity[row] - self._length[row]))
+            self._start[row] = start
+        self._neighbours = neighbours
+        self._unused = 0
+
+    def neighbors(self, node):
+        """Returns the list of neighbours of the node, in the order of the networkx adjacency dict."""
+        ids = self._ids
+        neighbours = [ids[x] for x in self._rows(self._index[node])]
+        if len(neighbours) > 1:  # Also drops the parallel edges of the multigraph.
+            neighbours = list(dict.fromkeys(neighbours))
+        return neighbours
+
+    def nodes(self, data=False):
+        """Returns the list of nodes (or of (node, attributes) if data is True)."""
+        nodes = list(dict.fromkeys(x for x in self._ids if x is not None))
+        if data:
+            return [(x, self.node[x]) for x in nodes]
+        return nodes
+
+    def edges(self):
+        """Returns the list of edges, in the order of networkx.Graph.edges."""
+        ids = self._ids
+        output = []
+        seen = set()
+        for node in self.nodes():
+            neighbours = [ids[x] for x in self._rows(self._index[node])]
+            if len(neighbours) > 1:
+                if self.multigraph:  # The parallel edges are grouped, as in networkx.MultiGraph.
+                    counts = collections.Counter(neighbours)
+                    neighbours = [x for x in dict.fromkeys(neighbours) for _ in range(counts[x])]
+                else:
+                    neighbours = list(dict.fromkeys(neighbours))
+            for neighbour in neighbours:
+                if neighbour not in seen:
+                    output.append((node, neighbour))
+            seen.add(node)
+        return output
+
+    def degree(self, node=None):
+        """Returns the degree of the node or, without the node, the list of (node, degree)."""
+        if node is not None:
+            row = self._index[node]
+            return self._length[row] + self._self_loops.get(row, 0)
+        degrees = zip(self._ids, self._length)
+        if self._self_loops:
+            degrees = [(x, length + self._self_loops.get(row, 0)) for row, (x, length) in enumerate(degrees)]
+        return [(x, degree) for x, degree in degrees if x is not None]
+
+    def get_edge_data(self, u, v, default=None):
+        if not self.has_edge(u, v):
+            return default
+        return self._edge_data.get(tuple(sorted((self._index[u], self._index[v]))), {})
+
+    def to_networkx(self):
+        """Returns the copy of the graph as networkx.Graph (or networkx.MultiGraph)."""
+        output_graph = networkx.MultiGraph(**self.graph) if self.multigraph else networkx.Graph(**self.graph)
+        for node, attributes in self.nodes(data=True):
+            output_graph.add_node(node, **attributes)
+        for u, v in self.edges():
+            output_graph.add_edge(u, v, **self.get_edge_data(u, v))
+        return output_graph
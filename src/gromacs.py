@@ -26,7 +26,7 @@ def generate_cg_bonded_terms(settings, cg_graph, output_topology, plain=False):
 
     Args:
         settings: The XML settings file.
-        cg_graph: The networkx.Graph object.
+        cg_graph: The graph.Graph object.
         output_topology: The GROMACS topology object.
         plain: If set to True then cg_terms will not be in cross_ sections.
     """
@@ -64,6 +64,7 @@ def generate_cg_bonded_terms(settings, cg_graph, output_topology, plain=False):
 
     # Generates triplets and quadruplets. 2-nd pass around new topology file.
     new_g = output_topology.get_graph()
+    local_paths = tools.LocalPaths(new_g)
     for b1, b2 in cg_edges:
         n1, n2 = output_topology.atoms[b1], output_topology.atoms[b2]
         chain_name = n1.chain_name
@@ -77,7 +78,7 @@ def generate_cg_bonded_terms(settings, cg_graph, output_topology, plain=False):
             if angle_params:
                 triplets = {
                     tuple(map(lambda x: output_topology.atoms[x].name, z)): tuple(z)
-                    for z in tools.gen_bonded_tuples(new_g, 3, (b1, b2))
+                    for z in local_paths.bonded_tuples(3, (b1, b2))
                 }
                 for tr, tr_ids in triplets.iteritems():
                     a_params = angle_params.get(tr, angle_params.get(tuple(reversed(tr))))
@@ -88,7 +89,7 @@ def generate_cg_bonded_terms(settings, cg_graph, output_topology, plain=False):
             if dihedral_params or pairs_params:
                 quadruplets = {
                     tuple(map(lambda x: output_topology.atoms[x].name, z)): tuple(z)
-                    for z in tools.gen_bonded_tuples(new_g, 4, (b1, b2))
+                    for z in local_paths.bonded_tuples(4, (b1, b2))
                 }
                 for q, q_ids in quadruplets.iteritems():
                     d_params = dihedral_params.get(q, dihedral_params.get(tuple(reversed(q))))
@@ -19,7 +19,11 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import argparse
+import cProfile
+import files_io
+import profiling
 import structures
+import sys
 
 __doc__ = 'Prepare step of bakery'
 
@@ -29,16 +33,101 @@ def _args():
         description='Prepares hybrid coordinate and topology files.',
         add_help=True)
 
-    parser.add_argument('--options', help='XML options file', required=True)
+    parser.add_argument('--options', help='XML options file, required without --layout')
+    parser.add_argument('--cache_dir', default=None,
+                        help='Directory of the cache of parsed input files (default: $BAKERY_CACHE_DIR)')
+    parser.add_argument('--num_workers', default=1, type=int,
+                        help='Number of processes that place the atomistic fragments and generate exclusions')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='Save checkpoints prepare_checkpoint_<hybrid topology>.<stage>.pck of the preparation')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue from the last valid checkpoint, implies --checkpoint')
+    parser.add_argument('--seed', default=None, type=int,
+                        help='Seed of the selection of chains of the source coordinates of fragments '
+                             '(default: random selection)')
+    parser.add_argument('--orient_fragments', action='store_true',
+                        help='Rotate the atomistic fragments to fit the positions of the neighbouring CG beads')
+    parser.add_argument('--overlap_cutoff', default=None, type=float,
+                        help='Report the non-excluded atomistic pairs closer than this distance (nm) '
+                             'in overlaps_<hybrid topology>.dat')
+    parser.add_argument('--save_layout', default=None,
+                        help='Save the layout of the hybrid coordinates in the .npz file')
+    parser.add_argument('--layout', default=None,
+                        help='Only write the hybrid coordinates of --cg_coordinate or --trajectory from the saved layout')
+    parser.add_argument('--cg_coordinate', default=None,
+                        help='CG coordinate file with the snapshot, used with --layout')
+    parser.add_argument('--hybrid_coordinate', default=None,
+                        help='Output hybrid coordinate file, used with --layout (default: from the layout)')
+    parser.add_argument('--trajectory', default=None,
+                        help='Multi-frame .gro or LAMMPS dump file with the CG trajectory, every frame is '
+                             'backmapped with the layout of the preparation (or of --layout)')
+    parser.add_argument('--output_pattern', default='hyb_conf_{:04d}.gro',
+                        help='Names of hybrid coordinate files of the frames of --trajectory, '
+                             'formatted with the frame index (default: %(default)s)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Save the cProfile statistics of the run in prepare_stages_<hybrid topology>.prof')
+    parser.add_argument('--trace_memory', action='store_true',
+                        help='Record the peak of memory traced by tracemalloc in every stage (Python 3 only)')
 
     return parser
 
 
 def main():
-    args = _args().parse_args()
-    bck_settings = structures.BackmapperSettings2(args.options)
+    parser = _args()
+    args = parser.parse_args()
+    if args.trace_memory and profiling.tracemalloc is None:
+        parser.error('--trace_memory requires tracemalloc, which is not available in Python {}.{}'.format(
+            *sys.version_info[:2]))
+    if args.layout is not None:
+        if args.trajectory is not None:
+            structures.backmap_trajectory(
+                args.layout, args.trajectory, args.output_pattern, num_workers=args.num_workers)
+            return
+        if args.cg_coordinate is None:
+            parser.error('--layout requires --cg_coordinate or --trajectory')
+        structures.apply_layout(args.layout, args.cg_coordinate, args.hybrid_coordinate)
+        return
+    if args.options is None:
+        parser.error('--options is required')
+    if args.cache_dir is not None:
+        files_io.set_parse_cache_dir(args.cache_dir)
+    if args.trace_memory:
+        profiling.stage_profile.start_trace_memory()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
 
-    bck_settings.prepare_hybrid()
+    with profiling.stage('parse'):
+        bck_settings = structures.BackmapperSettings2(args.options, seed=args.seed)
+        profiling.count('cg_beads', bck_settings.cg_graph.number_of_nodes())
+        profiling.count('fragments', len(bck_settings.fragments))
+
+    checkpoints = None
+    if args.checkpoint or args.resume:
+        checkpoints = structures.Checkpoints(
+            'prepare_checkpoint_{}'.format(bck_settings.hyb_topology.file_name.split('.')[0]),
+            bck_settings.input_fingerprint)
+
+    bck_settings.prepare_hybrid(
+        num_workers=args.num_workers, checkpoints=checkpoints, resume=args.resume,
+        orient_fragments=args.orient_fragments)
+    if args.overlap_cutoff is not None:
+        bck_settings.report_overlaps(args.overlap_cutoff)
+    if args.save_layout is not None:
+        bck_settings.save_layout(args.save_layout)
+    if args.trajectory is not None:
+        with profiling.stage('trajectory'):
+            output_files = structures.backmap_trajectory(
+                bck_settings.layout(), args.trajectory, args.output_pattern, num_workers=args.num_workers)
+            profiling.count('frames', len(output_files))
+
+    # The stage profile and the statistics are saved next to the hybrid topology.
+    output_prefix = 'prepare_stages_{}'.format(bck_settings.hyb_topology.file_name.split('.')[0])
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats('{}.prof'.format(output_prefix))
+        print('Saved cProfile statistics {}.prof'.format(output_prefix))
+    profiling.stage_profile.write('{}.json'.format(output_prefix))
 
 
 if __name__ == '__main__':
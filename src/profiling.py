@@ -0,0 +1,155 @@
+"""
+Copyright (C) 2017 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is distributed under free software licence:
+you can redistribute it and/or modify it under the terms of the
+GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2.
+    tracemalloc = None
+
+__doc__ = 'Timings, memory usage and counts of items of the stages of the prepare step.'
+
+
+def _cpu_time():
+    """Returns the user and system CPU time of the process and of its finished children."""
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def _max_rss():
+    """Returns the peak resident set size of the process and of its largest child, in kB (Linux).
+
+    The peaks are over the whole lifetime of the processes, not only of the current stage.
+    """
+    if resource is None:
+        return None, None
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class StageProfile(object):
+    """Records the wall time, the CPU time, the peak memory and the counts of items of stages.
+
+    The stages can be nested, the name of the nested stage contains the names of
+    the enclosing stages, separated by '/'. The records are in the order of the start
+    of the stages.
+
+    The resident set size cannot be reset, so the stage records the increase of the
+    lifetime peak during the stage (max_rss_increase_kb, zero if the stage stays below
+    the earlier peak) and the lifetime peak at its end (cumulative_max_rss_kb), the same
+    for the children processes.
+    """
+    def __init__(self):
+        self.stages = []
+        self._open_stages = []
+        self.trace_memory = False
+
+    def start_trace_memory(self):
+        """Starts tracemalloc, the stages will record the peak of the traced memory."""
+        if tracemalloc is None:
+            raise RuntimeError('tracemalloc is not available in this version of Python')
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.trace_memory = True
+
+    def _update_traced_peak(self):
+        """Propagates the peak of the traced memory to all open stages and resets it."""
+        if not self.trace_memory:
+            return
+        peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+        for record in self._open_stages:
+            record['traced_peak_kb'] = max(record['traced_peak_kb'], peak_kb)
+        if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+            tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that records the stage, yields the record of the stage."""
+        if self._open_stages:
+            name = '{}/{}'.format(self._open_stages[-1]['name'], name)
+        record = collections.OrderedDict([('name', name), ('wall_time', None), ('cpu_time', None)])
+        record['counts'] = collections.OrderedDict()
+        self._update_traced_peak()
+        if self.trace_memory:
+            record['traced_peak_kb'] = tracemalloc.get_traced_memory()[0] // 1024
+        self.stages.append(record)
+        self._open_stages.append(record)
+        wall_time0, cpu_time0 = time.time(), _cpu_time()
+        max_rss0, children_max_rss0 = _max_rss()
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.time() - wall_time0
+            record['cpu_time'] = _cpu_time() - cpu_time0
+            max_rss, children_max_rss = _max_rss()
+            record['max_rss_increase_kb'] = None if max_rss is None else max_rss - max_rss0
+            record['children_max_rss_increase_kb'] = None if max_rss is None else children_max_rss - children_max_rss0
+            record['cumulative_max_rss_kb'], record['children_cumulative_max_rss_kb'] = max_rss, children_max_rss
+            self._update_traced_peak()
+            self._open_stages.pop()
+
+    def count(self, name, value):
+        """Sets the count of items in the innermost open stage."""
+        if self._open_stages:
+            self._open_stages[-1]['counts'][name] = value
+
+    def write(self, file_name):
+        """Writes the records of the stages as JSON."""
+        with open(file_name, 'w') as output_file:
+            json.dump({'stages': self.stages}, output_file, indent=2)
+        print('Saved stage profile {}'.format(file_name))
+
+    def clear(self):
+        self.stages = []
+        self._open_stages = []
+
+
+# The profile of the stages of the current run.
+stage_profile = StageProfile()
+
+
+def stage(name):
+    """Context manager that records the stage in the stage_profile."""
+    return stage_profile.stage(name)
+
+
+def count(name, value):
+    """Sets the count of items in the current stage of the stage_profile."""
+    stage_profile.count(name, value)
+
+
+def profile_stage(name):
+    """Decorator that records every call of the function as the stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_profile.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -59,7 +59,7 @@ def main():  # NOQA
 
     input_conf = gromacs_topology.read(args.top, doRegularExcl=generate_exclusions)
     input_gro_conf = files_io.GROFile(args.conf)
-    input_gro_conf.read()
+    input_gro_conf.read(cached=False)
 
     if not generate_exclusions:
         exclusion_file = open(args.exclusion_list, 'r')
@@ -398,9 +398,10 @@ def main():  # NOQA
             global_int_step += 1
 
         confout_aa = '{}confout_aa_{}_{}_phase_one.gro'.format(args.output_prefix, args.alpha, rng_seed)
-        at_gro_conf.update_positions(system)
+        snapshot = files_io.ParticleSnapshot.take(system, gro_whole.particle_ids())
+        at_gro_conf.update_positions(system, snapshot=snapshot)
         at_gro_conf.write(confout_aa, force=True)
-        gro_whole.update_positions(system)
+        gro_whole.update_positions(system, snapshot=snapshot)
         gro_whole.write(
             '{}confout_full_{}_{}_phase_one.gro'.format(args.output_prefix, args.alpha, args.rng_seed), force=True)
         print('Atomistic configuration write to: {}'.format(confout_aa))
@@ -458,11 +459,12 @@ def main():  # NOQA
 
     time_bck = time.time() - time_sim0
 
-    gro_whole.update_positions(system)
+    snapshot = files_io.ParticleSnapshot.take(system, gro_whole.particle_ids())
+    gro_whole.update_positions(system, snapshot=snapshot)
     gro_whole.write(
         '{}confout_full_{}_{}_phase_two.gro'.format(args.output_prefix, args.alpha, rng_seed), force=True)
     confout_aa = '{}confout_aa_{}_{}_phase_two.gro'.format(args.output_prefix, args.alpha, rng_seed)
-    at_gro_conf.update_positions(system)
+    at_gro_conf.update_positions(system, snapshot=snapshot)
     at_gro_conf.write(confout_aa, force=True)
 
     print('Atomistic configuration write to: {}'.format(confout_aa))
@@ -531,12 +533,13 @@ def main():  # NOQA
     benchmark_file.close()
     ## End save benchmark data
 
-    gro_whole.update_positions(system)
+    snapshot = files_io.ParticleSnapshot.take(system, gro_whole.particle_ids())
+    gro_whole.update_positions(system, snapshot=snapshot)
     gro_whole.write(
         '{}confout_final_full_{}_{}.gro'.format(args.output_prefix, args.alpha, rng_seed), force=True)
 
     confout_aa = '{}confout_final_aa_{}_{}.gro'.format(args.output_prefix, args.alpha, rng_seed)
-    at_gro_conf.update_positions(system)
+    at_gro_conf.update_positions(system, snapshot=snapshot)
     at_gro_conf.write(confout_aa, force=True)
     print('Final atomistic configuration write to: {}'.format(confout_aa))
     print('Final hybrid configuration write to: {}'.format(
@@ -544,7 +547,7 @@ def main():  # NOQA
 
     # Write atomistic topology
     hyb_top = files_io.GROMACSTopologyFile(args.top)
-    hyb_top.read()
+    hyb_top.read(cached=False)
     at_topology = general_tools.get_atomistic_topology(
         hyb_top,
         virtual_atomtypes=[
@@ -21,16 +21,25 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import collections
 import copy
 import files_io
+import hashlib
+import os
+import graph
 import tools
 import xml.etree.ElementTree as etree
 
 import numpy as np
 import random
-import networkx
 import logging
+import multiprocessing
+import profiling
 import sys
 import warnings
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 __doc__ = "Data structures."""
 
 BeadID = collections.namedtuple('BeadID', ['name', 'degree'])
@@ -44,6 +53,186 @@ BondedParams = collections.namedtuple('BondedParams', ['params', 'typeid'])
 
 logger = logging.getLogger()
 
+# The settings used by the processes of the fragment placement, set before the pool is created.
+_placement_settings = None
+
+
+def _place_residue_worker(residue_task):
+    """Places the fragments of the residue in the worker process, see BackmapperSettings2._place_residue."""
+    return _placement_settings._place_residue(residue_task)
+
+
+# The version of the checkpoint format, the checkpoints of other versions are not valid.
+CHECKPOINT_VERSION = 4
+
+# The stages of prepare_hybrid after which the checkpoints are saved, in order.
+CHECKPOINT_STAGES = ('placement', 'cg_terms', 'cross_bonds')
+
+
+class Checkpoints(object):
+    """Stores the state of prepare_hybrid after its stages, one pickle file per stage.
+
+    Args:
+        prefix: The prefix of the checkpoint files, <prefix>.<stage>.pck.
+        fingerprint: The fingerprint of the input files, the checkpoints of other inputs are not valid.
+    """
+    def __init__(self, prefix, fingerprint):
+        self.prefix = prefix
+        self.fingerprint = fingerprint
+
+    def file_name(self, stage):
+        return '{}.{}.pck'.format(self.prefix, stage)
+
+    def save(self, stage, state):
+        """Saves the state of the stage."""
+        data = {'version': CHECKPOINT_VERSION, 'fingerprint': self.fingerprint, 'stage': stage, 'state': state}
+        # Written to the temporary file first, so the interrupted save does not leave a partial checkpoint.
+        tmp_file_name = '{}.tmp'.format(self.file_name(stage))
+        with open(tmp_file_name, 'wb') as checkpoint_file:
+            pickle.dump(data, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file_name, self.file_name(stage))
+        print('Saved checkpoint {}'.format(self.file_name(stage)))
+
+    def load_last(self):
+        """Returns (stage, state) of the last valid checkpoint or (None, None)."""
+        for stage in reversed(CHECKPOINT_STAGES):
+            file_name = self.file_name(stage)
+            if not os.path.exists(file_name):
+                continue
+            try:
+                with open(file_name, 'rb') as checkpoint_file:
+                    data = pickle.load(checkpoint_file)
+            except Exception as ex:  # pylint:disable=W0703
+                print('Checkpoint {} cannot be read: {}'.format(file_name, ex))
+                continue
+            if data.get('version') != CHECKPOINT_VERSION or data.get('fingerprint') != self.fingerprint:
+                print('Checkpoint {} is from other input files or version, skipped'.format(file_name))
+                continue
+            print('Resuming from checkpoint {}'.format(file_name))
+            return stage, data['state']
+        print('No valid checkpoint found')
+        return None, None
+
+# The version of the layout files written by BackmapperSettings2.save_layout.
+LAYOUT_VERSION = 1
+
+
+def load_layout(layout_file):
+    """Reads the layout saved by BackmapperSettings2.save_layout, returns the dict of arrays."""
+    with np.load(layout_file) as layout_data:
+        layout = dict(layout_data.items())
+    if int(layout['version']) != LAYOUT_VERSION:
+        raise RuntimeError('Layout {} has version {}, expected {}'.format(
+            layout_file, int(layout['version']), LAYOUT_VERSION))
+    return layout
+
+
+def _write_layout_frame(layout, cg_positions, box, output_file):
+    """Writes the hybrid coordinate file with the atoms of the layout around the CG positions.
+
+    Args:
+        layout: The dict of arrays of the layout.
+        cg_positions: The (N, 3) array of positions of the CG beads, in the order of the bead ids.
+        box: The box of the CG snapshot.
+        output_file: The name of the hybrid coordinate file.
+
+    Returns:
+        The GROFile object with the hybrid coordinates.
+    """
+    if len(cg_positions) != int(layout['num_cg_atoms']):
+        raise RuntimeError('CG snapshot has {} beads, the layout {}'.format(
+            len(cg_positions), int(layout['num_cg_atoms'])))
+    positions = cg_positions[layout['cg_ids'] - 1] + layout['offsets']
+
+    output_gro = files_io.GROFile(output_file)
+    output_gro.atoms.extend(
+        layout['atom_id'], layout['atom_id'], layout['name'].tolist(), layout['chain_name'].tolist(),
+        layout['chain_idx'], positions)
+    output_gro.title = str(layout['title']) or None
+    output_gro.box = box
+    output_gro.write(force=True)
+    return output_gro
+
+
+def apply_layout(layout_file, cg_coordinate, output_file=None):
+    """Writes the hybrid coordinate file of the CG snapshot from the layout of the earlier preparation.
+
+    The position of every atom is the position of its CG bead in the snapshot plus
+    its offset in the fragment, see BackmapperSettings2.save_layout.
+
+    Args:
+        layout_file: The .npz file saved by BackmapperSettings2.save_layout.
+        cg_coordinate: The CG coordinate file with the snapshot.
+        output_file: The name of the hybrid coordinate file, by default the one of the layout.
+
+    Returns:
+        The GROFile object with the hybrid coordinates.
+    """
+    layout = load_layout(layout_file)
+    cg_file = files_io.read_coordinates(cg_coordinate)
+    cg_positions = cg_file.atoms.positions(np.arange(1, len(cg_file.atoms) + 1))
+    output_gro = _write_layout_frame(
+        layout, cg_positions, cg_file.box, output_file or str(layout['file_name']))
+    print('Saved {} atoms of {} in {}'.format(len(output_gro.atoms), cg_coordinate, output_gro.file_name))
+    return output_gro
+
+
+# The layout and the trajectory used by the processes of backmap_trajectory, set before the pool
+# is created, so the forked workers share them instead of receiving copies with every frame.
+_trajectory_layout = None
+_trajectory_reader = None
+
+
+def _backmap_frame(task):
+    """Writes the hybrid coordinate file of the frame of _trajectory_reader, returns the number of atoms."""
+    frame_idx, output_file = task
+    frame = _trajectory_reader.read_frame(frame_idx)
+    return len(_write_layout_frame(_trajectory_layout, frame.position, frame.box, output_file).atoms)
+
+
+def backmap_trajectory(layout, trajectory_file, output_pattern, num_workers=1):
+    """Writes the hybrid coordinate file of every frame of the CG trajectory.
+
+    The atomistic fragments are placed once, by the preparation that saved the layout, the
+    frames only move them with their CG beads, see apply_layout. The frames are independent,
+    with num_workers > 1 they are written by the pool of processes that share the layout.
+
+    Args:
+        layout: The dict of arrays of the layout or the name of the .npz file.
+        trajectory_file: The multi-frame .gro or LAMMPS dump file with the CG trajectory.
+        output_pattern: The name of the output files, formatted with the index of the frame,
+            e.g. hyb_conf_{:04d}.gro.
+        num_workers: The number of processes.
+
+    Returns:
+        The list of names of the hybrid coordinate files.
+    """
+    global _trajectory_layout, _trajectory_reader
+    if not isinstance(layout, dict):
+        layout = load_layout(layout)
+    if output_pattern.format(0) == output_pattern.format(1):
+        raise RuntimeError('Output pattern {} does not contain the frame index, e.g. {{}}'.format(output_pattern))
+    _trajectory_layout = layout
+    _trajectory_reader = files_io.read_trajectory(trajectory_file)
+    tasks = [(frame_idx, output_pattern.format(frame_idx)) for frame_idx in range(len(_trajectory_reader))]
+    print('Backmapping {} frames of {}, workers: {}'.format(len(tasks), trajectory_file, num_workers))
+    try:
+        if num_workers <= 1 or len(tasks) < 2:
+            num_atoms = [_backmap_frame(task) for task in tasks]
+        else:
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                num_atoms = pool.map(_backmap_frame, tasks, 1)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _trajectory_layout = None
+        _trajectory_reader = None
+    print('Saved {} frames with {} atoms in {}'.format(len(tasks), num_atoms[0] if num_atoms else 0, output_pattern))
+    return [output_file for _, output_file in tasks]
+
+
 class CGFragment:
     """Complex struct, with the construct that does a bit of processing."""
     def __init__(
@@ -54,7 +243,8 @@ class CGFragment:
             charge_map=None,
             as_remove=None,
             equilibrate_charges=False,
-            type_map=None):
+            type_map=None,
+            rng=None):
         self.topology = cg_molecule.source_topology
         self.coordinate = cg_molecule.source_coordinate
         self.fragment_list = fragment_list
@@ -73,23 +263,20 @@ class CGFragment:
                 raise RuntimeError('Please specify fragment_name for {} as it contains more than one chain type'.format(
                     cg_molecule.name))
             fragment_name = self.coordinate.chains.keys()[0]
-        chains = self.coordinate.chains[fragment_name]
-        # Select random chain from the ensemble of chains.
-        atoms = chains[random.sample(chains.keys(), 1)[0]]
+        self.fragment_name = fragment_name
         self.atomparams = {
             k: v[0] for k, v in self.topology.chain_atom_names[fragment_name].items()
             }
         self.active_sites = {}
 
-        self.com = np.zeros(3)
-        total_mass = 0.0
-        tmp_atom_list = []
+        # Select random chain from the ensemble of chains, with rng if it is set.
+        chains = self.coordinate.chains[fragment_name]
+        self.set_chain((rng or random).choice(sorted(chains)))
+
         at_charges = []
         num_at_change = 0
         for bid, bead in enumerate(self.fragment_list):
             atom_name = bead.split(':')[2]
-            atom = atoms[atom_name]._replace()
-            atom_mass = self.atomparams[atom_name].mass
             if charge_map:
                 if charge_map[bid] == '*':
                     at_charges.append(self.atomparams[atom_name].charge)
@@ -99,9 +286,6 @@ class CGFragment:
             else:
                 at_charges.append(self.atomparams[atom_name].charge)
                 num_at_change += 1
-            self.com += atom_mass * atom.position
-            total_mass += atom_mass
-            tmp_atom_list.append(atom)
 
         total_charge = sum(at_charges)
         if equilibrate_charges and total_charge != 0.0:
@@ -119,17 +303,55 @@ class CGFragment:
                     self.charge_map.append(c - dcharge)
             print('Equilibrate charge, total: {} -> {}'.format(total_charge, sum(self.charge_map)))
 
-        self.com /= total_mass
+        if active_sites:
+            for at_as in active_sites:
+                t = at_as.split(':')  # Format: atom name -> maximum degree
+                self.active_sites[t[1]] = int(t[2])
+
+    def set_chain(self, chain_idx):
+        """Takes the atomistic coordinates of the fragment from the chain of the source coordinates.
+
+        Args:
+            chain_idx: The index of the chain of fragment_name in the source coordinates.
+
+        Raises:
+            KeyError: if an atom of the fragment is not in the chain.
+        """
+        atoms = self.coordinate.chains[self.fragment_name][chain_idx]
+        com = np.zeros(3)
+        total_mass = 0.0
+        tmp_atom_list = []
+        for bead in self.fragment_list:
+            atom_name = bead.split(':')[2]
+            atom = atoms[atom_name]._replace()
+            atom_mass = self.atomparams[atom_name].mass
+            com += atom_mass * atom.position
+            total_mass += atom_mass
+            tmp_atom_list.append(atom)
+
+        self.chain_idx = chain_idx
+        self.source_atoms = atoms
+        self.com = com / total_mass
         self.cg_mass = total_mass
         # Move the atoms in fragments to the origin, always by substracting the com of the fragment.
         self.atom_in_fragments = [
             files_io.Atom(x[0], x[1], x[2], x[3], x[4] - self.com)
             for x in tmp_atom_list
             ]
-        if active_sites:
-            for at_as in active_sites:
-                t = at_as.split(':')  # Format: atom name -> maximum degree
-                self.active_sites[t[1]] = int(t[2])
+
+    def source_com(self, cg_fragment):
+        """Returns the COM of atoms of the other fragment in the source chain of this fragment.
+
+        The position is relative to the COM of this fragment, so it is the reference position
+        of the neighbouring CG bead in the frame of atom_in_fragments.
+
+        Raises:
+            KeyError: if the atoms of the other fragment are not in the source chain.
+        """
+        atom_names = [bead.split(':')[2] for bead in cg_fragment.fragment_list]
+        masses = np.array([cg_fragment.atomparams[atom_name].mass for atom_name in atom_names])
+        positions = np.array([self.source_atoms[atom_name].position for atom_name in atom_names])
+        return masses.dot(positions) / masses.sum() - self.com
 
 
 def _get_params(input_dict, key_list, raise_exception=True):
@@ -148,9 +370,26 @@ def _get_params(input_dict, key_list, raise_exception=True):
 
 
 class BackmapperSettings2:
-    def __init__(self, input_xml):
+    # The attributes changed by prepare_hybrid, saved in the checkpoints.
+    _checkpoint_attrs = (
+        'res2atom', 'cg_active_sites', 'res_fragment_keys', 'atom_ids', 'cg_old_new_id', 'cg_new_id_old',
+        'atom2cg', 'mol_atomid_map', 'mol_atomname_map', 'cg2atom', 'global_graph', 'cg_atomtypes',
+        'at_cross_bonds', 'at_cross_angles', 'at_cross_dihedrals', 'fragment_rotations')
+
+    def __init__(self, input_xml, seed=None):
+        # The seed of the selection of source chains of the fragments, None for a random selection.
+        self.seed = seed
         self.res2atom = collections.defaultdict(list)
         self.cg_active_sites = collections.defaultdict(list)
+        # Integer labels of the active sites (chain_name, name), the tuple of labels of
+        # active sites of every CG bead and the compatible pairs for the tuples of labels.
+        self.active_site_labels = {}
+        self.bead_active_site_labels = {}
+        self.active_site_pairs = {}
+        # The fragment keys of CG beads of every residue and the templates of bonded terms
+        # of residues, keyed by the tuple of fragment keys.
+        self.res_fragment_keys = collections.defaultdict(list)
+        self.residue_terms_templates = {}
         self.atom_id2fragment = {}
         self.atom_ids = []  # List of ids of atomistic particles
         self.cg_old_new_id = {}
@@ -163,13 +402,25 @@ class BackmapperSettings2:
         self.cg2atom = collections.defaultdict(list)
 
         self.charge_transfer = {}   # Map with charge transfer.
+        self.cg_atomtypes = []  # The atom types of CG beads in the hybrid topology.
+        self.removed_atom_ids = set()  # The ids of atoms removed after creating the cross bonds.
+        self.fragment_rotations = {}  # CG id -> rotation of its fragment, see _fit_fragment_rotations.
 
-        self.global_graph = networkx.Graph()
+        self.global_graph = graph.Graph()
+        self.checkpoints = None
 
         # Parse XML file
         tree = etree.parse(input_xml)
         self.root = tree.getroot()
-        self._parse()
+        with files_io.parse_cache.recording() as read_keys:
+            self._parse()
+
+        # The fingerprint of the options and of the content of all read files.
+        with open(input_xml, 'rb') as xml_file:
+            fingerprint = hashlib.sha1(xml_file.read())
+        for key in read_keys:
+            fingerprint.update(key.encode('utf-8'))
+        self.input_fingerprint = fingerprint.hexdigest()
 
         # AT cross terms
         self.at_cross_bonds = {}
@@ -425,7 +676,8 @@ class BackmapperSettings2:
                                     'Number of entries in type_map {} does not match number of beads {}'.format(
                                         len(type_map), len(bead_list)))
                         try:
-                            cg_fragment = CGFragment(cg_molecule, bead_list, active_sites, charge_map, as_remove, equilibrate_charges, type_map)
+                            rng = self._fragment_rng(mol_deg, cg_molecule.name, related_bead_name, name, degree)
+                            cg_fragment = CGFragment(cg_molecule, bead_list, active_sites, charge_map, as_remove, equilibrate_charges, type_map, rng)
                             self.fragments[(mol_deg, cg_molecule.name, related_bead_name)][name][degree] = cg_fragment
                         except KeyError as ex:
                             continue
@@ -455,16 +707,136 @@ class BackmapperSettings2:
                         transfer_to_map[tt_to_on] = tt_to
 
 
-    def prepare_hybrid(self):
-        """Creates hybrid files."""
+    def _fragment_rng(self, *fragment_key):
+        """Returns the random generator of the fragment, seeded with the seed and the key of the fragment.
+
+        Every fragment has its own generator, so its chain does not depend on the other fragments.
+        Returns None if the seed is not set.
+        """
+        if self.seed is None:
+            return None
+        label = ' '.join(str(x) for x in (self.seed,) + fragment_key)
+        return random.Random(int(hashlib.sha1(label.encode('utf-8')).hexdigest(), 16))
+
+    def prepare_hybrid(self, num_workers=1, checkpoints=None, resume=False, orient_fragments=False):
+        """Creates hybrid files.
+
+        Args:
+            num_workers: The number of processes that place the atomistic fragments
+                and generate the exclusion lists.
+            checkpoints: The Checkpoints object, if set the state is saved after the
+                fragment placement, the CG term renumbering and the cross-bond selection.
+            resume: If True, continues from the last valid checkpoint.
+            orient_fragments: If True, the fragments are rotated to fit the positions of
+                the neighbouring CG beads, see _fit_fragment_rotations.
+        """
         outfile = self.hybrid_configuration['file']
-        new_at_id = 1
+        self.checkpoints = checkpoints
+
+        resume_stage, resume_data = None, None
+        if checkpoints is not None and resume:
+            resume_stage, state = checkpoints.load_last()
+            if resume_stage is not None:
+                resume_data = self._restore_checkpoint(state)
+        if resume_stage is None:
+            self._place_fragments(outfile, num_workers, orient_fragments)
+            self._save_checkpoint('placement')
+        cg_atomtypes = self.cg_atomtypes
+
+        # Rebuild hybrid topology.
+        self.rebuild_hybrid_topology(resume_stage, resume_data)
+        with profiling.stage('write'):
+            # The atomistic topology is masked from the hybrid one and written in the same walk.
+            at_topol = tools.get_atomistic_topology(self.hyb_topology, virtual_atomtypes=cg_atomtypes)
+            self.hyb_topology.write(others=[(at_topol, 'at_{}'.format(self.hyb_topology.file_name))])
+            # Write the hybrid coordinate file.
+            outfile.write(force=True)
+
+            # Write the list of bonds, angles and dihedrals to separate files.
+            out_cross_bonds = 'cross_bonds_{}'.format(self.hyb_topology.file_name.replace('.top', '.dat'))
+            out_cross_angles = 'cross_angles_{}'.format(self.hyb_topology.file_name.replace('.top', '.dat'))
+            out_cross_dihedrals = 'cross_dihedrals_{}'.format(self.hyb_topology.file_name.replace('.top', '.dat'))
+            with open(out_cross_bonds, 'w') as outbond:
+                outl = []
+                for k, p in self.at_cross_bonds.items():
+                    new_k = map(at_topol.old2new_ids.get, k)
+                    if p.typeid:
+                        outl.append([int(p.typeid)] + new_k)
+                outl.sort(key=lambda x: x[0])
+                outbond.write('\n'.join([' '.join(map(str, p)) for p in outl]))
+            print('Saved {}'.format(out_cross_bonds))
+
+            with open(out_cross_angles, 'w') as outbond:
+                outl = []
+                for k, p in self.at_cross_angles.items():
+                    new_k = map(at_topol.old2new_ids.get, k)
+                    if p.typeid:
+                        outl.append([int(p.typeid)] + new_k)
+                outl.sort(key=lambda x: x[0])
+                outbond.write('\n'.join([' '.join(map(str, p)) for p in outl]))
+            print('Saved {}'.format(out_cross_angles))
+
+            with open(out_cross_dihedrals, 'w') as outbond:
+                outl = []
+                for k, p in self.at_cross_dihedrals.items():
+                    new_k = map(at_topol.old2new_ids.get, k)
+                    if p.typeid:
+                        outl.append([int(p.typeid)] + new_k)
+                outl.sort(key=lambda x: x[0])
+                outbond.write('\n'.join([' '.join(map(str, p)) for p in outl]))
+            print('Saved {}'.format(out_cross_dihedrals))
+            profiling.count('atoms', len(outfile.atoms))
+        # Generate exclusion list.
+        self._generate_exclusion_lists(num_workers)
 
-        cg_ids = sorted(self.cg_graph.nodes())
-        cg_atomtypes = []
+    def layout(self):
+        """Returns the layout of the hybrid coordinates, used by apply_layout for other CG snapshots.
 
+        For every atom of the hybrid coordinate file, in the order of ids, the layout has the id
+        of its CG bead in the CG coordinate file and its offset from the bead, the position in
+        the fragment, together with the names and the chains of atoms. The fragments keep the
+        orientation fitted to this configuration, see _fit_fragment_rotations.
+        """
+        outfile = self.hybrid_configuration['file']
+        # The ids before the removal of atoms, the remaining atoms were renumbered in this order.
+        old_ids = sorted((set(self.cg_new_id_old) | set(self.atom2cg)) - self.removed_atom_ids)
+        if len(old_ids) != len(outfile.atoms):
+            raise RuntimeError('Layout of {} atoms does not match the hybrid configuration with {} atoms'.format(
+                len(old_ids), len(outfile.atoms)))
+        cg_ids = np.zeros(len(old_ids), dtype=np.int64)
+        offsets = np.zeros((len(old_ids), 3))
+        for row, at_id in enumerate(old_ids):
+            cg_bead_id = self.atom2cg.get(at_id, at_id)
+            cg_ids[row] = self.cg_new_id_old[cg_bead_id]
+            if at_id != cg_bead_id:
+                cg_fragment = self.atom_id2fragment[at_id]
+                offsets[row] = cg_fragment.atom_in_fragments[at_id - cg_bead_id - 1].position
+                rotation = self.fragment_rotations.get(cg_ids[row])
+                if rotation is not None:
+                    offsets[row] = rotation.dot(offsets[row])
+        at = outfile.atoms.columns(np.sort(outfile.atoms.keys_array()))
+        return {
+            'version': np.asarray(LAYOUT_VERSION),
+            'file_name': np.asarray(outfile.file_name),
+            'title': np.asarray(outfile.title or ''),
+            'num_cg_atoms': np.asarray(len(self.cg_coordinate.atoms)),
+            'cg_ids': cg_ids,
+            'offsets': offsets,
+            'atom_id': at.atom_id,
+            'name': np.asarray(at.name).astype(str),
+            'chain_name': np.asarray(at.chain_name).astype(str),
+            'chain_idx': at.chain_idx}
+
+    def save_layout(self, file_name):
+        """Saves the layout of the hybrid coordinates in the .npz file, see layout."""
+        layout = self.layout()
+        np.savez(file_name, **layout)
+        print('Saved layout of {} atoms in {}'.format(len(layout['atom_id']), file_name))
+
+    def _place_fragments(self, outfile, num_workers=1, orient_fragments=False):
+        """Selects and places the atomistic fragments of all residues."""
         # Residue graph for getting the residue degree.
-        residue_graph = networkx.MultiGraph()
+        residue_graph = graph.Graph(multigraph=True)
 
         for cg_id in self.cg_graph.nodes():
             cg_bead = self.cg_graph.node[cg_id]
@@ -483,218 +855,461 @@ class BackmapperSettings2:
             residue_graph.node[res_id]['degree'] = str(deg)
             residue_graph.node[res_id]['fragment_key'] = None
 
-        for res_id in sorted(residue_graph.nodes()):
-            cg_nodes = residue_graph.node[res_id]['cg_nodes']
-            residue_degree = residue_graph.node[res_id]['degree']
-            residue_name = residue_graph.node[res_id]['chain_name']
-            possible_fragments = [x for x in self.fragments.keys()
-                                  if x[1] == residue_name and (x[0] == '*' or x[0] == residue_degree)]
-
-            selected_fragment = None
-            for possible_fragment in possible_fragments:
-                f = self.fragments[possible_fragment]
-                selected_fragment = possible_fragment
-                for cg_id in cg_nodes:
-                    cg_node = self.cg_graph.node[cg_id]
-                    if str(cg_node['degree']) not in f[cg_node['name']] and '*' not in f[cg_node['name']]:
-                        selected_fragment = None
-                if selected_fragment is not None:
-                    break
-            if selected_fragment is None:
-                print('Residue id: {}'.format(res_id))
-                print('Bead ids: {}'.format(cg_nodes))
-                print('Residue degree: {}'.format(residue_degree))
-                print('Residue name: {}'.format(residue_name))
-
-                print(('It is very likely that your .xml file does not'
-                       ' contains definition of a fragment for residue {}').format(residue_name))
-
-                raise RuntimeError(
-                    'Problem with the option file, could not find correct fragment for molecule {}'.format(res_id))
-
-            for cg_id in cg_nodes:
-                cg_atom = self.cg_coordinate.atoms[cg_id]
-                cg_bead = self.cg_graph.node[cg_id]
-                cg_bead_id = new_at_id
-
-                fragments = self.fragments[selected_fragment][cg_bead['name']]
-
-                cg_fragment = fragments.get(str(cg_bead['degree']), fragments.get('*'))
-                if not cg_fragment:
-                    raise RuntimeError('Problem with getting atomistic fragments')
-                outfile.atoms[cg_bead_id] = files_io.Atom(
-                    atom_id=cg_bead_id,
-                    name=cg_bead['name'],
-                    chain_name=cg_fragment.cg_molecule.ident,
-                    # Change chain name to one from <ident> tag in the cg_molecule
-                    chain_idx=res_id,
-                    position=cg_atom.position
-                )
-                self.cg_new_id_old[cg_bead_id] = cg_id
-                self.cg_old_new_id[cg_id] = cg_bead_id
-
-                self.atom_id2fragment[new_at_id] = cg_fragment
-
-                self.global_graph.add_node(cg_bead_id, **cg_bead)
-
-                # Change the mass of CG bead
-                chain_name = cg_fragment.cg_molecule.ident
-                topol_atom = copy.copy(self.cg_topology.atoms[cg_id])
-                topol_atom.mass = cg_fragment.cg_mass
-                topol_atom.atom_id = cg_bead_id
-                topol_atom.chain_idx = res_id
-                topol_atom.chain_name = cg_fragment.cg_molecule.ident  # Change chain name to one from <ident> tag in the cg_molecule
-                topol_atom.cgnr = cg_bead_id
-                self.hyb_topology.atoms[new_at_id] = topol_atom
-                if cg_fragment.cg_molecule.ident not in self.hyb_topology.chains:
-                    self.hyb_topology.chains[cg_fragment.cg_molecule.ident] = {}
-                if res_id not in self.hyb_topology.chains[cg_fragment.cg_molecule.ident]:
-                    self.hyb_topology.chains[cg_fragment.cg_molecule.ident][res_id] = {}
-                if topol_atom.name in self.hyb_topology.chains[cg_fragment.cg_molecule.ident][res_id]:
-                    raise RuntimeError(
-                        '{} already defined, please make sure that atom names are unique'.format(topol_atom.name))
-                cg_atomtypes.append(topol_atom.atom_type)
-                self.hyb_topology.chains[cg_fragment.cg_molecule.ident][res_id][topol_atom.name] = topol_atom
-
-                # Set the atomistic coordinates for this fragment, put it in the
-                # output coordinate file.
-                cg_com = cg_atom.position
-                new_at_id += 1
-                for idx, at in enumerate(cg_fragment.atom_in_fragments):
-                    new_at_atom = files_io.Atom(
-                        new_at_id,
-                        at.name,
-                        cg_fragment.cg_molecule.ident,  # Change chain name to one from <ident> tag in the cg_molecule
-                        res_id,
-                        at.position + cg_com
-                    )
-                    outfile.atoms[new_at_id] = new_at_atom
-                    self.global_graph.add_node(
-                        new_at_id,
-                        name=at.name,
-                        res_id=res_id,
-                        position=at.position + cg_com,
-                        chain_name=chain_name)
-
-                    # Set topology atom
-                    topol_atom = copy.copy(cg_fragment.topology.chain_atom_names[at.chain_name][at.name][0])
-                    if res_id not in self.mol_atomid_map[chain_name]:
-                        self.mol_atomid_map[chain_name][res_id] = {}
-                        self.mol_atomname_map[chain_name][res_id] = {}
-                    self.mol_atomid_map[chain_name][res_id][topol_atom.atom_id] = new_at_id
-                    self.mol_atomname_map[chain_name][res_id][topol_atom.name] = new_at_id
-
-                    if cg_fragment.charge_map:
-                        topol_atom.charge = cg_fragment.charge_map[idx]
-                    if cg_fragment.type_map and cg_fragment.type_map[idx] != '*':
-                        topol_atom.atom_type = cg_fragment.type_map[idx]
-                    topol_atom.atom_id = new_at_id
-                    topol_atom.chain_idx = res_id
-                    topol_atom.chain_name = cg_fragment.cg_molecule.ident
-                    topol_atom.cgnr = new_at_id
-                    self.hyb_topology.atoms[new_at_id] = topol_atom
-                    if cg_fragment.cg_molecule.ident not in self.hyb_topology.chains:
-                        self.hyb_topology.chains[cg_fragment.cg_molecule.ident] = {}
-                    if res_id not in self.hyb_topology.chains[cg_fragment.cg_molecule.ident]:
-                        self.hyb_topology.chains[cg_fragment.cg_molecule.ident][res_id] = {}
-                    if topol_atom.name in self.hyb_topology.chains[cg_fragment.cg_molecule.ident][res_id]:
-                        raise RuntimeError(
-                            '{} already defined, please make sure that atom names are unique'.format(topol_atom.name))
-                    self.hyb_topology.chains[cg_fragment.cg_molecule.ident][res_id][topol_atom.name] = topol_atom
-
-                    # Set active sites.
-                    if at.name in cg_fragment.active_sites:
-                        self.cg_active_sites[cg_bead_id].append((new_at_atom, cg_fragment.active_sites[at.name]))
-
-                    self.atom_id2fragment[new_at_id] = cg_fragment
-                    self.atom_ids.append(new_at_id)
-                    self.atom2cg[new_at_id] = cg_bead_id
-                    self.cg2atom[cg_bead_id].append(new_at_id)
-                    self.res2atom[res_id].append(new_at_id)
-
-                    new_at_id += 1
+        with profiling.stage('placement'):
+            residue_tasks = self._assign_fragments(residue_graph)
+            if orient_fragments:
+                self._fit_fragment_rotations(residue_tasks)
+            print('Placing atomistic fragments of {} residues, workers: {}'.format(len(residue_tasks), num_workers))
+            for res_id, placed_beads in self._place_residues(residue_tasks, num_workers):
+                for placed_bead in placed_beads:
+                    self._add_placed_bead(outfile, res_id, placed_bead, self.cg_atomtypes)
+            profiling.count('residues', len(residue_tasks))
+            profiling.count('atoms', len(self.atom_ids))
 
         outfile.box = self.cg_coordinate.box
 
-        # Rebuild hybrid topology.
-        self.rebuild_hybrid_topology()
-        self.hyb_topology.write()
-        # Write the hybrid coordinate file.
-        outfile.write(force=True)
-        # Write only atomistic topology
-        hyb_top = files_io.GROMACSTopologyFile(self.hyb_topology.file_name)
-        hyb_top.read()
-        at_topol = tools.get_atomistic_topology(hyb_top, virtual_atomtypes=cg_atomtypes)
-        at_topol.write('at_{}'.format(self.hyb_topology.file_name))
-
-        # Write the list of bonds, angles and dihedrals to separate files.
-        out_cross_bonds = 'cross_bonds_{}'.format(self.hyb_topology.file_name.replace('.top', '.dat'))
-        out_cross_angles = 'cross_angles_{}'.format(self.hyb_topology.file_name.replace('.top', '.dat'))
-        out_cross_dihedrals = 'cross_dihedrals_{}'.format(self.hyb_topology.file_name.replace('.top', '.dat'))
-        with open(out_cross_bonds, 'w') as outbond:
-            outl = []
-            for k, p in self.at_cross_bonds.items():
-                new_k = map(at_topol.old2new_ids.get, k)
-                if p.typeid:
-                    outl.append([int(p.typeid)] + new_k)
-            outl.sort(key=lambda x: x[0])
-            outbond.write('\n'.join([' '.join(map(str, p)) for p in outl]))
-        print('Saved {}'.format(out_cross_bonds))
-
-        with open(out_cross_angles, 'w') as outbond:
-            outl = []
-            for k, p in self.at_cross_angles.items():
-                new_k = map(at_topol.old2new_ids.get, k)
-                if p.typeid:
-                    outl.append([int(p.typeid)] + new_k)
-            outl.sort(key=lambda x: x[0])
-            outbond.write('\n'.join([' '.join(map(str, p)) for p in outl]))
-        print('Saved {}'.format(out_cross_angles))
-
-        with open(out_cross_dihedrals, 'w') as outbond:
-            outl = []
-            for k, p in self.at_cross_dihedrals.items():
-                new_k = map(at_topol.old2new_ids.get, k)
-                if p.typeid:
-                    outl.append([int(p.typeid)] + new_k)
-            outl.sort(key=lambda x: x[0])
-            outbond.write('\n'.join([' '.join(map(str, p)) for p in outl]))
-        print('Saved {}'.format(out_cross_dihedrals))
-        # Generate exclusion list.
-        self._generate_exclusion_lists()
-
-    def rebuild_hybrid_topology(self):
-        """Regenerate the hybrid topology based on the new particle ids."""
-        # First build coarse-grained topology.
-        def generate_cg_b_list(old_list):
-            if not old_list:
-                return {}
-            return {tuple((map(self.cg_old_new_id.get, k))): v + [' ; cg_bonded'] for k, v in old_list.items()}
-
-        def generate_at_b_list(at):
-            """Generates atomistic list of bonds"""
-            topology = self.atom_id2fragment[at.atom_id].topology
-            bonded_lists = [
-                (2, topology.bonds, 'bonds'),
-                (3, topology.angles, 'angles'),
-                (4, topology.dihedrals, 'dihedrals'),
-                (4, topology.improper_dihedrals, 'dihedrals'),
-                (2, topology.pairs, 'pairs')
-            ]
-            for ternary, top_list, output_name in bonded_lists:
-                for p, params in top_list.items():
-                    old2new_id = self.mol_atomid_map[at.chain_name][at.chain_idx]
+    def _save_checkpoint(self, stage, **data):
+        """Saves the state after the stage if the checkpoints are enabled.
+
+        Args:
+            stage: The name of the stage, from CHECKPOINT_STAGES.
+            data: The local data of the stage, returned by _restore_checkpoint.
+        """
+        if self.checkpoints is None:
+            return
+        # The fragments are stored by their keys and the indexes of their source chains,
+        # with their source files they are read again.
+        fragment_keys = {}
+        fragment_chains = {}
+        for selected_fragment, beads in self.fragments.items():
+            for bead_name, degrees in beads.items():
+                if bead_name == 'cg_molecule':
+                    continue
+                for degree_key, cg_fragment in degrees.items():
+                    fragment_keys[id(cg_fragment)] = (selected_fragment, bead_name, degree_key)
+                    fragment_chains[(selected_fragment, bead_name, degree_key)] = cg_fragment.chain_idx
+        state = {
+            'attrs': {name: getattr(self, name) for name in self._checkpoint_attrs},
+            'fragment_chains': fragment_chains,
+            'atom_id2fragment': {
+                atom_id: fragment_keys[id(cg_fragment)] for atom_id, cg_fragment in self.atom_id2fragment.items()},
+            'hyb_topology': self.hyb_topology.get_parsed_state(),
+            'hybrid_configuration': self.hybrid_configuration['file'].get_parsed_state(),
+            'data': data
+        }
+        self.checkpoints.save(stage, state)
+
+    def _restore_checkpoint(self, state):
+        """Restores the state saved by _save_checkpoint, returns the local data of the stage."""
+        for name, value in state['attrs'].items():
+            setattr(self, name, value)
+        # The fragments take the chains they were placed with, not the ones selected in __init__.
+        for (selected_fragment, bead_name, degree_key), chain_idx in state['fragment_chains'].items():
+            cg_fragment = self.fragments[selected_fragment][bead_name][degree_key]
+            if cg_fragment.chain_idx != chain_idx:
+                cg_fragment.set_chain(chain_idx)
+        self.atom_id2fragment = {
+            atom_id: self.fragments[selected_fragment][bead_name][degree_key]
+            for atom_id, (selected_fragment, bead_name, degree_key) in state['atom_id2fragment'].items()}
+        self.hyb_topology.set_parsed_state(state['hyb_topology'])
+        self.hybrid_configuration['file'].set_parsed_state(state['hybrid_configuration'])
+        return state['data']
+
+    def _assign_fragments(self, residue_graph):
+        """Selects the atomistic fragments of residues and assigns the blocks of new ids.
+
+        The fragment depends only on the name and the degree of the residue and on the names
+        and the degrees of its beads, the signature of the residue. The selection is done once
+        for every signature, by _select_fragments, the residues with the same signature reuse it.
+
+        Returns:
+            The list of residue tasks (res_id, [(cg_id, cg_bead_id, fragment_key)]) in the
+            order of residue ids. The CG bead takes the id cg_bead_id and the atoms of its
+            fragment the following ids. The fragment_key is the key in self.fragments.
+        """
+        # Residue name -> the keys of fragments, in the order of self.fragments.
+        fragment_index = collections.defaultdict(list)
+        for fragment_key in self.fragments:
+            fragment_index[fragment_key[1]].append(fragment_key)
+        selections = {}  # signature -> the list of (fragment_key, number of atoms) of beads
+        new_at_id = 1
+        residue_tasks = []
+        for res_id in sorted(residue_graph.nodes()):
+            residue = residue_graph.node[res_id]
+            cg_nodes = residue['cg_nodes']
+            signature = (residue['chain_name'], residue['degree'], tuple(
+                (self.cg_graph.node[cg_id]['name'], str(self.cg_graph.node[cg_id]['degree'])) for cg_id in cg_nodes))
+            selection = selections.get(signature)
+            if selection is None:
+                selection = selections[signature] = self._select_fragments(
+                    res_id, cg_nodes, signature, fragment_index[residue['chain_name']])
+            beads = []
+            for cg_id, (fragment_key, num_atoms) in zip(cg_nodes, selection):
+                beads.append((cg_id, new_at_id, fragment_key))
+                new_at_id += 1 + num_atoms
+            residue_tasks.append((res_id, beads))
+        print('Assigned fragments of {} residues with {} signatures'.format(len(residue_tasks), len(selections)))
+        profiling.count('signatures', len(selections))
+        return residue_tasks
+
+    def _select_fragments(self, res_id, cg_nodes, signature, fragment_keys):
+        """Selects the fragments of beads of the residue with the signature, see _assign_fragments.
+
+        Args:
+            res_id: The id of the residue, for the error message.
+            cg_nodes: The ids of the CG beads of the residue.
+            signature: The tuple (residue name, residue degree, ((bead name, bead degree), ...)).
+            fragment_keys: The keys of fragments of the residue name.
+
+        Returns:
+            The list of (fragment_key, number of atoms) for every bead.
+        """
+        residue_name, residue_degree, bead_signature = signature
+        possible_fragments = [x for x in fragment_keys if x[0] == '*' or x[0] == residue_degree]
+
+        selected_fragment = None
+        for possible_fragment in possible_fragments:
+            f = self.fragments[possible_fragment]
+            selected_fragment = possible_fragment
+            for bead_name, bead_degree in bead_signature:
+                if bead_degree not in f[bead_name] and '*' not in f[bead_name]:
+                    selected_fragment = None
+            if selected_fragment is not None:
+                break
+        if selected_fragment is None:
+            print('Residue id: {}'.format(res_id))
+            print('Bead ids: {}'.format(cg_nodes))
+            print('Residue degree: {}'.format(residue_degree))
+            print('Residue name: {}'.format(residue_name))
+
+            print(('It is very likely that your .xml file does not'
+                   ' contains definition of a fragment for residue {}').format(residue_name))
+
+            raise RuntimeError(
+                'Problem with the option file, could not find correct fragment for molecule {}'.format(res_id))
+
+        selection = []
+        for bead_name, bead_degree in bead_signature:
+            fragments = self.fragments[selected_fragment][bead_name]
+            degree_key = bead_degree if bead_degree in fragments else '*'
+            cg_fragment = fragments.get(degree_key)
+            if not cg_fragment:
+                raise RuntimeError('Problem with getting atomistic fragments')
+            selection.append(((selected_fragment, bead_name, degree_key), len(cg_fragment.atom_in_fragments)))
+        return selection
+
+    def _fit_fragment_rotations(self, residue_tasks):
+        """Finds the rotations of fragments that fit the neighbouring CG beads in the residue.
+
+        For every CG bead, the vectors to its bonded beads of the same residue are compared
+        with the vectors between the COMs of their fragments in the source coordinates; the
+        rotation of the fragment is the least-squares fit of the directions, computed for all
+        beads at once by tools.kabsch_rotations. The beads without such neighbours keep the
+        orientation of the source coordinates.
+
+        Args:
+            residue_tasks: The residue tasks from _assign_fragments.
+        """
+        bead_fragment_keys = {}
+        for _, beads in residue_tasks:
+            for cg_id, _, fragment_key in beads:
+                bead_fragment_keys[cg_id] = fragment_key
+
+        reference_coms = {}  # (fragment key, fragment key of the neighbour) -> COM of the neighbour
+        bead_ids = []
+        references = []
+        neighbour_ids = []
+        for cg_id, fragment_key in sorted(bead_fragment_keys.items()):
+            res_id = self.cg_graph.node[cg_id]['res_id']
+            cg_fragment = self.fragments[fragment_key[0]][fragment_key[1]][fragment_key[2]]
+            bead_references = []
+            bead_neighbours = []
+            for neighbour_id in self.cg_graph.neighbors(cg_id):
+                if neighbour_id == cg_id or self.cg_graph.node[neighbour_id]['res_id'] != res_id:
+                    continue
+                key = (fragment_key, bead_fragment_keys[neighbour_id])
+                if key not in reference_coms:
+                    neighbour_key = bead_fragment_keys[neighbour_id]
+                    try:
+                        reference_coms[key] = cg_fragment.source_com(
+                            self.fragments[neighbour_key[0]][neighbour_key[1]][neighbour_key[2]])
+                    except KeyError:
+                        reference_coms[key] = None
+                if reference_coms[key] is not None:
+                    bead_references.append(reference_coms[key])
+                    bead_neighbours.append(neighbour_id)
+            if bead_neighbours:
+                bead_ids.append(cg_id)
+                references.append(bead_references)
+                neighbour_ids.append(bead_neighbours)
+        print('Fitting orientation of {} fragments'.format(len(bead_ids)))
+        profiling.count('oriented_fragments', len(bead_ids))
+        if not bead_ids:
+            return
+
+        # The vectors of the beads are padded to the same length, the padding has zero weight.
+        max_neighbours = max(len(x) for x in neighbour_ids)
+        reference = np.zeros((len(bead_ids), max_neighbours, 3))
+        weights = np.zeros((len(bead_ids), max_neighbours))
+        rows = np.repeat(np.arange(len(bead_ids)), [len(x) for x in neighbour_ids])
+        cols = np.concatenate([np.arange(len(x)) for x in neighbour_ids])
+        reference[rows, cols] = np.concatenate(references)
+        weights[rows, cols] = 1.0
+        target = np.zeros_like(reference)
+        positions = self.cg_coordinate.atoms
+        target[rows, cols] = (positions.positions(np.concatenate(neighbour_ids)) -
+                              positions.positions(np.array(bead_ids)[rows]))
+        box = np.asarray(self.cg_coordinate.box, dtype=np.float64)[:3]
+        if (box > 0).all():  # Minimum image of the bonds.
+            target -= box * np.round(target / box)
+
+        # Only the directions are fitted, the CG bonds are not as long as the distances of COMs.
+        for vectors in (reference, target):
+            lengths = np.linalg.norm(vectors, axis=2)
+            lengths[lengths == 0] = 1.0
+            vectors /= lengths[:, :, None]
+        # The small weight of the identity keeps the source orientation around the bond of end beads.
+        rotations = tools.kabsch_rotations(reference, target, weights, identity_weight=0.01)
+        self.fragment_rotations = dict(zip(bead_ids, rotations))
+
+    def _place_residues(self, residue_tasks, num_workers=1):
+        """Places the fragments of residues, yields the results in the order of the tasks.
+
+        The residues are independent, with num_workers > 1 they are placed by the pool
+        of processes. The results do not depend on the number of workers.
+        """
+        if num_workers <= 1 or len(residue_tasks) < 2:
+            for residue_task in residue_tasks:
+                yield self._place_residue(residue_task)
+            return
+        global _placement_settings
+        _placement_settings = self
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            chunk_size = max(1, len(residue_tasks) // (4 * num_workers))
+            for result in pool.imap(_place_residue_worker, residue_tasks, chunk_size):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+            _placement_settings = None
+
+    def _place_residue(self, residue_task):
+        """Creates the atoms of fragments of the residue.
+
+        Returns:
+            The tuple (res_id, placed_beads), for every CG bead the placed_bead is the tuple
+            (cg_id, fragment_key, coordinate atom, topology atom, atoms) and the atoms are
+            the list of (coordinate atom, atom id in the source topology, topology atom).
+        """
+        res_id, beads = residue_task
+        placed_beads = []
+        for cg_id, cg_bead_id, fragment_key in beads:
+            cg_atom = self.cg_coordinate.atoms[cg_id]
+            cg_bead = self.cg_graph.node[cg_id]
+            selected_fragment, bead_name, degree_key = fragment_key
+            cg_fragment = self.fragments[selected_fragment][bead_name][degree_key]
+            chain_name = cg_fragment.cg_molecule.ident  # Chain name from <ident> tag in the cg_molecule
+
+            cg_out_atom = files_io.Atom(
+                atom_id=cg_bead_id,
+                name=cg_bead['name'],
+                chain_name=chain_name,
+                chain_idx=res_id,
+                position=cg_atom.position
+            )
+            # Change the mass of CG bead
+            cg_topol_atom = copy.copy(self.cg_topology.atoms[cg_id])
+            cg_topol_atom.mass = cg_fragment.cg_mass
+            cg_topol_atom.atom_id = cg_bead_id
+            cg_topol_atom.chain_idx = res_id
+            cg_topol_atom.chain_name = chain_name
+            cg_topol_atom.cgnr = cg_bead_id
+
+            # Set the atomistic coordinates for this fragment.
+            cg_com = cg_atom.position
+            at_positions = [at.position for at in cg_fragment.atom_in_fragments]
+            rotation = self.fragment_rotations.get(cg_id)
+            if rotation is not None:
+                at_positions = np.dot(at_positions, rotation.T)
+            atoms = []
+            for idx, at in enumerate(cg_fragment.atom_in_fragments):
+                new_at_id = cg_bead_id + 1 + idx
+                new_at_atom = files_io.Atom(new_at_id, at.name, chain_name, res_id, at_positions[idx] + cg_com)
+                source_atom = cg_fragment.topology.chain_atom_names[at.chain_name][at.name][0]
+                topol_atom = copy.copy(source_atom)
+                if cg_fragment.charge_map:
+                    topol_atom.charge = cg_fragment.charge_map[idx]
+                if cg_fragment.type_map and cg_fragment.type_map[idx] != '*':
+                    topol_atom.atom_type = cg_fragment.type_map[idx]
+                topol_atom.atom_id = new_at_id
+                topol_atom.chain_idx = res_id
+                topol_atom.chain_name = chain_name
+                topol_atom.cgnr = new_at_id
+                atoms.append((new_at_atom, source_atom.atom_id, topol_atom))
+            placed_beads.append((cg_id, fragment_key, cg_out_atom, cg_topol_atom, atoms))
+        return res_id, placed_beads
+
+    def _add_topology_atom(self, res_id, topol_atom):
+        """Adds the atom to the hybrid topology and its chains."""
+        self.hyb_topology.atoms[topol_atom.atom_id] = topol_atom
+        if topol_atom.chain_name not in self.hyb_topology.chains:
+            self.hyb_topology.chains[topol_atom.chain_name] = {}
+        if res_id not in self.hyb_topology.chains[topol_atom.chain_name]:
+            self.hyb_topology.chains[topol_atom.chain_name][res_id] = {}
+        if topol_atom.name in self.hyb_topology.chains[topol_atom.chain_name][res_id]:
+            raise RuntimeError(
+                '{} already defined, please make sure that atom names are unique'.format(topol_atom.name))
+        self.hyb_topology.chains[topol_atom.chain_name][res_id][topol_atom.name] = topol_atom
+
+    def _add_placed_bead(self, outfile, res_id, placed_bead, cg_atomtypes):
+        """Puts the CG bead and its atoms from _place_residue in the output files and the maps."""
+        cg_id, fragment_key, cg_out_atom, cg_topol_atom, atoms = placed_bead
+        selected_fragment, bead_name, degree_key = fragment_key
+        cg_fragment = self.fragments[selected_fragment][bead_name][degree_key]
+        cg_bead_id = cg_out_atom.atom_id
+        chain_name = cg_fragment.cg_molecule.ident
+
+        outfile.atoms[cg_bead_id] = cg_out_atom
+        self.cg_new_id_old[cg_bead_id] = cg_id
+        self.cg_old_new_id[cg_id] = cg_bead_id
+
+        self.atom_id2fragment[cg_bead_id] = cg_fragment
+        self.res_fragment_keys[res_id].append(fragment_key)
+
+        self.global_graph.add_node(cg_bead_id, **self.cg_graph.node[cg_id])
+
+        self._add_topology_atom(res_id, cg_topol_atom)
+        cg_atomtypes.append(cg_topol_atom.atom_type)
+
+        for new_at_atom, source_atom_id, topol_atom in atoms:
+            new_at_id = new_at_atom.atom_id
+            outfile.atoms[new_at_id] = new_at_atom
+            self.global_graph.add_node(
+                new_at_id,
+                name=new_at_atom.name,
+                res_id=res_id,
+                position=new_at_atom.position.copy(),
+                chain_name=chain_name)
+
+            # Set topology atom
+            if res_id not in self.mol_atomid_map[chain_name]:
+                self.mol_atomid_map[chain_name][res_id] = {}
+                self.mol_atomname_map[chain_name][res_id] = {}
+            self.mol_atomid_map[chain_name][res_id][source_atom_id] = new_at_id
+            self.mol_atomname_map[chain_name][res_id][topol_atom.name] = new_at_id
+
+            self._add_topology_atom(res_id, topol_atom)
+
+            # Set active sites.
+            if new_at_atom.name in cg_fragment.active_sites:
+                self.cg_active_sites[cg_bead_id].append((new_at_atom, cg_fragment.active_sites[new_at_atom.name]))
+
+            self.atom_id2fragment[new_at_id] = cg_fragment
+            self.atom_ids.append(new_at_id)
+            self.atom2cg[new_at_id] = cg_bead_id
+            self.cg2atom[cg_bead_id].append(new_at_id)
+            self.res2atom[res_id].append(new_at_id)
+
+    def _build_residue_terms(self, res_id):
+        """Collects the bonded terms of atoms of the residue from the topologies of their fragments.
+
+        Returns:
+            The dict with BondedTerms, by the name of the output section. The terms with atoms
+            in different CG beads are in the cross sections.
+        """
+        residue_terms = collections.OrderedDict()
+        # The terms of a fragment topology are listed once for all its atoms.
+        topology_terms = {}
+        for at_id in self.res2atom[res_id]:
+            at = self.hyb_topology.atoms[at_id]
+            topology = self.atom_id2fragment[at_id].topology
+            bonded_lists = topology_terms.get(topology)
+            if bonded_lists is None:
+                bonded_lists = topology_terms[topology] = [
+                    (topology.bonds.items(), 'bonds'),
+                    (topology.angles.items(), 'angles'),
+                    (topology.dihedrals.items(), 'dihedrals'),
+                    (topology.improper_dihedrals.items(), 'dihedrals'),
+                    (topology.pairs.items(), 'pairs')
+                ]
+            old2new_id = self.mol_atomid_map[at.chain_name][at.chain_idx]
+            for top_list, output_name in bonded_lists:
+                for p, params in top_list:
                     new_tuple = tuple(map(old2new_id.get, p))
 
                     # Skip the terms that involves the missing atoms. The atoms can be missing because of
                     # the degree dependent atomistic fragments.
-                    if None not in new_tuple and at.atom_id in new_tuple:  # correct pair
+                    if None not in new_tuple and at_id in new_tuple:  # correct pair
                         cg_beads = map(self.atom2cg.get, new_tuple)
                         if cg_beads.count(cg_beads[0]) == len(cg_beads):  # Atoms in the same CG bead
                             out_name = output_name
                         else:
                             out_name = '{}{}'.format(self.cross_prefix, output_name)
-                        self.hyb_topology.new_data[out_name][new_tuple] = params
+                        if out_name not in residue_terms:
+                            residue_terms[out_name] = files_io.BondedTerms(
+                                param_table=self.hyb_topology.param_table)
+                        residue_terms[out_name][new_tuple] = params
+        return residue_terms
+
+    def _get_residue_terms_template(self, res_id):
+        """Returns the template of bonded terms of the residue.
+
+        The residues with the same fragments have the same atoms and terms, shifted by the
+        id of their first atom. The template is built from the first such residue.
+
+        Returns:
+            The list of (out_name, term_ids, param_ids), the term_ids are relative
+            to the first atom of the residue.
+        """
+        fragment_keys = tuple(self.res_fragment_keys[res_id])
+        template = self.residue_terms_templates.get(fragment_keys)
+        if template is None:
+            first_at_id = self.res2atom[res_id][0]
+            template = []
+            for out_name, residue_terms in self._build_residue_terms(res_id).items():
+                term_ids, param_ids = residue_terms.arrays()
+                template.append((out_name, term_ids - first_at_id, param_ids))
+            self.residue_terms_templates[fragment_keys] = template
+        return template
+
+    @profiling.profile_stage('rebuild')
+    def rebuild_hybrid_topology(self, resume_stage=None, resume_data=None):
+        """Regenerate the hybrid topology based on the new particle ids.
+
+        Args:
+            resume_stage: The stage of the restored checkpoint, the stages up to it are skipped.
+            resume_data: The local data of the stage of the restored checkpoint.
+        """
+        if resume_stage in (None, 'placement'):
+            self._renumber_terms()
+            self._save_checkpoint('cg_terms')
+
+        if resume_stage == 'cross_bonds':
+            at_cross_bonds = resume_data['at_cross_bonds']
+            atoms_to_remove = resume_data['atoms_to_remove']
+        else:
+            cg_cross_bonds = self._find_cg_cross_bonds()
+            print('Found {} bonds between coarse-grained beads'.format(len(cg_cross_bonds)))
+            print('Generating atomistic cross-bonds between coarse-grained beads; It will take a while...')
+            # Create the atomistic bonds across the coarse-grained beads.
+            # We iterate over bonds in cg_graph and then generate the bonds.
+            # At the level of topology, CG bonds are already defined.
+            at_cross_bonds, atoms_to_remove = self._create_cross_bonds(cg_cross_bonds)
+            self._save_checkpoint('cross_bonds', at_cross_bonds=at_cross_bonds, atoms_to_remove=atoms_to_remove)
+
+        # Generate entries for AT cross bonds.
+        print('Found {} atomistic cross bonds'.format(len(at_cross_bonds)))
+        self._generate_atomistic_bonds(at_cross_bonds)
+        self._remove_atomistic_particles(set(atoms_to_remove))
+
+    def _renumber_terms(self):
+        """Puts the renumbered CG terms and the terms of atomistic fragments in the hybrid topology."""
+        # First build coarse-grained topology.
+        def generate_cg_b_list(old_list):
+            if not old_list:
+                return {}
+            return {tuple((map(self.cg_old_new_id.get, k))): v + [' ; cg_bonded'] for k, v in old_list.items()}
 
         print('Renumering atomistic and coarse-grained bonds')
         self.hyb_topology.new_data['{}bonds'.format(self.cross_prefix)] = generate_cg_b_list(
@@ -706,16 +1321,20 @@ class BackmapperSettings2:
         self.hyb_topology.new_data['{}dihedrals'.format(self.cross_prefix)].update(
             generate_cg_b_list(self.cg_topology.improper_dihedrals))
 
-        # Create the atomistic topology.
-        for atid in self.atom_ids:
-            generate_at_b_list(self.hyb_topology.atoms[atid])
+        # Create the atomistic topology, the terms of every residue from the template of its fragments.
+        for res_id in sorted(self.res2atom, key=lambda x: self.res2atom[x][0]):
+            first_at_id = self.res2atom[res_id][0]
+            for out_name, term_ids, param_ids in self._get_residue_terms_template(res_id):
+                self.hyb_topology.new_data[out_name].add_coded(term_ids + first_at_id, param_ids)
+        profiling.count('residues', len(self.res2atom))
 
         for (b1, b2), params in self.hyb_topology.new_data['{}bonds'.format(self.cross_prefix)].items():
             self.global_graph.add_edge(b1, b2)
         for (b1, b2), params in self.hyb_topology.new_data['bonds'].items():
             self.global_graph.add_edge(b1, b2)
 
-        # Generate list of CG bonds that are not defined at AT level
+    def _find_cg_cross_bonds(self):
+        """Returns the set of CG bonds that are not defined at the AT level."""
         cg_cross_bonds = set()
         for b1, b2 in self.global_graph.edges():
             if b1 in self.cg_new_id_old and b2 in self.cg_new_id_old:  # Look only on CG bonds
@@ -730,12 +1349,15 @@ class BackmapperSettings2:
                         break
                 if not is_connected:
                     cg_cross_bonds.add(tuple(sorted([b1, b2])))
+        return cg_cross_bonds
+
+    @profiling.profile_stage('cross_bonds')
+    def _create_cross_bonds(self, cg_cross_bonds):
+        """Selects the active sites of the CG bonds that are not defined at the AT level.
 
-        print('Found {} bonds between coarse-grained beads'.format(len(cg_cross_bonds)))
-        print('Generating atomistic cross-bonds between coarse-grained beads; It will take a while...')
-        # Create the atomistic bonds across the coarse-grained beads.
-        # We iterate over bonds in cg_graph and then generate the bonds.
-        # At the level of topology, CG bonds are already defined.
+        Returns:
+            The list of atomistic cross bonds and the list of atoms to remove.
+        """
         at_cross_bonds = []
         atoms_to_remove = []
         charge_to_transfer = []
@@ -802,10 +1424,24 @@ class BackmapperSettings2:
             sys.stdout.write('{} %\r'.format(100.0*(progress_indc/progress_indc_total)))
             progress_indc += 1.0
 
-        # Generate entries for AT cross bonds.
-        print('Found {} atomistic cross bonds'.format(len(at_cross_bonds)))
-        self._generate_atomistic_bonds(at_cross_bonds)
-        self._remove_atomistic_particles(set(atoms_to_remove))
+        profiling.count('cg_cross_bonds', len(cg_cross_bonds))
+        profiling.count('at_cross_bonds', len(at_cross_bonds))
+        profiling.count('atoms_to_remove', len(atoms_to_remove))
+        return at_cross_bonds, atoms_to_remove
+
+    def _remove_graph_nodes(self, node_ids, global_degree):
+        """Removes the nodes from the global graph and updates the degree of their neighbours.
+
+        Args:
+            node_ids: The list of nodes to remove.
+            global_degree: The dict with the degree of nodes, updated in place.
+        """
+        for node_id in node_ids:
+            for neighbour_id in self.global_graph[node_id]:
+                if neighbour_id != node_id:
+                    global_degree[neighbour_id] -= 1
+            del global_degree[node_id]
+            self.global_graph.remove_node(node_id)
 
     def _get_predefined_active_sites(self, b1, b2, global_degree, atoms_to_remove):
         """Look for correct active sites for CG bonds b1-b2."""
@@ -875,9 +1511,7 @@ class BackmapperSettings2:
                 # connected to this atom if in settings the set of atoms to remove were defined.
                 ats1, ats2 = at1, at2   # Pair of selected atoms.
                 atoms_to_remove.extend(tmp_atoms_to_remove)
-                for ai in tmp_atoms_to_remove:
-                    self.global_graph.remove_node(ai)
-                global_degree = dict(self.global_graph.degree())
+                self._remove_graph_nodes(tmp_atoms_to_remove, global_degree)
             else:
                 print('{b1}({b1id})-{b2}({b2id}) deg1:{deg1} < {max_d1} deg2:{deg2} < {max_d2} valid: {valid}'.format(
                     deg1=at1_deg, deg2=at2_deg, b1=b1_key, b2=b2_key, max_d1=max_d1, max_d2=max_d2, valid=valid,
@@ -891,70 +1525,95 @@ class BackmapperSettings2:
 
         return ats1, ats2, global_degree
 
+    def _get_active_site_labels(self, cg_bead_id):
+        """Returns the tuple with integer labels of active sites of the CG bead."""
+        labels = self.bead_active_site_labels.get(cg_bead_id)
+        if labels is None:
+            labels = tuple([
+                self.active_site_labels.setdefault((at.chain_name, at.name), len(self.active_site_labels))
+                for at, _ in self.cg_active_sites[cg_bead_id]])
+            self.bead_active_site_labels[cg_bead_id] = labels
+        return labels
+
+    def _get_active_site_pairs(self, b1, b2):
+        """Returns the pairs of active sites of CG beads b1-b2 that have the bond parameters.
+
+        The pairs are computed once for every pair of the lists of active sites and are
+        in the order of the search: (index in b1 list, index in b2 list, b1 key, b2 key).
+        """
+        pair_type = (self._get_active_site_labels(b1), self._get_active_site_labels(b2))
+        pairs = self.active_site_pairs.get(pair_type)
+        if pairs is None:
+            pairs = []
+            for idx1, (at1, _) in enumerate(self.cg_active_sites[b1]):
+                for idx2, (at2, _) in enumerate(self.cg_active_sites[b2]):
+                    b1_key = '{}:{}'.format(at1.chain_name, at1.name)
+                    b2_key = '{}:{}'.format(at2.chain_name, at2.name)
+                    test_bond = self.bond_params.get((b1_key, b2_key))
+                    if not test_bond:
+                        test_bond = self.bond_params.get((at1.name, at2.name))
+                    if test_bond:
+                        pairs.append((idx1, idx2, b1_key, b2_key))
+                    else:
+                        print('Params for {}-{} not found'.format(b1_key, b2_key))
+            self.active_site_pairs[pair_type] = pairs
+        return pairs
+
     def _search_active_sites(self, b1, b2, global_degree, atoms_to_remove):
         """Look for correct active sites for CG bonds b1-b2."""
         ats1, ats2 = None, None
-        for at1, max_d1 in self.cg_active_sites[b1]:
-            for at2, max_d2 in self.cg_active_sites[b2]:
-                b1_key = '{}:{}'.format(at1.chain_name, at1.name)
-                b2_key = '{}:{}'.format(at2.chain_name, at2.name)
-                test_bond = self.bond_params.get((b1_key, b2_key))
-                if not test_bond:
-                    test_bond = self.bond_params.get((at1.name, at2.name))
-                if (test_bond and self.global_graph.has_node(at1.atom_id)
-                        and self.global_graph.has_node(at2.atom_id)):
-                    at1_deg = global_degree[at1.atom_id]
-                    at2_deg = global_degree[at2.atom_id]
-                    at_remove1 = self.atom_id2fragment[b1].active_sites_remove_map.get(b1_key)
-                    at_remove2 = self.atom_id2fragment[b2].active_sites_remove_map.get(b2_key)
-                    tmp_atoms_to_remove = []
-                    valid = True
-                    # Before we check the degree, let's first try to remove atoms (if they are defined to
-                    # remove and after that compare the degree.
-                    if at_remove1:
-                        for atr1 in at_remove1:
-                            atr_chain_name, atr_name = atr1.split(':')[1], atr1.split(':')[2]
-                            atr1_id = self.mol_atomname_map[atr_chain_name][at1.chain_idx][atr_name]
-                            if not self.global_graph.has_node(atr1_id):
-                                valid = False
-                                break
-                            tmp_atoms_to_remove.append(atr1_id)
-                            if self.global_graph.has_edge(atr1_id, at1.atom_id):
-                                at1_deg -= 1
-                    if at_remove2 and valid:
-                        for atr2 in at_remove2:
-                            atr_chain_name, atr_name = atr2.split(':')[1], atr2.split(':')[2]
-                            atr2_id = self.mol_atomname_map[atr_chain_name][at2.chain_idx][atr_name]
-                            if not self.global_graph.has_node(atr2_id):
-                                valid = False
-                                break
-                            tmp_atoms_to_remove.append(atr2_id)
-                            if self.global_graph.has_edge(atr2_id, at2.atom_id):
-                                at2_deg -= 1
-
-                    # Check the degree after update with virtual removing of atoms.
-                    if at1_deg < max_d1 and at2_deg < max_d2 and valid:
-                        # Found correct pair of active sites. Remove the atoms that were
-                        # connected to this atom if in settings the set of atoms to remove were defined.
-                        ats1, ats2 = at1, at2   # Pair of selected atoms.
-                        atoms_to_remove.extend(tmp_atoms_to_remove)
-                        for ai in tmp_atoms_to_remove:
-                            self.global_graph.remove_node(ai)
-                        global_degree = dict(self.global_graph.degree())
-                        break
-                    else:
-                        print('{b1}({b1id})-{b2}({b2id}) deg1:{deg1} < {max_d1} deg2:{deg2} < {max_d2} valid: {valid}'.format(
-                            deg1=at1_deg, deg2=at2_deg, b1=b1_key, b2=b2_key, max_d1=max_d1, max_d2=max_d2, valid=valid,
-                            b1id=b1, b2id=b2
-                        ))
+        active_sites1 = self.cg_active_sites[b1]
+        active_sites2 = self.cg_active_sites[b2]
+        for idx1, idx2, b1_key, b2_key in self._get_active_site_pairs(b1, b2):
+            at1, max_d1 = active_sites1[idx1]
+            at2, max_d2 = active_sites2[idx2]
+            if self.global_graph.has_node(at1.atom_id) and self.global_graph.has_node(at2.atom_id):
+                at1_deg = global_degree[at1.atom_id]
+                at2_deg = global_degree[at2.atom_id]
+                at_remove1 = self.atom_id2fragment[b1].active_sites_remove_map.get(b1_key)
+                at_remove2 = self.atom_id2fragment[b2].active_sites_remove_map.get(b2_key)
+                tmp_atoms_to_remove = []
+                valid = True
+                # Before we check the degree, let's first try to remove atoms (if they are defined to
+                # remove and after that compare the degree.
+                if at_remove1:
+                    for atr1 in at_remove1:
+                        atr_chain_name, atr_name = atr1.split(':')[1], atr1.split(':')[2]
+                        atr1_id = self.mol_atomname_map[atr_chain_name][at1.chain_idx][atr_name]
+                        if not self.global_graph.has_node(atr1_id):
+                            valid = False
+                            break
+                        tmp_atoms_to_remove.append(atr1_id)
+                        if self.global_graph.has_edge(atr1_id, at1.atom_id):
+                            at1_deg -= 1
+                if at_remove2 and valid:
+                    for atr2 in at_remove2:
+                        atr_chain_name, atr_name = atr2.split(':')[1], atr2.split(':')[2]
+                        atr2_id = self.mol_atomname_map[atr_chain_name][at2.chain_idx][atr_name]
+                        if not self.global_graph.has_node(atr2_id):
+                            valid = False
+                            break
+                        tmp_atoms_to_remove.append(atr2_id)
+                        if self.global_graph.has_edge(atr2_id, at2.atom_id):
+                            at2_deg -= 1
+
+                # Check the degree after update with virtual removing of atoms.
+                if at1_deg < max_d1 and at2_deg < max_d2 and valid:
+                    # Found correct pair of active sites. Remove the atoms that were
+                    # connected to this atom if in settings the set of atoms to remove were defined.
+                    ats1, ats2 = at1, at2   # Pair of selected atoms.
+                    atoms_to_remove.extend(tmp_atoms_to_remove)
+                    self._remove_graph_nodes(tmp_atoms_to_remove, global_degree)
+                    break
                 else:
-                    print('Params for {}-{} not found'.format(b1_key, b2_key))
-            if ats1 is not None and ats2 is not None:
-                # Found active sites, break the for at1, for at2 loops
-                break
+                    print('{b1}({b1id})-{b2}({b2id}) deg1:{deg1} < {max_d1} deg2:{deg2} < {max_d2} valid: {valid}'.format(
+                        deg1=at1_deg, deg2=at2_deg, b1=b1_key, b2=b2_key, max_d1=max_d1, max_d2=max_d2, valid=valid,
+                        b1id=b1, b2id=b2
+                    ))
 
         return ats1, ats2, global_degree
 
+    @profiling.profile_stage('terms')
     def _generate_atomistic_bonds(self, at_cross_bonds):
         """Generates parameters for atomistic bonds."""
         fout_filename = 'missing_definitions.txt'
@@ -965,7 +1624,9 @@ class BackmapperSettings2:
         angle_key = '{}angles'.format(self.cross_prefix)
         dihedral_key = '{}dihedrals'.format(self.cross_prefix)
 
-        for b1, b2 in at_cross_bonds:
+        # Angles and dihedrals around the new bonds, the graph does not change in the loop.
+        bonded_tuples = tools.gen_bonded_tuples_many(self.global_graph, [3, 4], at_cross_bonds)
+        for (b1, b2), (triplets, quadruplets) in zip(at_cross_bonds, bonded_tuples):
             n1 = self.global_graph.node[b1]
             n2 = self.global_graph.node[b2]
             b1_key = n1_key = '{}:{}'.format(n1['chain_name'], n1['name'])
@@ -982,8 +1643,6 @@ class BackmapperSettings2:
             self.hyb_topology.new_data[bond_key][(b1, b2)] = param.params
             self.at_cross_bonds[(b1, b2)] = param
             # Generate angles.
-            triplets = tools.gen_bonded_tuples(self.global_graph, 3, (b1, b2))
-            quadruplets = tools.gen_bonded_tuples(self.global_graph, 4, (b1, b2))
             for triplet in triplets:
                 n1_key, n2_key, n3_key = [
                     '{}:{}'.format(x['chain_name'], x['name'])
@@ -1029,53 +1688,110 @@ class BackmapperSettings2:
         fout.writelines('\n'.join([' '.join(map(str, x)) for x in sorted(missing_definitions, key=lambda l: len(l))]))
         print('Wrote missing definitions in {}'.format(fout_filename))
         fout.close()
+        profiling.count('cross_angles', len(self.at_cross_angles))
+        profiling.count('cross_dihedrals', len(self.at_cross_dihedrals))
+        profiling.count('missing_definitions', len(missing_definitions))
 
+    @profiling.profile_stage('removal')
     def _remove_atomistic_particles(self, atoms_to_remove):
         """Update coordinate and topology file by removing atoms and renumbering"""
         if atoms_to_remove:
             print('Clean up atomistic particles after creating bonds, atoms to remove: {}'.format(len(atoms_to_remove)))
-            self.hyb_topology.remove_atoms(atoms_to_remove, renumber=False)
-            self.hybrid_configuration['file'].remove_atoms(atoms_to_remove, renumber=False)
-            # Renumber data files
-            self.hyb_topology.renumber()
-            self.hybrid_configuration['file'].renumber()
-
-    def _generate_exclusion_lists(self):
-        # Collect all bonds and greate global_graph again...
-        at_g = networkx.Graph()
-        cg_g = networkx.Graph()
-
-        bonds = [b for b in self.hyb_topology.bonds.keys()
-                 if b[0] in self.atom_ids and b[1] in self.atom_ids]
+            # Removes and renumbers in one pass over the data.
+            self.hyb_topology.remove_atoms(atoms_to_remove, renumber=True)
+            self.hybrid_configuration['file'].remove_atoms(atoms_to_remove, renumber=True)
+            self.removed_atom_ids = set(atoms_to_remove)
+        profiling.count('atoms_removed', len(atoms_to_remove))
+
+    @profiling.profile_stage('overlaps')
+    def report_overlaps(self, cutoff, file_name=None):
+        """Writes the per-residue report of the atoms of the hybrid configuration placed too close.
+
+        The pairs of atomistic particles closer than the cutoff are found by tools.find_close_pairs,
+        the pairs excluded by the atomistic bonds (nrexcl of the hybrid topology) are skipped.
+        Every residue with overlaps is one line of the report, with the number of overlapping
+        pairs, the shortest distance and the closest pair of atoms.
+
+        Args:
+            cutoff: The distance below which the atoms overlap, in nm.
+            file_name: The name of the report, by default overlaps_<hybrid topology>.dat.
+
+        Returns:
+            The number of overlapping pairs.
+        """
+        if file_name is None:
+            file_name = 'overlaps_{}.dat'.format(self.hyb_topology.file_name.split('.')[0])
+        outfile = self.hybrid_configuration['file']
+        # The atoms were renumbered after the removal, in the order of the old ids.
+        old_ids = sorted((set(self.cg_new_id_old) | set(self.atom2cg)) - self.removed_atom_ids)
+        atom_ids = np.array([new_id for new_id, old_id in enumerate(old_ids, 1) if old_id in self.atom2cg],
+                            dtype=np.int64)
+        at = outfile.atoms.columns(atom_ids)
+        is_atom = np.zeros(len(old_ids) + 1, dtype=bool)
+        is_atom[atom_ids] = True
+
+        i, j, distance = tools.find_close_pairs(at.position, outfile.box, cutoff)
+        i, j = atom_ids[i], atom_ids[j]
+        bonds = list(self.hyb_topology.bonds.keys())
         for k in self.hyb_topology.new_data:
             if 'bonds' in k:
-                bonds.extend([b for b in self.hyb_topology.new_data[k]
-                              if b[0] in self.atom_ids and b[1] in self.atom_ids])
-        at_g.add_edges_from(bonds)
-
-        bonds = [b for b in self.hyb_topology.bonds.keys() if b[0] in self.cg2atom and b[1] in self.cg2atom]
+                bonds.extend(self.hyb_topology.new_data[k])
+        at_graph = tools.CompactAdjacency([b for b in bonds if is_atom[b[0]] and is_atom[b[1]]])
+        excl_at = int(self.hyb_topology.moleculetype['excl_at'])
+        overlap = ~at_graph.within(i, j, excl_at)
+        i, j, distance = i[overlap], j[overlap], distance[overlap]
+
+        # The pair counts in the residues of both atoms.
+        res_ids = outfile.atoms.columns(np.concatenate((i, j))).chain_idx
+        residues = {}
+        for res_id, pair_distance, at1, at2 in zip(
+                res_ids.tolist(), np.tile(distance, 2).tolist(),
+                np.concatenate((i, j)).tolist(), np.concatenate((j, i)).tolist()):
+            report = residues.get(res_id)
+            if report is None:
+                report = residues[res_id] = [0, pair_distance, at1, at2]
+            report[0] += 1
+            if pair_distance < report[1]:
+                report[1:] = [pair_distance, at1, at2]
+        names = outfile.atoms.columns(outfile.atoms.keys_array())
+        id2name = dict(zip(names.atom_id.tolist(), names.name))
+        id2chain = dict(zip(names.atom_id.tolist(), names.chain_name))
+        with open(file_name, 'w') as report_file:
+            report_file.write('# Atomistic pairs closer than {} nm, not excluded (nrexcl={})\n'.format(
+                cutoff, excl_at))
+            report_file.write('# res_id chain_name num_pairs min_distance atom_id1 atom_name1 atom_id2 atom_name2\n')
+            for res_id in sorted(residues):
+                num_pairs, min_distance, at1, at2 = residues[res_id]
+                report_file.write('{} {} {} {:.4f} {} {} {} {}\n'.format(
+                    res_id, id2chain[at1], num_pairs, min_distance, at1, id2name[at1], at2, id2name[at2]))
+        print('Found {} overlapping pairs (< {} nm) in {} residues, report saved in {}'.format(
+            len(distance), cutoff, len(residues), file_name))
+        profiling.count('overlaps', len(distance))
+        profiling.count('residues', len(residues))
+        return len(distance)
+
+    @profiling.profile_stage('exclusions')
+    def _generate_exclusion_lists(self, num_workers=1, shard_size=20000):
+        """Generates the list of exclusions of the atomistic and of the coarse-grained bonds.
+
+        Args:
+            num_workers: The number of processes that search the graphs.
+            shard_size: The number of source nodes searched at once, see tools.write_exclusions.
+        """
+        atom_ids = set(self.atom_ids)
+        bonds = list(self.hyb_topology.bonds.keys())
         for k in self.hyb_topology.new_data:
             if 'bonds' in k:
-                bonds.extend([b for b in self.hyb_topology.new_data[k] if b[0] in self.cg2atom and b[1] in self.cg2atom])
-        cg_g.add_edges_from(bonds)
-
-        print('Generating exclusion lists AT, nrexcl={}'.format(self.hyb_topology.moleculetype['excl_at']))
-        paths = dict(networkx.all_pairs_shortest_path(at_g, int(self.hyb_topology.moleculetype['excl_at'])))
-        exclusions = set()
-        for l in paths.values():
-            for p in l.values():
-                if len(p) > 1:
-                    exclusions.add(tuple(sorted([p[0], p[-1]])))
-
-        print('Generating exclusion lists CG, nrexcl={}'.format(self.hyb_topology.moleculetype['excl_cg']))
-        paths = dict(networkx.all_pairs_shortest_path(cg_g, int(self.hyb_topology.moleculetype['excl_cg'])))
-        for l in paths.values():
-            for p in l.values():
-                if len(p) > 1:
-                    exclusions.add(tuple(sorted([p[0], p[-1]])))
-
+                bonds.extend(self.hyb_topology.new_data[k])
+        at_graph = tools.CompactAdjacency([b for b in bonds if b[0] in atom_ids and b[1] in atom_ids])
+        cg_graph = tools.CompactAdjacency([b for b in bonds if b[0] in self.cg2atom and b[1] in self.cg2atom])
+        excl_at = int(self.hyb_topology.moleculetype['excl_at'])
+        excl_cg = int(self.hyb_topology.moleculetype['excl_cg'])
+
+        print('Generating exclusion lists AT nrexcl={}, CG nrexcl={}, workers: {}'.format(
+            excl_at, excl_cg, num_workers))
         output_filename = 'exclusion_{}.list'.format(self.hyb_topology.file_name.split('.')[0])
-        out_file = open(output_filename, 'w')
-        out_file.writelines('\n'.join(['{} {}'.format(*d) for d in sorted(exclusions)]))
-        out_file.close()
-        print('Generated {} exclusions, writen to {}'.format(len(exclusions), output_filename))
+        num_exclusions = tools.write_exclusions(
+            output_filename, [(at_graph, excl_at), (cg_graph, excl_cg)], num_workers, shard_size)
+        print('Generated {} exclusions, writen to {}'.format(num_exclusions, output_filename))
+        profiling.count('exclusions', num_exclusions)
@@ -0,0 +1,56 @@
+"""
+Copyright (C) 2016 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is part of Backmapper.
+
+Backmapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import backmapping
+import files_io
+import numpy
+
+
+class CenterOfMassMapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.positions = numpy.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [1.0, 2.0, 0.0]])
+        fragments = {'MOL': {
+            'C{}'.format(at_id): files_io.Atom(at_id, 'C{}'.format(at_id), 'MOL', 1, self.positions[at_id - 1])
+            for at_id in range(1, 4)}}
+        mass_map = collections.OrderedDict([
+            ('A', collections.OrderedDict([('1:MOL:C1', 1.0), ('1:MOL:C2', 3.0)])),
+            ('B', {'1:MOL:C3': 12.0})])
+        self.com_map = backmapping.CenterOfMassMap.from_mass_map(mass_map, fragments)
+
+    def test_com(self):
+        self.assertEqual(self.com_map.bead_names, ['A', 'B'])
+        self.assertEqual(self.com_map.com(self.positions).tolist(), [[0.75, 0.0, 0.0], [1.0, 2.0, 0.0]])
+
+    def test_frames(self):
+        frames = [files_io.GROFrame('frame', numpy.concatenate([self.positions, self.positions + shift]), None)
+                  for shift in (0.0, 1.0)]
+        tiled_map = self.com_map.tile(2, 3)
+        self.assertEqual(tiled_map.bead_names, ['A', 'B', 'A', 'B'])
+        coms = list(tiled_map.map_frames(frames))
+        self.assertEqual(coms[0].tolist(), [[0.75, 0.0, 0.0], [1.0, 2.0, 0.0]] * 2)
+        self.assertEqual(coms[1][2:].tolist(), [[1.75, 1.0, 1.0], [2.0, 3.0, 1.0]])
+        self.assertRaises(RuntimeError, backmapping.CenterOfMassMap, ['A'], [1], [0.0], [0])
@@ -17,8 +17,11 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import collections
+import shutil
 import sys
 import os
+import tempfile
 import unittest
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -150,7 +153,430 @@ class GROFileTestCase(unittest.TestCase):
         gro_file.box = (10, 10, 10)
 
         system = System()
-        self.assertEquals(gro_file.atoms[3].position, (2, 2, 2))
+        self.assertEquals(gro_file.atoms[3].position.tolist(), [2, 2, 2])
         gro_file.update_positions(system)
         print(gro_file.atoms[3].position)
         self.assertItemsEqual(gro_file.atoms[3].position, [33, 33, 33])
+
+    def test_update_position_snapshot(self):
+        gro_file = files_io.GROFile('abc.gro')
+        for at_id in [1, 2, 3]:
+            gro_file.atoms[at_id] = files_io.Atom(
+                atom_id=at_id,
+                name='A{}'.format(at_id),
+                chain_name='MOL',
+                chain_idx=1,
+                position=(0, 0, 0)
+            )
+        gro_file.box = (10, 10, 10)
+        sub_gro = files_io.GROFile.copy(gro_file, particle_ids=[2, 3], renumber=True)
+
+        snapshot = files_io.ParticleSnapshot.take(System(), gro_file.particle_ids())
+        self.assertEqual(len(snapshot), 3)
+        gro_file.update_positions(System(), snapshot=snapshot)
+        sub_gro.update_positions(System(), unfolded=False, snapshot=snapshot)
+        self.assertEqual(gro_file.atoms[3].position.tolist(), [33, 33, 33])
+        self.assertEqual(sub_gro.atoms[1].position.tolist(), [2, 2, 2])
+        self.assertEqual(sub_gro.atoms[2].position.tolist(), [3, 3, 3])
+        self.assertRaises(KeyError, snapshot.positions, [4])
+
+
+GRO_CONTENT = """Test system
+    5
+    1MOL     C1    1   1.000   2.000   3.000
+    1MOL     C2    2   1.100   2.100   3.100
+    2MOL     C1    3   4.000   5.000   6.000
+    2MOL     C2    4   4.100   5.100   6.100
+    7ION    NA     5   0.500   0.500   0.500
+  10.00000  10.00000  10.00000
+"""
+
+
+class GROFileReadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.file_name = 'test_read.gro'
+        with open(self.file_name, 'w') as output_file:
+            output_file.write(GRO_CONTENT)
+
+    def tearDown(self):
+        os.unlink(self.file_name)
+
+    def test_read_gro_block(self):
+        block = files_io.read_gro_block(GRO_CONTENT.splitlines()[2:7])
+        self.assertEqual(block.atom_id.tolist(), [1, 2, 3, 4, 5])
+        self.assertEqual(block.chain_idx.tolist(), [1, 1, 2, 2, 3])
+        self.assertEqual(block.name.tolist(), ['C1', 'C2', 'C1', 'C2', 'NA'])
+        self.assertEqual(block.chain_name.tolist(), ['MOL', 'MOL', 'MOL', 'MOL', 'ION'])
+        self.assertEqual(block.position.shape, (5, 3))
+        self.assertEqual(block.position[2].tolist(), [4.0, 5.0, 6.0])
+
+    def test_read(self):
+        gro_file = files_io.GROFile(self.file_name)
+        gro_file.read()
+        self.assertEqual(gro_file.title, 'Test system')
+        self.assertEqual(len(gro_file.atoms), 5)
+        self.assertEqual(gro_file.box.tolist(), [10.0, 10.0, 10.0])
+        self.assertEqual(gro_file.atoms[4].name, 'C2')
+        self.assertEqual(gro_file.atoms[4].chain_idx, 2)
+        self.assertEqual(gro_file.atoms[4].position.tolist(), [4.1, 5.1, 6.1])
+        self.assertEqual(sorted(gro_file.chains['MOL']), [1, 2])
+        self.assertEqual(gro_file.chains['MOL'][2]['C1'].atom_id, 3)
+        self.assertEqual(gro_file.fragments['ION']['NA'].atom_id, 5)
+
+    def test_write(self):
+        gro_file = files_io.GROFile(self.file_name)
+        gro_file.read()
+        out_name = 'test_write.gro'
+        gro_file.write(out_name, force=True)
+        with open(out_name) as output_file:
+            lines = output_file.readlines()
+        os.unlink(out_name)
+        self.assertEqual(len(lines), 8)
+        self.assertEqual(lines[2], '    1MOL     C1    1   1.000   2.000   3.000\n')
+        self.assertEqual(lines[6], '    3ION     NA    5   0.500   0.500   0.500\n')
+        self.assertEqual(lines[7], '10.000000 10.000000 10.000000\n')
+
+    def test_write_wide(self):
+        gro_file = files_io.GROFile(self.file_name)
+        gro_file.read()
+        gro_file.atoms[123456] = files_io.Atom(
+            atom_id=123456, name='OW', chain_name='SOL', chain_idx=234567, position=(1, 2, 3))
+        out_name = 'test_write_wide.gro'
+        gro_file.write(out_name, force=True, wide=True)
+        # The wide columns are detected from the atom lines.
+        wide_file = files_io.GROFile(out_name)
+        wide_file.read()
+        self.assertTrue(wide_file.wide)
+        self.assertEqual(len(wide_file.atoms), 6)
+        self.assertEqual(wide_file.atoms[6].name, 'OW')
+        self.assertEqual(wide_file.atoms[6].chain_name, 'SOL')
+        self.assertEqual(wide_file.atoms[6].position.tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(wide_file.atoms[1].position.tolist(), [1.0, 2.0, 3.0])
+        # The file read back is written again with the wide columns.
+        wide_file.write(out_name, force=True)
+        with open(out_name) as output_file:
+            lines = output_file.readlines()
+        os.unlink(out_name)
+        self.assertEqual(lines[7], '         4SOL     OW         6   1.000   2.000   3.000\n')
+
+    def test_gro_columns(self):
+        self.assertIs(files_io.gro_columns(GRO_CONTENT.splitlines()[2]), files_io.GRO_COLUMNS)
+        wide_line = files_io.GRO_WIDE_FORMAT % (123456, 'SOL', 'OW', 123456, 1.0, -2.0, 30.0)
+        self.assertIs(files_io.gro_columns(wide_line), files_io.GRO_WIDE_COLUMNS)
+        self.assertIs(files_io.gro_columns(wide_line.encode()), files_io.GRO_WIDE_COLUMNS)
+        gro_file = files_io.GROFile(self.file_name)
+        gro_file.read()
+        self.assertFalse(gro_file.wide)
+
+
+class AtomStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.gro_file = files_io.GROFile('abc.gro')
+        for at_id, name, chain_idx in [(1, 'C1', 1), (2, 'C2', 1), (3, 'C1', 2), (4, 'C2', 2)]:
+            self.gro_file.atoms[at_id] = files_io.Atom(
+                atom_id=at_id,
+                name=name,
+                chain_name='MOL',
+                chain_idx=chain_idx,
+                position=(at_id, at_id, at_id)
+            )
+
+    def test_columns(self):
+        atoms = self.gro_file.atoms
+        self.assertEqual(len(atoms.names), 2)
+        self.assertEqual(len(atoms.chain_names), 1)
+        self.assertEqual(atoms.positions([2, 4]).tolist(), [[2, 2, 2], [4, 4, 4]])
+        self.assertEqual(atoms.columns().name.tolist(), ['C1', 'C2', 'C1', 'C2'])
+        self.assertRaises(KeyError, lambda: atoms[5])
+
+    def test_read_only_position(self):
+        atoms = self.gro_file.atoms
+        at = atoms[2]
+
+        def write_position():
+            at.position[0] = 10
+        self.assertRaises(ValueError, write_position)
+        self.assertEqual(atoms[2].position.tolist(), [2, 2, 2])
+        atoms[2] = at._replace(position=at.position + 1)
+        self.assertEqual(atoms[2].position.tolist(), [3, 3, 3])
+        self.assertEqual(atoms.positions([2]).tolist(), [[3, 3, 3]])
+
+    def test_lazy_indexes(self):
+        self.assertEqual(self.gro_file.chains['MOL'][2]['C2'].atom_id, 4)
+        self.assertEqual(self.gro_file.fragments['MOL']['C1'].atom_id, 3)
+        # Indexes are rebuilt after modification.
+        self.gro_file.remove_atoms([3, 4], renumber=False)
+        self.assertEqual(list(self.gro_file.chains['MOL']), [1])
+        self.assertEqual(self.gro_file.fragments['MOL']['C1'].atom_id, 1)
+
+    def test_remove_atoms_renumber(self):
+        self.gro_file.remove_atoms([2])
+        self.assertEqual(sorted(self.gro_file.atoms), [1, 2, 3])
+        self.assertEqual(self.gro_file.atoms[2].name, 'C1')
+        self.assertEqual(self.gro_file.atoms[2].atom_id, 2)
+        self.assertEqual(self.gro_file.atoms[2].position.tolist(), [3, 3, 3])
+
+
+class GROTrajectoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.file_name = 'test_trajectory.gro'
+        with open(self.file_name, 'w') as output_file:
+            for frame_idx in range(3):
+                lines = GRO_CONTENT.splitlines()
+                lines[0] = 'Frame {}'.format(frame_idx)
+                # Shift positions of the first atom.
+                lines[2] = '{}{:8.3f}{}'.format(lines[2][:20], frame_idx, lines[2][28:])
+                output_file.write('\n'.join(lines) + '\n')
+
+    def tearDown(self):
+        for file_name in [self.file_name, '{}.idx'.format(self.file_name)]:
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+    def test_index(self):
+        trj = files_io.GROTrajectory(self.file_name)
+        self.assertEqual(len(trj), 3)
+        self.assertEqual(trj.num_atoms.tolist(), [5, 5, 5])
+        self.assertTrue(os.path.exists('{}.idx'.format(self.file_name)))
+
+        # Second time the index is read from the sidecar file.
+        trj = files_io.GROTrajectory(self.file_name)
+        self.assertEqual(len(trj), 3)
+
+    def test_read_frames(self):
+        trj = files_io.GROTrajectory(self.file_name)
+        frame = trj[2]
+        self.assertEqual(frame.title, 'Frame 2')
+        self.assertEqual(frame.position.shape, (5, 3))
+        self.assertEqual(frame.position[0].tolist(), [2.0, 2.0, 3.0])
+        self.assertEqual(frame.box.tolist(), [10.0, 10.0, 10.0])
+        self.assertEqual([f.position[0, 0] for f in trj], [0.0, 1.0, 2.0])
+        self.assertEqual(trj[-1].title, 'Frame 2')
+
+    def test_read_wide_frames(self):
+        gro_file = files_io.GROFile(self.file_name)
+        gro_file.read()
+        gro_file.write(self.file_name, force=True, wide=True)
+        trj = files_io.GROTrajectory(self.file_name, use_cache=False)
+        self.assertEqual(len(trj), 1)
+        self.assertEqual(trj[0].position.tolist(), gro_file.atoms.positions(sorted(gro_file.atoms)).tolist())
+
+
+class LammpsDumpTrajectoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.file_name = 'test_trajectory.dump'
+        with open(self.file_name, 'w') as output_file:
+            for timestep in [0, 100]:
+                output_file.write('ITEM: TIMESTEP\n{}\nITEM: NUMBER OF ATOMS\n3\n'.format(timestep))
+                output_file.write('ITEM: BOX BOUNDS pp pp pp\n-5 5\n-5 5\n0 20\n')
+                output_file.write('ITEM: ATOMS id type x y z\n')
+                output_file.write('3 1 1.0 2.0 3.0\n1 1 {} 0.0 0.0\n2 2 -5.0 5.0 10.0\n'.format(timestep / 100.0))
+
+    def tearDown(self):
+        os.unlink(self.file_name)
+
+    def test_read_frames(self):
+        trj = files_io.LammpsDumpTrajectory(self.file_name)
+        self.assertEqual(len(trj), 2)
+        frame = trj[1]
+        self.assertEqual(frame.title, 'Timestep 100')
+        self.assertEqual(frame.box.tolist(), [1.0, 1.0, 2.0])
+        # Sorted by atom id, shifted to the origin of the box and in nm.
+        self.assertEqual([[round(x, 6) for x in row] for row in frame.position.tolist()],
+                         [[0.6, 0.5, 0.0], [0.0, 1.0, 1.0], [0.6, 0.7, 0.3]])
+        self.assertEqual([round(f.position[0, 0], 6) for f in trj], [0.5, 0.6])
+
+
+class BondedTermsTestCase(unittest.TestCase):
+
+    def test_dict_interface(self):
+        terms = files_io.BondedTerms()
+        terms[(1, 2)] = ['1', '0.1']
+        terms[(2, 3)] = ['1', '0.2']
+        terms.append((1, 2), ['1', '0.3'])
+        terms[(4, 5)] = ['1', '0.1']
+        self.assertEqual(terms.arity, 2)
+        self.assertEqual(len(terms), 3)
+        self.assertEqual(list(terms), [(1, 2), (2, 3), (4, 5)])
+        self.assertEqual(terms[(1, 2)], ['1', '0.3'])
+        self.assertIn((4, 5), terms)
+        self.assertNotIn((5, 4), terms)
+        self.assertEqual(len(terms.param_table), 3)
+        del terms[(2, 3)]
+        self.assertEqual(terms, {(1, 2): ['1', '0.3'], (4, 5): ['1', '0.1']})
+        self.assertRaises(KeyError, lambda: terms[(2, 3)])
+        self.assertRaises(RuntimeError, terms.__setitem__, (1, 2, 3), ['1'])
+
+    def test_add_coded(self):
+        terms = files_io.BondedTerms()
+        terms[(1, 2)] = ['1', '0.1']
+        param_ids = [terms.param_table.code(['1', '0.2']), terms.param_table.code(['1', '0.3'])]
+        terms.add_coded([[2, 3], [1, 2]], param_ids)
+        self.assertEqual(list(terms), [(1, 2), (2, 3)])
+        self.assertEqual(terms[(1, 2)], ['1', '0.3'])
+        self.assertEqual(terms[(2, 3)], ['1', '0.2'])
+        self.assertRaises(RuntimeError, terms.add_coded, [[1, 2, 3]], param_ids[:1])
+
+    def test_modifications(self):
+        terms = files_io.BondedTerms({(1, 2): ['1', '0.1'], (2, 3): ['1', '0.2']})
+        param_id = terms.param_table.code(['1', '0.5'])
+        modifications = [
+            (lambda: terms.__setitem__((1, 2), ['1', '0.3']), {(1, 2): ['1', '0.3'], (2, 3): ['1', '0.2']}),
+            (lambda: terms.__delitem__((2, 3)), {(1, 2): ['1', '0.3']}),
+            (lambda: terms.append((3, 4), ['1', '0.4']), {(1, 2): ['1', '0.3'], (3, 4): ['1', '0.4']}),
+            (lambda: terms.add_coded([[1, 2]], [param_id]), {(1, 2): ['1', '0.5'], (3, 4): ['1', '0.4']}),
+            (lambda: terms.add_many([[4, 5]], ['2']),
+             {(1, 2): ['1', '0.5'], (3, 4): ['1', '0.4'], (4, 5): ['2']}),
+            (lambda: terms.remap(files_io.build_old2new([1, 2, 3, 4, 5], [5])),
+             {(1, 2): ['1', '0.5'], (3, 4): ['1', '0.4']})]
+        for modify, expected in modifications:
+            list(terms.items())
+            modify()
+            self.assertEqual(dict(terms.items()), expected)
+
+    def test_order(self):
+        keys = [(i, i + 1) for i in range(1, 9)]
+        expected = collections.OrderedDict()
+        terms = files_io.BondedTerms()
+        for i, key in enumerate(keys):
+            expected[key] = terms[key] = ['1', str(i)]
+        # The terms in the arrays and the pending ones are set again, deleted and added again.
+        list(terms)
+        terms[(9, 10)] = ['1', '9']
+        expected[(9, 10)] = ['1', '9']
+        for key in [(2, 3), (9, 10)]:
+            expected[key] = terms[key] = ['2']
+        for key in [(3, 4), (9, 10), (5, 6)]:
+            del terms[key]
+            del expected[key]
+        for key in [(9, 10), (3, 4)]:
+            expected[key] = terms[key] = ['3']
+        self.assertEqual(terms.items(), list(expected.items()))
+        ids, _ = terms.arrays()
+        self.assertEqual(list(map(tuple, ids.tolist())), list(expected))
+        self.assertEqual(terms.copy().items(), list(expected.items()))
+
+    def test_topology_sections(self):
+        topol = files_io.GROMACSTopologyFile('topol.top')
+        topol.angles = {(1, 2, 3): ['1', '109.5']}
+        topol.new_data['cross_bonds'] = {(3, 4): ['1', 0.1]}
+        self.assertIsInstance(topol.angles, files_io.BondedTerms)
+        self.assertIsInstance(topol.new_data['cross_bonds'], files_io.BondedTerms)
+        self.assertIs(topol.new_data['cross_bonds'].param_table, topol.param_table)
+        self.assertEqual(topol.angles[(1, 2, 3)], ['1', '109.5'])
+        self.assertEqual(list(topol._write_default(topol.new_data['cross_bonds'])), ['3 4 1 0.1'])
+
+    def test_remove_atoms(self):
+        topol = files_io.GROMACSTopologyFile('topol.top')
+        for at_id in range(1, 6):
+            at = files_io.TopoAtom()
+            at.atom_id = at_id
+            at.chain_name = 'MOL'
+            at.chain_idx = 1
+            at.name = 'C{}'.format(at_id)
+            topol.atoms[at_id] = at
+        topol.bonds = {(1, 2): ['1'], (2, 3): ['1'], (3, 4): ['1'], (4, 5): ['1']}
+        topol.angles = {(1, 2, 3): ['1'], (3, 4, 5): ['1']}
+        topol.new_data['bonds'] = {(2, 5): ['2']}
+
+        topol.remove_atoms([2], renumber=False)
+        self.assertEqual(list(topol.bonds), [(3, 4), (4, 5)])
+        self.assertEqual(list(topol.angles), [(3, 4, 5)])
+        self.assertEqual(len(topol.new_data['bonds']), 0)
+
+        topol.renumber()
+        self.assertEqual(sorted(topol.atoms), [1, 2, 3, 4])
+        self.assertEqual(topol.atoms[2].name, 'C3')
+        self.assertEqual(list(topol.bonds), [(2, 3), (3, 4)])
+        self.assertEqual(list(topol.angles), [(2, 3, 4)])
+
+        topol.remove_atoms([1], renumber=True)
+        self.assertEqual(list(topol.bonds), [(1, 2), (2, 3)])
+        self.assertEqual(topol.atoms[1].name, 'C3')
+
+
+class ParseCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.old_cache = files_io.parse_cache
+        files_io.parse_cache = files_io.ParseCache(self.cache_dir)
+        self.top_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hyb_topol.top')
+
+    def tearDown(self):
+        files_io.parse_cache = self.old_cache
+        shutil.rmtree(self.cache_dir)
+
+    def test_topology(self):
+        topol = files_io.GROMACSTopologyFile(self.top_name)
+        topol.read()
+        self.assertEqual(files_io.parse_cache.misses, 1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        # Only the disk part of the cache is left.
+        files_io.parse_cache.clear()
+        cached_topol = files_io.GROMACSTopologyFile(self.top_name)
+        cached_topol.read()
+        self.assertEqual(files_io.parse_cache.hits, 1)
+        self.assertEqual(sorted(cached_topol.atoms), sorted(topol.atoms))
+        self.assertEqual(cached_topol.bonds, topol.bonds)
+        self.assertEqual(cached_topol.dihedrals, topol.dihedrals)
+        self.assertEqual(cached_topol.header_section, topol.header_section)
+        self.assertIs(cached_topol.bonds.param_table, cached_topol.param_table)
+        self.assertIs(cached_topol.new_data['bonds'].param_table, cached_topol.param_table)
+        self.assertIs(cached_topol.chains['DOD'][1]['A1'], cached_topol.atoms[1])
+
+    def test_loaded_copies(self):
+        with open('test_cache.gro', 'w') as output_file:
+            output_file.write(GRO_CONTENT)
+        gro_file = files_io.GROFile('test_cache.gro')
+        gro_file.read()
+        gro_file.remove_atoms([1, 2])
+        cached_gro = files_io.GROFile('test_cache.gro')
+        cached_gro.read()
+        scaled_gro = files_io.GROFile('test_cache.gro')
+        scaled_gro.scale_factor = 10.0
+        scaled_gro.read()
+        os.unlink('test_cache.gro')
+        self.assertEqual(files_io.parse_cache.hits, 1)
+        self.assertEqual(files_io.parse_cache.misses, 2)
+        self.assertEqual(len(cached_gro.atoms), 5)
+        self.assertEqual(cached_gro.title, 'Test system')
+        self.assertEqual(cached_gro.fragments['ION']['NA'].atom_id, 5)
+        self.assertEqual(scaled_gro.atoms[5].position.tolist(), [5.0, 5.0, 5.0])
+
+    def test_memory_limit(self):
+        cache = files_io.ParseCache(memory_limit=1000)
+        cache.store('a', 'a' * 400)
+        cache.store('b', 'b' * 400)
+        self.assertEqual(cache.load('a'), 'a' * 400)  # b is now the least recently used.
+        cache.store('c', 'c' * 400)
+        cache.store('d', 'd' * 2000)  # Larger than the limit, never kept.
+        self.assertIsNone(cache.load('b'))
+        self.assertIsNone(cache.load('d'))
+        self.assertEqual(cache.load('a'), 'a' * 400)
+        self.assertEqual(cache.load('c'), 'c' * 400)
+        self.assertLessEqual(cache._memory_size, 1000)
+
+        no_memory_cache = files_io.ParseCache(memory_limit=0)
+        no_memory_cache.store('a', 'a')
+        self.assertIsNone(no_memory_cache.load('a'))
+
+    def test_recording_and_uncached_read(self):
+        with files_io.parse_cache.recording() as read_keys:
+            topol = files_io.GROMACSTopologyFile(self.top_name)
+            topol.read(cached=False)
+            with files_io.parse_cache.recording() as inner_keys:
+                files_io.GROMACSTopologyFile(self.top_name).read()
+        files_io.GROMACSTopologyFile(self.top_name).read()
+        self.assertEqual(len(read_keys), 2)
+        self.assertEqual(inner_keys, read_keys[1:])
+        self.assertEqual(read_keys[0], read_keys[1])
+        # The uncached read neither loads nor stores the state.
+        self.assertEqual((files_io.parse_cache.misses, files_io.parse_cache.hits), (1, 1))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self.assertIs(topol.chains['DOD'][1]['A1'], topol.atoms[1])
+
@@ -0,0 +1,96 @@
+"""
+Copyright (C) 2016 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is part of Backmapper.
+
+Backmapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import graph
+import networkx
+
+
+class GraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.g = graph.Graph(box=(1.0, 1.0, 1.0))
+        self.g.add_node(1, name='C1', res_id=1)
+        for b1, b2 in [(1, 2), (2, 3), (3, 4), (2, 5), (1, 2)]:
+            self.g.add_edge(b1, b2)
+
+    def test_adjacency(self):
+        self.assertEqual(self.g.nodes(), [1, 2, 3, 4, 5])
+        self.assertEqual(self.g.edges(), [(1, 2), (2, 3), (2, 5), (3, 4)])
+        self.assertEqual(self.g[2], [1, 3, 5])
+        self.assertEqual(dict(self.g.degree()), {1: 1, 2: 3, 3: 2, 4: 1, 5: 1})
+        self.assertTrue(self.g.has_edge(3, 2))
+        self.assertFalse(self.g.has_edge(1, 3))
+        self.assertEqual(self.g.graph['box'], (1.0, 1.0, 1.0))
+
+    def test_remove_node(self):
+        for at_id in range(6, 30):  # Moves the block of neighbours of 2.
+            self.g.add_edge(2, at_id)
+        self.g.remove_node(3)
+        self.assertEqual(self.g[2], [1, 5] + list(range(6, 30)))
+        self.assertEqual(self.g.degree(4), 0)
+        self.assertEqual(self.g.number_of_edges(), 26)
+        self.assertNotIn(3, self.g.node)
+
+    def test_node_attributes(self):
+        self.g.node[1]['degree'] = 1
+        self.g.add_node(5, name='C5')
+        self.assertEqual(dict(self.g.node[1]), {'name': 'C1', 'res_id': 1, 'degree': 1})
+        self.assertEqual(dict(self.g.node[5]), {'name': 'C5'})
+        self.assertRaises(KeyError, lambda: self.g.node[2]['name'])
+        nx_graph = self.g.to_networkx()
+        self.assertEqual(list(nx_graph.edges()), self.g.edges())
+        self.assertEqual(nx_graph.node[1], {'name': 'C1', 'res_id': 1, 'degree': 1})
+
+    def test_networkx_order(self):
+        # The ids that share the slots of small dicts, the order of the dicts is not the order
+        # of insertion on Python 2.
+        edges = [(17, 9), (17, 1), (1, 33), (9, 25), (17, 41), (1, 9), (100, 4), (4, 36), (36, 68)]
+        g = graph.Graph()
+        nx_graph = networkx.Graph()
+        for node in [68, 4, 36, 100, 17]:
+            g.add_node(node)
+            nx_graph.add_node(node)
+        g.add_edges_from(edges)
+        nx_graph.add_edges_from(edges)
+        self.assertEqual(g.nodes(), list(nx_graph.nodes()))
+        self.assertEqual(g.edges(), list(nx_graph.edges()))
+        for node in nx_graph:
+            self.assertEqual(g[node], list(nx_graph[node]))
+
+        g = graph.Graph(multigraph=True)
+        nx_graph = networkx.MultiGraph()
+        g.add_edges_from(edges + edges[:3])
+        nx_graph.add_edges_from(edges + edges[:3])
+        self.assertEqual(g.edges(), list(nx_graph.edges()))
+        for node in nx_graph:
+            self.assertEqual(g[node], list(nx_graph[node]))
+
+    def test_multigraph_degree(self):
+        g = graph.Graph(multigraph=True)
+        g.add_edge(1, 2)
+        g.add_edge(2, 1)
+        g.add_edge(2, 3)
+        self.assertEqual(dict(g.degree()), {1: 2, 2: 3, 3: 1})
+        self.assertEqual(g[2], [1, 3])
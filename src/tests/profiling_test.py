@@ -0,0 +1,154 @@
+"""
+Copyright (C) 2017 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is distributed under free software licence:
+you can redistribute it and/or modify it under the terms of the
+GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import prepare_files
+import profiling
+
+
+class StageProfileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.profile = profiling.StageProfile()
+
+    def test_nested_stages(self):
+        with self.profile.stage('a') as record_a:
+            self.profile.count('items', 1)
+            with self.profile.stage('b'):
+                with self.profile.stage('c') as record_c:
+                    self.profile.count('items', 3)
+                self.profile.count('items', 2)
+                self.profile.count('other', 4)
+            with self.profile.stage('d'):
+                pass
+            self.profile.count('items', 5)
+        self.profile.count('items', 6)  # Outside of stages, ignored.
+        with self.profile.stage('e'):
+            pass
+
+        self.assertEqual([r['name'] for r in self.profile.stages], ['a', 'a/b', 'a/b/c', 'a/d', 'e'])
+        self.assertEqual([dict(r['counts']) for r in self.profile.stages], [
+            {'items': 5}, {'items': 2, 'other': 4}, {'items': 3}, {}, {}])
+        self.assertIs(self.profile.stages[0], record_a)
+        self.assertIs(self.profile.stages[2], record_c)
+        self.assertEqual(self.profile._open_stages, [])
+        self.assertGreaterEqual(record_a['wall_time'], record_c['wall_time'])
+
+    def test_stage_with_exception(self):
+        try:
+            with self.profile.stage('a'):
+                with self.profile.stage('b'):
+                    raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual([r['name'] for r in self.profile.stages], ['a', 'a/b'])
+        self.assertTrue(all(r['wall_time'] is not None for r in self.profile.stages))
+        self.assertEqual(self.profile._open_stages, [])
+
+    @unittest.skipIf(profiling.resource is None, 'resource is not available')
+    def test_max_rss(self):
+        with self.profile.stage('a') as record_a:
+            with self.profile.stage('b') as record_b:
+                data = bytearray(16 * 1024 * 1024)
+            del data
+        for record in (record_a, record_b):
+            self.assertGreaterEqual(record['max_rss_increase_kb'], 0)
+            self.assertGreaterEqual(record['children_max_rss_increase_kb'], 0)
+            self.assertLessEqual(record['max_rss_increase_kb'], record['cumulative_max_rss_kb'])
+        # The increase of the peak in the enclosing stage includes the increase in the nested one.
+        self.assertGreaterEqual(record_a['max_rss_increase_kb'], record_b['max_rss_increase_kb'])
+        self.assertEqual(record_a['cumulative_max_rss_kb'], record_b['cumulative_max_rss_kb'])
+
+    @unittest.skipIf(profiling.tracemalloc is None, 'tracemalloc is not available')
+    def test_trace_memory(self):
+        self.profile.start_trace_memory()
+        try:
+            with self.profile.stage('a') as record_a:
+                with self.profile.stage('b') as record_b:
+                    data = [0] * (4 * 1024 * 1024)
+                del data
+                with self.profile.stage('c') as record_c:
+                    pass
+        finally:
+            profiling.tracemalloc.stop()
+        # The list holds 4M pointers of 8 bytes.
+        self.assertGreaterEqual(record_b['traced_peak_kb'], 30 * 1024)
+        self.assertGreaterEqual(record_a['traced_peak_kb'], record_b['traced_peak_kb'])
+        if hasattr(profiling.tracemalloc, 'reset_peak'):
+            self.assertLess(record_c['traced_peak_kb'], record_b['traced_peak_kb'])
+
+    @unittest.skipIf(profiling.tracemalloc is not None, 'tracemalloc is available')
+    def test_trace_memory_python2(self):
+        self.assertRaises(RuntimeError, self.profile.start_trace_memory)
+        # The option is rejected with the parsing of the arguments, before the preparation starts.
+        argv = sys.argv
+        sys.argv = ['prepare_files.py', '--options', 'missing.xml', '--trace_memory']
+        try:
+            self.assertRaises(SystemExit, prepare_files.main)
+        finally:
+            sys.argv = argv
+
+    def test_write(self):
+        with self.profile.stage('a'):
+            self.profile.count('items', 10)
+            with self.profile.stage('b'):
+                pass
+        work_dir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(work_dir, 'stages.json')
+            self.profile.write(file_name)
+            with open(file_name) as json_file:
+                data = json.load(json_file, object_pairs_hook=collections.OrderedDict)
+        finally:
+            shutil.rmtree(work_dir)
+        self.assertEqual(list(data), ['stages'])
+        self.assertEqual([r['name'] for r in data['stages']], ['a', 'a/b'])
+        self.assertEqual(data['stages'][0]['counts'], {'items': 10})
+        self.assertEqual(list(data['stages'][0])[:4], ['name', 'wall_time', 'cpu_time', 'counts'])
+        for record in data['stages']:
+            for key in ('max_rss_increase_kb', 'children_max_rss_increase_kb',
+                        'cumulative_max_rss_kb', 'children_cumulative_max_rss_kb'):
+                self.assertIn(key, record)
+
+    def test_module_functions(self):
+        old_profile = profiling.stage_profile
+        profiling.stage_profile = self.profile
+        try:
+            @profiling.profile_stage('f')
+            def f(x):
+                profiling.count('x', x)
+                return x + 1
+
+            with profiling.stage('a'):
+                self.assertEqual(f(1), 2)
+                self.assertEqual(f(2), 3)
+        finally:
+            profiling.stage_profile = old_profile
+        self.assertEqual([(r['name'], dict(r['counts'])) for r in self.profile.stages], [
+            ('a', {}), ('a/f', {'x': 1}), ('a/f', {'x': 2})])
+        self.profile.clear()
+        self.assertEqual(self.profile.stages, [])
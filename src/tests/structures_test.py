@@ -0,0 +1,448 @@
+"""
+Copyright (C) 2016 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is part of Backmapper.
+
+Backmapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import filecmp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import graph
+import networkx as nx
+import numpy
+import structures
+
+TESTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'tests'))
+
+
+class SystemTestMixin(object):
+    """Runs the preparation in the temporary copy of the test system from the tests directory."""
+    system = None
+    settings_file = 'settings.xml'
+
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        system_dir = os.path.join(self.work_dir, self.system)
+        shutil.copytree(os.path.join(TESTS_DIR, self.system), system_dir)
+        os.chdir(system_dir)
+
+    def tearDown(self):
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.work_dir)
+
+    def prepare(self, **kwargs):
+        settings = structures.BackmapperSettings2(self.settings_file)
+        settings.prepare_hybrid(**kwargs)
+        return settings
+
+    def assertSameFile(self, file_name, ref_file_name):
+        self.assertTrue(filecmp.cmp(file_name, ref_file_name, shallow=False),
+                        '{} differs from {}'.format(file_name, ref_file_name))
+
+
+def add_mirrored_chain(file_name):
+    """Appends to the .gro file the second residue, the copy of the first one mirrored in x."""
+    with open(file_name) as gro_file:
+        lines = gro_file.readlines()
+    atom_lines = lines[2:-1]
+    x0 = float(atom_lines[0][20:28])
+    new_lines = []
+    for line in atom_lines:
+        new_lines.append('{:5d}{}{:5d}{:8.3f}{}'.format(
+            2, line[5:15], int(line[15:20]) + len(atom_lines), 2 * x0 - float(line[20:28]), line[28:]))
+    with open(file_name, 'w') as gro_file:
+        gro_file.write(lines[0])
+        gro_file.write('{}\n'.format(2 * len(atom_lines)))
+        gro_file.writelines(atom_lines + new_lines + lines[-1:])
+
+
+def fragment_chains(settings):
+    """Returns the map from the keys of fragments to the indexes of their source chains."""
+    chains = {}
+    for fragment_key, beads in settings.fragments.items():
+        for bead_name, degrees in beads.items():
+            if bead_name != 'cg_molecule':
+                for degree_key, cg_fragment in degrees.items():
+                    chains[(fragment_key, bead_name, degree_key)] = cg_fragment.chain_idx
+    return chains
+
+
+@unittest.skipIf(sys.version_info[0] > 2, 'The reference follows the order of sets of Python 2')
+class MFReferenceTestCase(SystemTestMixin, unittest.TestCase):
+    """The cross bonds are processed in the order of the set of CG bonds, as in the reference."""
+    system = 'mf'
+
+    def test_reference(self):
+        self.prepare()
+        self.assertSameFile('hyb_conf.gro', 'ref_hyb_conf.gro')
+
+
+class PE4ReferenceTestCase(SystemTestMixin, unittest.TestCase):
+    system = 'pe4'
+    settings_file = 'pe4_settings.xml'
+
+    def test_reference(self):
+        self.prepare()
+        self.assertSameFile('hyb_conf.gro', 'ref_hyb_conf.gro')
+        self.assertSameFile('hyb_topol.top', 'ref_hyb_topol.top')
+
+
+class PlacementWorkersTestCase(SystemTestMixin, unittest.TestCase):
+    system = 'pe4'
+    settings_file = 'pe4_settings.xml'
+    output_files = ('hyb_conf.gro', 'hyb_topol.top', 'exclusion_hyb_topol.list')
+    maps = ('res2atom', 'atom_ids', 'atom2cg', 'cg2atom', 'cg_old_new_id', 'cg_new_id_old',
+            'mol_atomid_map', 'mol_atomname_map', 'removed_atom_ids')
+
+    def check_workers(self, **kwargs):
+        settings = self.prepare(num_workers=1, **kwargs)
+        serial_maps = {name: getattr(settings, name) for name in self.maps}
+        serial_rotations = settings.fragment_rotations
+        os.mkdir('serial')
+        for file_name in self.output_files:
+            shutil.move(file_name, 'serial')
+
+        settings = self.prepare(num_workers=2, **kwargs)
+        for name in self.maps:
+            self.assertEqual(getattr(settings, name), serial_maps[name], name)
+        self.assertEqual(sorted(settings.fragment_rotations), sorted(serial_rotations))
+        for cg_id, rotation in serial_rotations.items():
+            self.assertTrue((settings.fragment_rotations[cg_id] == rotation).all())
+        for file_name in self.output_files:
+            self.assertSameFile(file_name, os.path.join('serial', file_name))
+
+    def test_workers(self):
+        self.check_workers()
+
+    def test_workers_oriented(self):
+        self.check_workers(orient_fragments=True)
+
+
+class FragmentChainsTestCase(SystemTestMixin, unittest.TestCase):
+    """The source coordinates of the fragments of the testsuit system with two chains."""
+    system = 'testsuit'
+
+    def setUp(self):
+        super(FragmentChainsTestCase, self).setUp()
+        add_mirrored_chain('single_mf.gro')
+
+    def test_seed(self):
+        chains = [fragment_chains(structures.BackmapperSettings2(self.settings_file, seed=seed)) for seed in range(4)]
+        self.assertEqual(set(x for seed_chains in chains for x in seed_chains.values()), {1, 2})
+        self.assertEqual(fragment_chains(structures.BackmapperSettings2(self.settings_file, seed=1)), chains[1])
+
+    def test_set_chain(self):
+        settings = structures.BackmapperSettings2(self.settings_file, seed=1)
+        fragment_key, bead_name, degree_key = sorted(fragment_chains(settings))[0]
+        cg_fragment = settings.fragments[fragment_key][bead_name][degree_key]
+        positions = [at.position.tolist() for at in cg_fragment.atom_in_fragments]
+        cg_fragment.set_chain(3 - cg_fragment.chain_idx)
+        # The mirrored fragment relative to its COM.
+        self.assertEqual([[round(-x, 6), round(y, 6), round(z, 6)] for x, y, z in positions],
+                         [[round(x, 6), round(y, 6), round(z, 6)]
+                          for x, y, z in (at.position.tolist() for at in cg_fragment.atom_in_fragments)])
+
+    def test_prepare_seed(self):
+        settings = structures.BackmapperSettings2(self.settings_file, seed=1)
+        settings.prepare_hybrid()
+        shutil.move('hyb_conf.gro', 'first_hyb_conf.gro')
+        settings = structures.BackmapperSettings2(self.settings_file, seed=1)
+        settings.prepare_hybrid()
+        self.assertSameFile('hyb_conf.gro', 'first_hyb_conf.gro')
+
+
+class LayoutTestCase(SystemTestMixin, unittest.TestCase):
+    system = 'pe4'
+    settings_file = 'pe4_settings.xml'
+
+    def check_layout(self, **kwargs):
+        settings = self.prepare(**kwargs)
+        settings.save_layout('layout.npz')
+        structures.apply_layout('layout.npz', 'cg_conf.gro', 'layout_hyb_conf.gro')
+        self.assertSameFile('layout_hyb_conf.gro', 'hyb_conf.gro')
+
+    def test_apply_layout(self):
+        self.check_layout()
+        self.assertSameFile('hyb_conf.gro', 'ref_hyb_conf.gro')
+
+    def test_apply_layout_oriented(self):
+        self.check_layout(orient_fragments=True)
+
+    def test_mismatched_layout(self):
+        self.prepare().save_layout('layout.npz')
+        # The CG snapshot without the last bead.
+        with open('cg_conf.gro') as gro_file:
+            lines = gro_file.readlines()
+        lines[1] = '{}\n'.format(int(lines[1]) - 1)
+        del lines[-2]
+        with open('cg_short.gro', 'w') as gro_file:
+            gro_file.writelines(lines)
+        self.assertRaises(RuntimeError, structures.apply_layout, 'layout.npz', 'cg_short.gro', 'out.gro')
+
+        layout = structures.load_layout('layout.npz')
+        layout['version'] = structures.LAYOUT_VERSION + 1
+        numpy.savez('layout_version.npz', **layout)
+        self.assertRaises(RuntimeError, structures.apply_layout, 'layout_version.npz', 'cg_conf.gro', 'out.gro')
+
+
+class CheckpointsTestCase(SystemTestMixin, unittest.TestCase):
+    system = 'testsuit'
+    output_files = ('hyb_conf.gro', 'hyb_topol.top', 'exclusion_hyb_topol.list')
+
+    def checkpoints(self, settings):
+        return structures.Checkpoints('prepare_checkpoint', settings.input_fingerprint)
+
+    def prepare_with_checkpoints(self, resume):
+        settings = structures.BackmapperSettings2(self.settings_file)
+        settings.prepare_hybrid(checkpoints=self.checkpoints(settings), resume=resume)
+
+    def test_resume(self):
+        self.prepare_with_checkpoints(resume=False)
+        os.mkdir('first')
+        for file_name in self.output_files:
+            shutil.move(file_name, 'first')
+        for stage in structures.CHECKPOINT_STAGES:
+            shutil.move('prepare_checkpoint.{}.pck'.format(stage), 'first')
+
+        for stage_idx, stage in enumerate(structures.CHECKPOINT_STAGES):
+            for file_name in self.output_files:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+            for s in structures.CHECKPOINT_STAGES:
+                file_name = 'prepare_checkpoint.{}.pck'.format(s)
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+            for s in structures.CHECKPOINT_STAGES[:stage_idx+1]:
+                shutil.copy(os.path.join('first', 'prepare_checkpoint.{}.pck'.format(s)), '.')
+
+            settings = structures.BackmapperSettings2(self.settings_file)
+            self.assertEqual(self.checkpoints(settings).load_last()[0], stage)
+            self.prepare_with_checkpoints(resume=True)
+            for file_name in self.output_files:
+                self.assertSameFile(file_name, os.path.join('first', file_name))
+
+    def test_resume_layout(self):
+        add_mirrored_chain('single_mf.gro')
+        settings = structures.BackmapperSettings2(self.settings_file, seed=1)
+        settings.prepare_hybrid(checkpoints=self.checkpoints(settings))
+        settings.save_layout('first_layout.npz')
+        chains = fragment_chains(settings)
+        shutil.move('hyb_conf.gro', 'first_hyb_conf.gro')
+        for stage in structures.CHECKPOINT_STAGES[1:]:
+            os.remove('prepare_checkpoint.{}.pck'.format(stage))
+
+        # The fragments of the new settings take other chains, the placed ones are restored.
+        settings = structures.BackmapperSettings2(self.settings_file, seed=2)
+        self.assertNotEqual(fragment_chains(settings), chains)
+        settings.prepare_hybrid(checkpoints=self.checkpoints(settings), resume=True)
+        self.assertEqual(fragment_chains(settings), chains)
+        self.assertSameFile('hyb_conf.gro', 'first_hyb_conf.gro')
+        settings.save_layout('layout.npz')
+        first_layout = structures.load_layout('first_layout.npz')
+        layout = structures.load_layout('layout.npz')
+        self.assertEqual(sorted(layout), sorted(first_layout))
+        for name in layout:
+            self.assertTrue(numpy.array_equal(layout[name], first_layout[name]), name)
+        structures.apply_layout('layout.npz', 'cg_conf.gro', 'layout_hyb_conf.gro')
+        self.assertSameFile('layout_hyb_conf.gro', 'hyb_conf.gro')
+
+    def test_stale_checkpoint(self):
+        self.prepare_with_checkpoints(resume=False)
+        settings = structures.BackmapperSettings2(self.settings_file)
+        self.assertEqual(self.checkpoints(settings).load_last()[0], structures.CHECKPOINT_STAGES[-1])
+        self.assertEqual(structures.Checkpoints('prepare_checkpoint', 'other').load_last(), (None, None))
+
+        # Changed settings.
+        shutil.copy(self.settings_file, 'settings.bak')
+        with open(self.settings_file, 'a') as settings_file:
+            settings_file.write('\n')
+        settings = structures.BackmapperSettings2(self.settings_file)
+        self.assertEqual(self.checkpoints(settings).load_last(), (None, None))
+        shutil.move('settings.bak', self.settings_file)
+
+        # Changed input coordinates, the title of the CG coordinate file.
+        with open('cg_conf.gro') as gro_file:
+            lines = gro_file.readlines()
+        lines[0] = 'changed {}'.format(lines[0])
+        with open('cg_conf.gro', 'w') as gro_file:
+            gro_file.writelines(lines)
+        settings = structures.BackmapperSettings2(self.settings_file)
+        self.assertEqual(self.checkpoints(settings).load_last(), (None, None))
+
+        # The stale checkpoint is not used, the preparation is done from the beginning.
+        settings.prepare_hybrid(checkpoints=self.checkpoints(settings), resume=True)
+        self.assertEqual(self.checkpoints(settings).load_last()[0], structures.CHECKPOINT_STAGES[-1])
+
+
+class ExclusionListsTestCase(SystemTestMixin, unittest.TestCase):
+    system = 'pe4'
+    settings_file = 'pe4_settings.xml'
+
+    def test_exclusions(self):
+        settings = self.prepare()
+        topology = settings.hyb_topology
+        bonds = list(topology.bonds.keys())
+        for k in topology.new_data:
+            if 'bonds' in k:
+                bonds.extend(topology.new_data[k])
+        graphs = [
+            ([b for b in bonds if b[0] in settings.atom_ids and b[1] in settings.atom_ids],
+             int(topology.moleculetype['excl_at'])),
+            ([b for b in bonds if b[0] in settings.cg2atom and b[1] in settings.cg2atom],
+             int(topology.moleculetype['excl_cg']))]
+        exclusions = set()
+        for edges, cutoff in graphs:
+            g = nx.Graph()
+            g.add_edges_from(edges)
+            for l in dict(nx.all_pairs_shortest_path(g, cutoff)).values():
+                for p in l.values():
+                    if len(p) > 1:
+                        exclusions.add(tuple(sorted([p[0], p[-1]])))
+        with open('ref_exclusion_hyb_topol.list', 'w') as out_file:
+            out_file.writelines('\n'.join(['{} {}'.format(*d) for d in sorted(exclusions)]))
+        self.assertSameFile('exclusion_hyb_topol.list', 'ref_exclusion_hyb_topol.list')
+        for num_workers in [1, 2]:
+            os.remove('exclusion_hyb_topol.list')
+            settings._generate_exclusion_lists(num_workers, shard_size=50)
+            self.assertSameFile('exclusion_hyb_topol.list', 'ref_exclusion_hyb_topol.list')
+
+
+Fragment = collections.namedtuple('Fragment', 'atom_in_fragments')
+
+
+def reference_assign_fragments(settings, residue_graph):
+    """The fragment selection of _assign_fragments, searched for every residue."""
+    new_at_id = 1
+    residue_tasks = []
+    for res_id in sorted(residue_graph.nodes()):
+        cg_nodes = residue_graph.node[res_id]['cg_nodes']
+        residue_degree = residue_graph.node[res_id]['degree']
+        residue_name = residue_graph.node[res_id]['chain_name']
+        possible_fragments = [x for x in settings.fragments.keys()
+                              if x[1] == residue_name and (x[0] == '*' or x[0] == residue_degree)]
+
+        selected_fragment = None
+        for possible_fragment in possible_fragments:
+            f = settings.fragments[possible_fragment]
+            selected_fragment = possible_fragment
+            for cg_id in cg_nodes:
+                cg_node = settings.cg_graph.node[cg_id]
+                if str(cg_node['degree']) not in f[cg_node['name']] and '*' not in f[cg_node['name']]:
+                    selected_fragment = None
+            if selected_fragment is not None:
+                break
+        if selected_fragment is None:
+            raise RuntimeError('Could not find correct fragment for molecule {}'.format(res_id))
+
+        beads = []
+        for cg_id in cg_nodes:
+            cg_bead = settings.cg_graph.node[cg_id]
+            fragments = settings.fragments[selected_fragment][cg_bead['name']]
+            degree_key = str(cg_bead['degree']) if str(cg_bead['degree']) in fragments else '*'
+            beads.append((cg_id, new_at_id, (selected_fragment, cg_bead['name'], degree_key)))
+            new_at_id += 1 + len(fragments[degree_key].atom_in_fragments)
+        residue_tasks.append((res_id, beads))
+    return residue_tasks
+
+
+class AssignFragmentsTestCase(SystemTestMixin, unittest.TestCase):
+    system = 'testsuit'
+
+    def setUp(self):
+        super(AssignFragmentsTestCase, self).setUp()
+        self.settings = structures.BackmapperSettings2(self.settings_file)
+        # Residue A of degree 2 matches ('2', 'A') and ('*', 'A'), of degree 1 matches ('1', 'A') and
+        # ('*', 'A') if the degrees of its beads are in ('1', 'A'), the first match in this order is selected.
+        self.settings.fragments = collections.OrderedDict([
+            (('2', 'A'), {'A1': {'3': Fragment([1, 2])}, 'A2': {'*': Fragment([1])}}),
+            (('1', 'A'), {'A1': {'1': Fragment([1, 2, 3]), '2': Fragment([1, 2])}, 'A2': {'*': Fragment([1] * 4)}}),
+            (('*', 'A'), {'A1': {'*': Fragment([1] * 5)}, 'A2': {'1': Fragment([1]), '2': Fragment([1, 2])}}),
+            (('1', 'B'), {'B1': {'2': Fragment([1, 2])}}),
+        ])
+        self.settings.cg_graph = graph.Graph()
+        self.residue_graph = graph.Graph(multigraph=True)
+
+    def add_residue(self, res_id, name, degree, beads):
+        cg_nodes = []
+        for bead_name, bead_degree in beads:
+            cg_id = len(self.settings.cg_graph.node) + 1
+            self.settings.cg_graph.add_node(cg_id, name=bead_name, degree=bead_degree, res_id=res_id)
+            cg_nodes.append(cg_id)
+        self.residue_graph.add_node(res_id, chain_name=name, degree=degree, cg_nodes=cg_nodes)
+
+    def test_assign_fragments(self):
+        self.add_residue(1, 'A', '1', [('A1', 1), ('A2', 2)])
+        self.add_residue(2, 'A', '2', [('A1', 3), ('A2', 1)])
+        self.add_residue(3, 'A', '1', [('A1', 3), ('A2', 1)])
+        self.add_residue(4, 'A', '0', [('A1', 1), ('A2', 2)])
+        self.add_residue(5, 'A', '1', [('A1', 1), ('A2', 2)])
+        self.add_residue(6, 'A', '2', [('A1', 1), ('A2', 2)])
+        self.add_residue(7, 'A', '1', [('A1', 2), ('A2', 2)])
+        residue_tasks = self.settings._assign_fragments(self.residue_graph)
+        self.assertEqual(residue_tasks, reference_assign_fragments(self.settings, self.residue_graph))
+        self.assertEqual([beads[0][2][0] for _, beads in residue_tasks], [
+            ('1', 'A'), ('2', 'A'), ('*', 'A'), ('*', 'A'), ('1', 'A'), ('*', 'A'), ('1', 'A')])
+
+    def test_no_match(self):
+        self.add_residue(1, 'A', '1', [('A1', 1), ('A2', 2)])
+        self.add_residue(2, 'B', '1', [('B1', 1)])
+        self.assertRaises(RuntimeError, reference_assign_fragments, self.settings, self.residue_graph)
+        self.assertRaises(RuntimeError, self.settings._assign_fragments, self.residue_graph)
+
+
+class RemoveGraphNodesTestCase(SystemTestMixin, unittest.TestCase):
+    system = 'testsuit'
+
+    def setUp(self):
+        super(RemoveGraphNodesTestCase, self).setUp()
+        self.settings = structures.BackmapperSettings2(self.settings_file)
+
+    def check_remove(self, edges, node_ids_list):
+        global_graph = graph.Graph()
+        global_graph.add_edges_from(edges)
+        self.settings.global_graph = global_graph
+        global_degree = dict(global_graph.degree())
+        for node_ids in node_ids_list:
+            self.settings._remove_graph_nodes(node_ids, global_degree)
+            self.assertEqual(global_degree, dict(global_graph.degree()))
+
+    def test_chain(self):
+        self.check_remove([(1, 2), (2, 3), (3, 4)], [[1], [3], [2, 4]])
+
+    def test_self_loop(self):
+        # Nodes 2 and 3 have self-loops, a self-loop counts twice in the degree of the node.
+        self.check_remove([(1, 2), (2, 2), (2, 3), (3, 3), (3, 4)], [[2], [4], [3, 1]])
+
+    def test_shared_neighbour(self):
+        # Nodes 1 and 3 share the neighbours 2 and 4, nodes 5 and 6 are bonded to each other.
+        edges = [(1, 2), (3, 2), (1, 4), (3, 4), (2, 5), (5, 6), (6, 4), (6, 6)]
+        self.check_remove(edges, [[1, 3], [5, 6], [2]])
+
+    def test_random(self):
+        rnd = random.Random(1234)
+        edges = [(rnd.randint(1, 30), rnd.randint(1, 30)) for _ in range(80)]
+        node_ids = sorted({n for e in edges for n in e})
+        rnd.shuffle(node_ids)
+        self.check_remove(edges, [node_ids[i:i+5] for i in range(0, len(node_ids), 5)])
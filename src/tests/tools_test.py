@@ -0,0 +1,221 @@
+"""
+Copyright (C) 2016 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is part of Backmapper.
+
+Backmapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import filecmp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import files_io
+import graph
+import networkx as nx
+import numpy
+import tools
+
+
+def reference_bonded_tuples(g, num, bond_pair):
+    """The gen_bonded_tuples based on networkx.single_source_shortest_path."""
+    b0, b1 = bond_pair
+    paths = []
+    if num > 3:
+        for nb0 in g[b0]:
+            paths.extend(nx.single_source_shortest_path(g, nb0, num-1).values())
+        for nb1 in g[b1]:
+            paths.extend(nx.single_source_shortest_path(g, nb1, num-1).values())
+
+    paths.extend(nx.single_source_shortest_path(g, b0, num-1).values())
+    paths.extend(nx.single_source_shortest_path(g, b1, num-1).values())
+    output = set()
+    for b in paths:
+        if len(b) == num and b0 in b and b1 in b:
+            if tuple(reversed(b)) not in output:
+                output.add(tuple(b))
+    return output
+
+
+def normalize_tuples(tuples):
+    """Returns the set of tuples independent of the direction of the tuples."""
+    return {min(t, tuple(reversed(t))) for t in tuples}
+
+
+class BondedTuplesTestCase(unittest.TestCase):
+    # Branched chain: 1-2-3-4-5 with branches 3-6-7 and 2-8.
+    branched_edges = [(1, 2), (2, 3), (3, 4), (4, 5), (3, 6), (6, 7), (2, 8)]
+    # Six membered ring 1..6 with the side chain 1-7-8 and the fused four membered ring 3-9-10-4.
+    ring_edges = [(1, 2), (2, 3), (3, 4), (4, 5), (5, 6), (6, 1), (1, 7), (7, 8), (3, 9), (9, 10), (10, 4)]
+
+    def check_tuples(self, edges):
+        nx_graph = nx.Graph()
+        nx_graph.add_edges_from(edges)
+        g = graph.Graph()
+        g.add_edges_from(edges)
+        # All edges in one batch, so the edges share the atoms.
+        bond_pairs = list(edges)
+        for num in [3, 4]:
+            reference = [reference_bonded_tuples(nx_graph, num, bond_pair) for bond_pair in bond_pairs]
+            self.assertTrue(all(reference))
+            for bond_pair, ref_tuples in zip(bond_pairs, reference):
+                self.assertEqual(tools.gen_bonded_tuples(nx_graph, num, bond_pair), ref_tuples)
+            self.assertEqual(tools.gen_bonded_tuples_many(nx_graph, num, bond_pairs), reference)
+            self.assertEqual(
+                [normalize_tuples(t) for t in tools.gen_bonded_tuples_many(g, num, bond_pairs)],
+                [normalize_tuples(t) for t in reference])
+        self.assertEqual(
+            tools.gen_bonded_tuples_many(nx_graph, [3, 4], bond_pairs),
+            [[reference_bonded_tuples(nx_graph, num, bond_pair) for num in [3, 4]] for bond_pair in bond_pairs])
+
+    def test_branched(self):
+        self.check_tuples(self.branched_edges)
+
+    def test_ring(self):
+        self.check_tuples(self.ring_edges)
+
+
+def write_reference_exclusions(file_name, graphs):
+    """Writes the exclusions of the list of (edges, cutoff) found by networkx.all_pairs_shortest_path."""
+    exclusions = set()
+    for edges, cutoff in graphs:
+        g = nx.Graph()
+        g.add_edges_from(edges)
+        for l in dict(nx.all_pairs_shortest_path(g, cutoff)).values():
+            for p in l.values():
+                if len(p) > 1:
+                    exclusions.add(tuple(sorted([p[0], p[-1]])))
+    with open(file_name, 'w') as out_file:
+        out_file.writelines('\n'.join(['{} {}'.format(*d) for d in sorted(exclusions)]))
+    return len(exclusions)
+
+
+class WriteExclusionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def read_file(self, file_name):
+        with open(os.path.join(self.work_dir, file_name)) as f:
+            return f.read()
+
+    def check_exclusions(self, graphs):
+        num_ref = write_reference_exclusions(os.path.join(self.work_dir, 'ref.list'), graphs)
+        reference = self.read_file('ref.list')
+        compact_graphs = [(tools.CompactAdjacency(edges), cutoff) for edges, cutoff in graphs]
+        for num_workers in [1, 2]:
+            for shard_size in [1, 3, 20000]:
+                num_pairs = tools.write_exclusions(
+                    os.path.join(self.work_dir, 'out.list'), compact_graphs, num_workers, shard_size)
+                self.assertEqual(num_pairs, num_ref)
+                self.assertEqual(self.read_file('out.list'), reference)
+
+    def test_chain_and_ring(self):
+        # The chain 1..10 with the ring 10..15, the CG graph shares some of the nodes.
+        at_edges = [(i, i + 1) for i in range(1, 15)] + [(15, 10), (3, 20), (20, 21)]
+        cg_edges = [(30, 31), (31, 32), (32, 33), (33, 30), (2, 30)]
+        self.check_exclusions([(at_edges, 3), (cg_edges, 1)])
+
+    def test_random(self):
+        rnd = random.Random(1234)
+        at_edges = [(rnd.randint(1, 60), rnd.randint(1, 60)) for _ in range(70)]
+        at_edges = [e for e in at_edges if e[0] != e[1]]
+        cg_edges = [(rnd.randint(40, 80), rnd.randint(40, 80)) for _ in range(30)]
+        cg_edges = [e for e in cg_edges if e[0] != e[1]]
+        self.check_exclusions([(at_edges, 3), (cg_edges, 2)])
+
+
+class AtomisticTopologyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.top_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hyb_topol.top')
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_live_topology(self):
+        topol = files_io.GROMACSTopologyFile(self.top_name)
+        topol.read()
+        topol.atoms[3].charge = 0.123456789
+        topol.atoms[2].mass = None
+        topol.new_data['bonds'] = {(2, 4): ['1', 0.15], (4, 2): ['1', 0.1], (2, 3): ['1', 0.2]}
+        topol.new_data['cross_bonds'] = {(3, 5): ['1', 0.2], (1, 2): ['1', 0.3]}
+        # As in the backmapping, the cross sections are written with their new data.
+        for section_name in ('cross_angles', 'cross_dihedrals', 'cross_pairs'):
+            topol.new_data[section_name] = {}
+        hyb_name, at_name, ref_hyb_name, ref_at_name = [
+            os.path.join(self.work_dir, x) for x in ('hyb.top', 'at.top', 'ref_hyb.top', 'ref_at.top')]
+
+        # The reference, the atomistic topology of the written and read hybrid topology.
+        topol.write(ref_hyb_name)
+        read_topol = files_io.GROMACSTopologyFile(ref_hyb_name)
+        read_topol.read(cached=False)
+        read_topol.file_name = topol.file_name
+        tools.get_atomistic_topology(read_topol).write(ref_at_name)
+
+        at_topol = tools.get_atomistic_topology(topol)
+        topol.write(hyb_name, others=[(at_topol, at_name)])
+        self.assertTrue(filecmp.cmp(hyb_name, ref_hyb_name, shallow=False))
+        self.assertTrue(filecmp.cmp(at_name, ref_at_name, shallow=False))
+        self.assertEqual(at_topol.old2new_ids[2], 1)
+        self.assertEqual(topol.atoms[2].atom_id, 2)
+        self.assertIs(at_topol.param_table, topol.param_table)
+
+        # Written alone, the atomistic topology is the same.
+        at_topol.write(at_name)
+        self.assertTrue(filecmp.cmp(at_name, ref_at_name, shallow=False))
+
+
+class KabschRotationsTestCase(unittest.TestCase):
+
+    def test_rotations(self):
+        angle = numpy.pi / 3
+        rotation = numpy.array([
+            [numpy.cos(angle), -numpy.sin(angle), 0], [numpy.sin(angle), numpy.cos(angle), 0], [0, 0, 1]])
+        reference = numpy.zeros((2, 3, 3))
+        reference[0] = [[1, 0, 0], [0, 1, 0], [0, 0, 1]]
+        reference[1, 0] = [1, 2, 3]
+        target = numpy.einsum('ij,bkj->bki', rotation, reference)
+        weights = numpy.array([[1, 1, 1], [0, 0, 0]])
+        rotations = tools.kabsch_rotations(reference, target, weights)
+        self.assertTrue(numpy.allclose(rotations[0], rotation))
+        # No points, no rotation.
+        self.assertTrue(numpy.allclose(rotations[1], numpy.eye(3)))
+        # The mirror image is fitted by the proper rotation.
+        rotations = tools.kabsch_rotations(reference[:1], -reference[:1], weights[:1])
+        self.assertAlmostEqual(numpy.linalg.det(rotations[0]), 1.0)
+
+
+class FindClosePairsTestCase(unittest.TestCase):
+
+    def test_periodic_pairs(self):
+        positions = [[0.05, 1.0, 1.0], [2.95, 1.0, 1.0], [1.0, 1.0, 1.0], [1.05, 1.0, 1.0], [2.0, 2.0, 2.0]]
+        i, j, distance = tools.find_close_pairs(positions, [3.0, 3.0, 3.0], 0.2)
+        self.assertEqual(list(zip(i.tolist(), j.tolist())), [(0, 1), (2, 3)])
+        self.assertEqual([round(x, 6) for x in distance.tolist()], [0.1, 0.05])
+
+    def test_excluded_pairs(self):
+        adjacency = tools.CompactAdjacency([(1, 2), (2, 3), (3, 4)])
+        mask = adjacency.within([1, 1, 2, 5], [3, 4, 4, 6], 2)
+        self.assertEqual(mask.tolist(), [True, False, True, False])
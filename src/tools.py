@@ -18,8 +18,12 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
 import argparse
+import copy
+import itertools
 import files_io
+import multiprocessing
 import networkx as nx
+import numpy
 import sys
 
 __doc__ = "Tool functions."
@@ -54,33 +58,315 @@ class MyArgParser(argparse.ArgumentParser):
                     of.write('{}={}\n'.format(k, v))
 
 
+class LocalPaths(object):
+    """Enumerates the bounded shortest paths of the graph, from the adjacency lists of visited nodes.
+
+    The search follows networkx.single_source_shortest_path, including the order of the
+    dictionaries, so for every source the same shortest path to every node is selected.
+    Only the parent of every node is stored, the paths of the requested length are
+    rebuilt at the end and cached. The graph must not change while the object is used.
+
+    Args:
+        g: The graph.Graph or networkx.Graph object.
+    """
+    def __init__(self, g):
+        self.g = g
+        self._adj = {}
+        self._paths = {}
+
+    def neighbours(self, node):
+        """Returns the list of neighbours of the node."""
+        nbs = self._adj.get(node)
+        if nbs is None:
+            nbs = list(self.g[node])
+            self._adj[node] = nbs
+        return nbs
+
+    def paths(self, source, length):
+        """Returns the list of shortest paths from the source that have `length` nodes.
+
+        The paths are in the order of the dictionary returned by single_source_shortest_path.
+        """
+        key = (source, length)
+        output = self._paths.get(key)
+        if output is None:
+            parents = {source: None}
+            nextlevel = {source: 1}
+            level = 0
+            while nextlevel and length - 1 > level:
+                thislevel = nextlevel
+                nextlevel = {}
+                for v in thislevel:
+                    for w in self.neighbours(v):
+                        if w not in parents:
+                            parents[w] = v
+                            nextlevel[w] = 1
+                level += 1
+            output = []
+            if level == length - 1:
+                for w in dict(parents):  # The order of the copied dictionary, as in networkx.
+                    if w in nextlevel:
+                        path = [w]
+                        while parents[path[-1]] is not None:
+                            path.append(parents[path[-1]])
+                        output.append(path[::-1])
+            self._paths[key] = output
+        return output
+
+    def bonded_tuples(self, num, bond_pair):
+        """Returns the set of tuples with `num` atoms that contain the bond, see gen_bonded_tuples."""
+        b0, b1 = bond_pair
+        sources = []
+        if num > 3:
+            sources.extend(self.neighbours(b0))
+            sources.extend(self.neighbours(b1))
+        sources.extend([b0, b1])
+        output = set()
+        for source in sources:
+            for b in self.paths(source, num):
+                if b0 in b and b1 in b:
+                    if tuple(reversed(b)) not in output:
+                        output.add(tuple(b))
+        return output
+
+
 def gen_bonded_tuples(g, num, bond_pair):
     """Generates tuples of different size, based on the graph and input edge.
 
     Args:
-        g: The networkx Graph object.
+        g: The graph.Graph or networkx.Graph object.
         num: The length of the tuple.
         bond_pair: The edge which has to be included in all tuples.
 
     Returns:
         The set of all tuples of defined length from graph `g`.
     """
-    b0, b1 = bond_pair
-    paths = []
-    if num > 3:
-        for nb0 in g[b0]:
-            paths.extend(nx.single_source_shortest_path(g, nb0, num-1).values())
-        for nb1 in g[b1]:
-            paths.extend(nx.single_source_shortest_path(g, nb1, num-1).values())
-
-    paths.extend(nx.single_source_shortest_path(g, b0, num-1).values())
-    paths.extend(nx.single_source_shortest_path(g, b1, num-1).values())
-    output = set()
-    for b in paths:
-        if len(b) == num and b0 in b and b1 in b:
-            if tuple(reversed(b)) not in output:
-                output.add(tuple(b))
-    return output
+    return LocalPaths(g).bonded_tuples(num, bond_pair)
+
+
+def gen_bonded_tuples_many(g, num, bond_pairs):
+    """Generates the tuples of gen_bonded_tuples for many edges of the same graph.
+
+    The searches from the atoms shared by the edges are done only once.
+
+    Args:
+        g: The graph.Graph or networkx.Graph object.
+        num: The length of the tuple or the list of lengths.
+        bond_pairs: The list of edges.
+
+    Returns:
+        The list with the set of tuples for every edge, or with the list of sets,
+        one for every length, if `num` is a list.
+    """
+    local_paths = LocalPaths(g)
+    if isinstance(num, (list, tuple)):
+        return [[local_paths.bonded_tuples(n, bond_pair) for n in num] for bond_pair in bond_pairs]
+    return [local_paths.bonded_tuples(num, bond_pair) for bond_pair in bond_pairs]
+
+
+# The pair of nodes (i, j) is encoded as a single integer (i << _PAIR_SHIFT) | j.
+_PAIR_SHIFT = 32
+_PAIR_MASK = (1 << _PAIR_SHIFT) - 1
+
+# The list of (CompactAdjacency, cutoff) used by the exclusion workers.
+_exclusion_graphs = None
+
+
+class CompactAdjacency(object):
+    """Adjacency of the undirected graph with integer nodes, kept in the CSR arrays.
+
+    The neighbours of the node i are indices[indptr[i]:indptr[i+1]].
+
+    Args:
+        edges: The list of pairs of node ids.
+    """
+    def __init__(self, edges):
+        edges = numpy.asarray(edges, dtype=numpy.int64).reshape(-1, 2)
+        edges = edges[edges[:, 0] != edges[:, 1]]
+        size = int(edges.max()) + 1 if len(edges) else 0
+        heads = numpy.concatenate((edges[:, 0], edges[:, 1]))
+        tails = numpy.concatenate((edges[:, 1], edges[:, 0]))
+        self.indices = tails[numpy.argsort(heads, kind='mergesort')]
+        self.indptr = numpy.zeros(size + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(heads, minlength=size), out=self.indptr[1:])
+        self.nodes = numpy.flatnonzero(numpy.diff(self.indptr))
+
+    def pairs_within(self, sources, cutoff):
+        """Returns the pairs (i, j), i < j, of the source nodes i and the nodes j at most cutoff bonds away.
+
+        The breadth-first search runs for all sources at once, level by level.
+
+        Args:
+            sources: The array of nodes of the graph.
+            cutoff: The maximal distance between the nodes.
+
+        Returns:
+            The sorted array of the encoded pairs.
+        """
+        sources = numpy.asarray(sources, dtype=numpy.int64)
+        reached = numpy.unique((sources << _PAIR_SHIFT) | sources)
+        front_src, front_node = sources, sources
+        for _ in range(cutoff):
+            if not len(front_node):
+                break
+            starts = self.indptr[front_node]
+            counts = self.indptr[front_node + 1] - starts
+            offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            next_node = self.indices[numpy.repeat(starts, counts) + offsets]
+            keys = numpy.unique((numpy.repeat(front_src, counts) << _PAIR_SHIFT) | next_node)
+            keys = keys[~numpy.isin(keys, reached, assume_unique=True)]
+            reached = numpy.union1d(reached, keys)
+            front_src, front_node = keys >> _PAIR_SHIFT, keys & _PAIR_MASK
+        return reached[(reached & _PAIR_MASK) > (reached >> _PAIR_SHIFT)]
+
+    def within(self, i, j, cutoff):
+        """Returns the mask of the pairs (i[k], j[k]), i < j, of nodes at most cutoff bonds away."""
+        i = numpy.asarray(i, dtype=numpy.int64)
+        j = numpy.asarray(j, dtype=numpy.int64)
+        sources = numpy.unique(i)
+        # The nodes without bonds are not in the arrays.
+        reached = self.pairs_within(sources[sources < len(self.indptr) - 1], cutoff)
+        return numpy.isin((i << _PAIR_SHIFT) | j, reached)
+
+
+def _exclusion_shard(bounds):
+    """Returns the sorted encoded exclusions of the source nodes in the range [lo, hi)."""
+    lo, hi = bounds
+    keys = []
+    for adjacency, cutoff in _exclusion_graphs:
+        nodes = adjacency.nodes
+        sources = nodes[numpy.searchsorted(nodes, lo):numpy.searchsorted(nodes, hi)]
+        keys.append(adjacency.pairs_within(sources, cutoff))
+    return numpy.unique(numpy.concatenate(keys))
+
+
+def write_exclusions(output_filename, graphs, num_workers=1, shard_size=20000):
+    """Writes the sorted list of pairs of nodes within the cutoff distance in any of the graphs.
+
+    The source nodes are split into shards of consecutive ids, every shard gives the sorted
+    part of the list, so the shards are written one by one, in order. With num_workers > 1
+    the shards are processed by the pool of processes.
+
+    Args:
+        output_filename: The name of the output file, with one pair per line.
+        graphs: The list of (CompactAdjacency, cutoff).
+        num_workers: The number of processes.
+        shard_size: The number of source nodes in a shard.
+
+    Returns:
+        The number of written pairs.
+    """
+    global _exclusion_graphs
+    nodes = numpy.unique(numpy.concatenate([adjacency.nodes for adjacency, _ in graphs] + [[]]))
+    nodes = nodes.astype(numpy.int64)
+    bounds = nodes[::shard_size].tolist() + [int(nodes[-1]) + 1] if len(nodes) else []
+    shards = list(zip(bounds[:-1], bounds[1:]))
+    _exclusion_graphs = graphs
+    pool = None
+    if num_workers > 1 and len(shards) > 1:
+        pool = multiprocessing.Pool(num_workers)
+        results = pool.imap(_exclusion_shard, shards)
+    else:
+        results = (_exclusion_shard(shard) for shard in shards)
+    num_pairs = 0
+    try:
+        with open(output_filename, 'w') as out_file:
+            separator = ''
+            for keys in results:
+                for chunk in files_io.format_rows('%d %d', [keys >> _PAIR_SHIFT, keys & _PAIR_MASK]):
+                    out_file.write(separator + chunk[:-1])
+                    separator = '\n'
+                num_pairs += len(keys)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _exclusion_graphs = None
+    return num_pairs
+
+
+def find_close_pairs(positions, box, cutoff):
+    """Returns the pairs of points closer than the cutoff in the periodic (rectangular) box.
+
+    The points are sorted into the cell list with cells not smaller than the cutoff, and the
+    distances are computed for every pair of neighbouring cells at once, one of the 27 shifts
+    of cells at a time. The number of cells is limited by the number of points, so the time
+    and the memory scale linearly with the number of points at the constant density.
+
+    Args:
+        positions: The (N, 3) array of positions.
+        box: The box size, only the first three values are used.
+        cutoff: The distance, smaller than the half of the box.
+
+    Returns:
+        The tuple of arrays (i, j, distance) with the indexes i < j of the close points,
+        sorted by i and j.
+    """
+    positions = numpy.asarray(positions, dtype=numpy.float64)
+    box = numpy.asarray(box, dtype=numpy.float64)[:3]
+    num_points = len(positions)
+    if num_points < 2:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, numpy.zeros(0)
+    wrapped = positions - box * numpy.floor(positions / box)
+    point_spacing = (box.prod() / num_points) ** (1.0 / 3.0)
+    num_cells = numpy.maximum(numpy.floor(box / max(cutoff, point_spacing)), 1).astype(numpy.int64)
+    cell = numpy.minimum((wrapped / box * num_cells).astype(numpy.int64), num_cells - 1)
+    cell_key = numpy.ravel_multi_index(cell.T, num_cells)
+    order = numpy.argsort(cell_key, kind='mergesort')
+    cell_start = numpy.searchsorted(cell_key[order], numpy.arange(num_cells.prod() + 1))
+
+    # With less than three cells in the direction, the shifts -1 and 1 point to the same cell.
+    shifts = [sorted(set(x % n for x in (-1, 0, 1))) for n in num_cells.tolist()]
+    output_i, output_j, output_distance = [], [], []
+    for shift in itertools.product(*shifts):
+        neighbour_key = numpy.ravel_multi_index(((cell + shift) % num_cells).T, num_cells)
+        starts = cell_start[neighbour_key]
+        counts = cell_start[neighbour_key + 1] - starts
+        i = numpy.repeat(numpy.arange(num_points), counts)
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        j = order[numpy.repeat(starts, counts) + offsets]
+        upper = j > i
+        i, j = i[upper], j[upper]
+        vectors = wrapped[j] - wrapped[i]
+        vectors -= box * numpy.round(vectors / box)
+        distance = numpy.sqrt(numpy.einsum('ij,ij->i', vectors, vectors))
+        close = distance < cutoff
+        output_i.append(i[close])
+        output_j.append(j[close])
+        output_distance.append(distance[close])
+    i, j, distance = [numpy.concatenate(x) for x in (output_i, output_j, output_distance)]
+    pair_order = numpy.lexsort((j, i))
+    return i[pair_order], j[pair_order], distance[pair_order]
+
+
+def kabsch_rotations(reference, target, weights, identity_weight=0.0):
+    """Returns the rotations that best map the reference points onto the target points, in batch.
+
+    For every item b, the rotation R[b] minimizes sum_k weights[b, k] |R[b] reference[b, k] - target[b, k]|^2
+    (Kabsch algorithm). The points are the vectors from the common origin, the padded points have
+    zero weight. The identity_weight adds the unit vectors of the axes, mapped onto themselves, to
+    every item, so the degenerate fits (e.g. of one point) take the rotation closest to the identity.
+
+    Args:
+        reference: The (B, K, 3) array of reference points.
+        target: The (B, K, 3) array of target points.
+        weights: The (B, K) array of weights of the points.
+        identity_weight: The weight of the axes in the fit.
+
+    Returns:
+        The (B, 3, 3) array of rotation matrices.
+    """
+    covariance = numpy.einsum('bk,bki,bkj->bij', weights, target, reference) + identity_weight * numpy.eye(3)
+    u, _, vt = numpy.linalg.svd(covariance)
+    # Reflections are turned into the proper rotations by flipping the least significant axis.
+    sign = numpy.sign(numpy.linalg.det(numpy.matmul(u, vt)))
+    sign[sign == 0] = 1.0
+    u[:, :, 2] *= sign[:, None]
+    rotations = numpy.matmul(u, vt)
+    if not identity_weight:
+        rotations[~(weights > 0).any(axis=1)] = numpy.eye(3)
+    return rotations
 
 
 def get_graph(settings):
@@ -120,46 +406,56 @@ def get_graph(settings):
     return g
 
 
-def generate_list(input_list, id_map):
-    output = {}
-    for k, v in input_list.items():
-        try:
-            new_k = tuple(map(lambda x: id_map[x], k))
-            output[new_k] = v
-        except KeyError:
-            continue
-    return output
-
-
 def get_atomistic_topology(in_top, virtual_atomtypes=None):
     """Returns atomistic topology from hybrid topology.
 
+    The atoms of virtual types are masked in the arrays of the hybrid topology, the bonded
+    terms are taken as the hybrid topology writes them and the cross terms are merged into
+    the sections. The hybrid topology is not changed, the atomistic one shares its ParamTable
+    and its content, so both can be written in one walk, see GROMACSTopologyFile.write.
+
     Args:
         in_top: Input hybrid topology.
         virtual_atomtypes: The list of CG atom types.
     Returns:
-        atomistic topology.
+        atomistic topology, with the map of old to new atom ids in old2new_ids.
     """
 
     if virtual_atomtypes is None:
         virtual_atomtypes = {k for k, v in in_top.atomtypes.items() if v['type'] == 'V'}
 
+    # The atoms of virtual types are masked by the codes of the types.
+    old_ids = sorted(in_top.atoms)
+    atoms = [in_top.atoms[x] for x in old_ids]
+    atom_types = files_io.Categories()
+    type_codes = atom_types.codes([at.atom_type for at in atoms])
+    is_virtual = numpy.array([x in virtual_atomtypes for x in atom_types.values], dtype=bool)[type_codes]
+    old2new = files_io.build_old2new(old_ids, numpy.asarray(old_ids)[is_virtual])
+
+    written_sections = in_top.written_sections()
+    out_top = files_io.GROMACSTopologyFile(in_top.file_name)
+    out_top.param_table = in_top.param_table
+    out_top.init()
+    out_top.content = in_top.content
+    out_top.skip_cross = True
+    out_top.defaults = in_top.defaults
+    out_top.moleculetype = in_top.moleculetype
+    out_top.molecules = in_top.molecules
+    out_top.system_name = in_top.system_name
+
     # Map topol id -> atom_id
     topol_old2new = {}
     new_topol_atoms = {}
-    new_id = 1
-    for old_id in sorted(in_top.atoms):
-        at = in_top.atoms[old_id]
-        if at.atom_type in virtual_atomtypes:
-            continue
+    for old_id, at in itertools.compress(zip(old_ids, atoms), ~is_virtual):
+        new_id = int(old2new[old_id])
+        at = copy.copy(at)
         at.atom_id = new_id
         at.cgnr = at.chain_idx
         new_topol_atoms[new_id] = at
         topol_old2new[old_id] = new_id
-        new_id += 1
 
-    in_top.atomtypes = {k: v for k, v in in_top.atomtypes.items() if v['type'] != 'V'}
-    in_top.old2new_ids = topol_old2new
+    out_top.atomtypes = {k: v for k, v in in_top.atomtypes.items() if v['type'] != 'V'}
+    out_top.old2new_ids = topol_old2new
 
     bondtypes = {}
     for i in in_top.bondtypes:
@@ -168,7 +464,7 @@ def get_atomistic_topology(in_top, virtual_atomtypes=None):
                 if i not in bondtypes:
                     bondtypes[i] = {}
                 bondtypes[i][j] = params
-    in_top.bondtypes = bondtypes
+    out_top.bondtypes = bondtypes
     angletypes = {}
     for i in in_top.angletypes:
         for j in in_top.angletypes[i]:
@@ -180,7 +476,7 @@ def get_atomistic_topology(in_top, virtual_atomtypes=None):
                         angletypes[i][j] = {k: params}
                     else:
                         angletypes[i][j][k] = params
-    in_top.angletypes = angletypes
+    out_top.angletypes = angletypes
     dihedraltypes = {}
     for i in in_top.dihedraltypes:
         for j in in_top.dihedraltypes[i]:
@@ -195,35 +491,26 @@ def get_atomistic_topology(in_top, virtual_atomtypes=None):
                             dihedraltypes[i][j][k] = {l: params}
                         else:
                             dihedraltypes[i][j][k][l] = params
-    in_top.dihedraltypes = dihedraltypes
-
-    in_top.header_section.insert(0, '; input_topol: {}\n'.format(in_top.file_name))
-    in_top.header_section.insert(1, '; clean: {}\n; remove_cross: {}\n'.format(True, True))
-
-    in_top.atoms = new_topol_atoms
-
-    new_bonds = generate_list(in_top.bonds, topol_old2new)
-    new_angles = generate_list(in_top.angles, topol_old2new)
-    new_dihs = generate_list(in_top.dihedrals, topol_old2new)
-    new_pairs = generate_list(in_top.pairs, topol_old2new)
-    new_cr_bonds = generate_list(in_top.cross_bonds, topol_old2new)
-    new_cr_angles = generate_list(in_top.cross_angles, topol_old2new)
-    new_cr_dihs = generate_list(in_top.cross_dihedrals, topol_old2new)
-    new_cr_pairs = generate_list(in_top.cross_pairs, topol_old2new)
-
-    in_top.bonds = new_bonds
-    in_top.angles = new_angles
-    in_top.dihedrals = new_dihs
-    in_top.pairs = new_pairs
-
-    in_top.bonds.update(new_cr_bonds)
-    in_top.angles.update(new_cr_angles)
-    in_top.dihedrals.update(new_cr_dihs)
-    in_top.pairs.update(new_cr_pairs)
-    in_top.cross_bonds = {}
-    in_top.cross_angles = {}
-    in_top.cross_dihedrals = {}
-    in_top.cross_pairs = {}
-    in_top.skip_cross = True
-
-    return in_top
+    out_top.dihedraltypes = dihedraltypes
+
+    out_top.header_section = [
+        '; input_topol: {}\n'.format(in_top.file_name),
+        '; clean: {}\n; remove_cross: {}\n'.format(True, True)] + list(in_top.header_section)
+
+    out_top.atoms = new_topol_atoms
+
+    # The cross terms are merged into the sections, as the terms set again they keep
+    # their place and take the last parameters.
+    for section_name in ('bonds', 'angles', 'dihedrals', 'improper_dihedrals', 'pairs'):
+        cross_section_name = 'cross_{}'.format(section_name)
+        terms = files_io.BondedTerms(param_table=in_top.param_table)
+        if section_name in written_sections:
+            terms = in_top.written_terms(section_name)
+            terms.remap(old2new)
+        if cross_section_name in written_sections:
+            cross_terms = in_top.written_terms(cross_section_name)
+            cross_terms.remap(old2new)
+            terms.add_coded(*cross_terms.arrays())
+        setattr(out_top, section_name, terms)
+
+    return out_top
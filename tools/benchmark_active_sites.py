@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2016 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is distributed under free software licence:
+you can redistribute it and/or modify it under the terms of the
+GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmark of the active-site search of BackmapperSettings2 on a synthetic
+linear polymer: every bead is a residue with a backbone of atoms and two
+active sites, each with one leaving atom that is removed when the cross bond
+is created. The time per cross bond of the incremental degree update is
+compared with the rebuild of the degree of the whole graph after every bond.
+"""
+
+import argparse
+import collections
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import files_io
+import graph
+import structures
+
+
+class Fragment(object):
+    def __init__(self, active_sites_remove_map):
+        self.active_sites_remove_map = active_sites_remove_map
+
+
+class SyntheticSettings(structures.BackmapperSettings2):
+    """Settings with the data structures of the active-site search, without the XML file."""
+
+    def __init__(self, num_beads, atoms_per_bead):
+        self.global_graph = graph.Graph()
+        self.cg_active_sites = collections.defaultdict(list)
+        self.active_site_labels = {}
+        self.bead_active_site_labels = {}
+        self.active_site_pairs = {}
+        self.atom_id2fragment = {}
+        self.mol_atomname_map = collections.defaultdict(dict)
+        self.predefined_active_sites = {}
+        self.bond_params = {('MON:A1', 'MON:A2'): ['1'], ('MON:A2', 'MON:A1'): ['1']}
+        fragment = Fragment({'MON:A1': ['0:MON:H1'], 'MON:A2': ['0:MON:H2']})
+        self.cross_bonds = []
+        at_id = num_beads + 1
+        for bead_id in range(1, num_beads + 1):
+            self.global_graph.add_node(bead_id)
+            self.atom_id2fragment[bead_id] = fragment
+            names = ['A1', 'H1', 'A2', 'H2'] + ['C{}'.format(i) for i in range(atoms_per_bead - 4)]
+            atom_map = {}
+            for name in names:
+                atom_map[name] = at_id
+                self.global_graph.add_node(at_id)
+                at_id += 1
+            self.mol_atomname_map['MON'][bead_id] = atom_map
+            backbone = [atom_map['A1']] + [atom_map[n] for n in names[4:]] + [atom_map['A2']]
+            for at1, at2 in zip(backbone, backbone[1:]):
+                self.global_graph.add_edge(at1, at2)
+            self.global_graph.add_edge(atom_map['A1'], atom_map['H1'])
+            self.global_graph.add_edge(atom_map['A2'], atom_map['H2'])
+            for name in ['A1', 'A2']:
+                atom = files_io.Atom(atom_map[name], name, 'MON', bead_id, None)
+                self.cg_active_sites[bead_id].append((atom, 2))
+            if bead_id > 1:
+                self.cross_bonds.append((bead_id - 1, bead_id))
+
+    def run(self):
+        """Runs the search for all cross bonds, as in rebuild_hybrid_topology."""
+        atoms_to_remove = []
+        at_cross_bonds = []
+        global_degree = dict(self.global_graph.degree())
+        for b1, b2 in self.cross_bonds:
+            ats1, ats2, global_degree = self._search_active_sites(b1, b2, global_degree, atoms_to_remove)
+            if ats1 is None or ats2 is None:
+                raise RuntimeError('Active sites for {}-{} not found'.format(b1, b2))
+            at_cross_bonds.append((ats1.atom_id, ats2.atom_id))
+            self.global_graph.add_edge(ats1.atom_id, ats2.atom_id)
+            global_degree[ats1.atom_id] += 1
+            global_degree[ats2.atom_id] += 1
+        return at_cross_bonds, atoms_to_remove, global_degree
+
+
+class FullDegreeSettings(SyntheticSettings):
+    """Rebuilds the degree of the whole graph after the removal of atoms."""
+
+    def _remove_graph_nodes(self, node_ids, global_degree):
+        for node_id in node_ids:
+            self.global_graph.remove_node(node_id)
+        global_degree.clear()
+        global_degree.update(self.global_graph.degree())
+
+
+def _args():
+    parser = argparse.ArgumentParser('Benchmark of the active-site search.')
+    parser.add_argument('--sizes', default='250,500,1000,2000',
+                        help='Comma separated list of the number of CG beads')
+    parser.add_argument('--atoms_per_bead', default=20, type=int)
+    parser.add_argument('--skip_full', action='store_true', help='Do not run the full degree rebuild')
+    return parser.parse_args()
+
+
+def main():
+    args = _args()
+    print('{:>8} {:>10} {:>14} {:>14} {:>14} {:>14}'.format(
+        'beads', 'atoms', 'cross bonds', 'incr [ms/bond]', 'full [ms/bond]', 'speed-up'))
+    for num_beads in map(int, args.sizes.split(',')):
+        results = []
+        timings = []
+        for settings_class in [SyntheticSettings] + ([] if args.skip_full else [FullDegreeSettings]):
+            settings = settings_class(num_beads, args.atoms_per_bead)
+            num_atoms = settings.global_graph.number_of_nodes() - num_beads
+            # The search reports every rejected pair of active sites.
+            stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+            try:
+                t0 = time.time()
+                results.append(settings.run())
+                timings.append(1000.0 * (time.time() - t0) / len(settings.cross_bonds))
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+        if len(results) == 2 and results[0] != results[1]:
+            raise RuntimeError('Different results of the incremental and the full degree update')
+        full = '{:14.4f} {:14.1f}'.format(timings[1], timings[1] / timings[0]) if len(timings) == 2 else ''
+        print('{:8d} {:10d} {:14d} {:14.4f} {}'.format(
+            num_beads, num_atoms, len(settings.cross_bonds), timings[0], full))
+
+
+if __name__ == '__main__':
+    main()